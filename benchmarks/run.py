@@ -0,0 +1,348 @@
+"""Offline benchmarks for the ingest and RAG pipeline.
+
+Generates synthetic documents, then times each stage in isolation: the extractors,
+chunk_document, embedding, Qdrant upsert/search (in-memory mode), BM25 + RRF fusion
+and cross-encoder reranking. Reports p50/p95/p99 latency and throughput per stage
+and writes them to a JSON file to diff between commits.
+
+    python -m benchmarks.run                          # medium size, all stages
+    python -m benchmarks.run --size small --only chunk,hybrid
+    python -m benchmarks.run --compare benchmarks/results/<old>.json
+
+Nothing touches the network: the models must already be in the local Hugging Face
+cache (or exported for EMBEDDING_BACKEND=onnx). Stages whose dependencies are
+missing (a model, tesseract, python-docx, ...) are recorded as skipped, and a stage
+that raises is recorded as failed without stopping the others.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+
+# Never download anything; a missing model skips its stages instead
+os.environ.setdefault("HF_HUB_OFFLINE", "1")
+os.environ.setdefault("TRANSFORMERS_OFFLINE", "1")
+
+import numpy as np
+
+from benchmarks import synthetic
+from utils.vector_store import VECTOR_SIZE
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+STAGES = (
+    "extract_pdf", "extract_docx", "extract_image", "extract_code",
+    "chunk", "embed", "qdrant_upsert", "qdrant_search", "hybrid", "rerank",
+)
+SIZES = {
+    "small": dict(pdf_pages=5, docx_words=2000, image_lines=10, code_functions=50,
+                  doc_words=5000, embed_batch=32, points=2000, queries=50, candidates=15),
+    "medium": dict(pdf_pages=25, docx_words=10000, image_lines=25, code_functions=300,
+                   doc_words=50000, embed_batch=64, points=20000, queries=200, candidates=15),
+    "large": dict(pdf_pages=100, docx_words=50000, image_lines=40, code_functions=2000,
+                  doc_words=250000, embed_batch=128, points=100000, queries=500, candidates=15),
+}
+QUESTIONS = [
+    "What does the termination clause say about liability?",
+    "How much did quarterly revenue grow?",
+    "Which customer invoices are still unpaid?",
+    "Summarize the retrieval latency report.",
+]
+
+
+class Skip(Exception):
+    pass
+
+
+def summarize(samples, items=None, unit=None):
+    """Latency percentiles in ms over `samples` (seconds) and throughput in `unit`/s."""
+    ms = np.array(samples) * 1000
+    result = {
+        "runs": len(samples),
+        "p50_ms": round(float(np.percentile(ms, 50)), 3),
+        "p95_ms": round(float(np.percentile(ms, 95)), 3),
+        "p99_ms": round(float(np.percentile(ms, 99)), 3),
+        "mean_ms": round(float(ms.mean()), 3),
+    }
+    if items:
+        result["throughput"] = round(items * len(samples) / float(np.sum(samples)), 3)
+        result["throughput_unit"] = f"{unit}/s"
+    return result
+
+
+def timed(fn, runs, warmup=1):
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def timed_each(fn, inputs, warmup=1):
+    for item in inputs[:warmup]:
+        fn(item)
+    samples = []
+    for item in inputs:
+        started = time.perf_counter()
+        fn(item)
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+class Bench:
+    def __init__(self, size, runs, workdir, seed=0):
+        self.cfg = SIZES[size]
+        self.runs = runs
+        self.workdir = workdir
+        self.seed = seed
+        self._document = None
+        self._chunks = None
+        self._models = {}
+
+    # Inputs shared by several stages
+
+    def document(self):
+        if self._document is None:
+            self._document = synthetic.markdown_document(self.cfg["doc_words"], self.seed)
+        return self._document
+
+    def chunks(self):
+        if self._chunks is None:
+            from utils.chunker import chunk_document
+            self._chunks = [c["text"] for c in chunk_document(self.document())]
+        return self._chunks
+
+    def model(self, kind):
+        if kind not in self._models:
+            try:
+                import api
+                started = time.perf_counter()
+                self._models[kind] = api.get_embedder() if kind == "embedder" else api.get_reranker()
+                self._models[kind + "_load_s"] = round(time.perf_counter() - started, 3)
+            except Exception as e:
+                raise Skip(f"{kind} unavailable offline ({e})")
+        return self._models[kind]
+
+    def _file(self, name, writer, *args):
+        path = os.path.join(self.workdir, name)
+        if not os.path.exists(path):
+            writer(path, *args, seed=self.seed)
+        return path, os.path.getsize(path)
+
+    # Stages
+
+    def extract_pdf(self):
+        try:
+            from utils.extract_pdf import extract_text_from_pdf
+        except ImportError as e:
+            raise Skip(str(e))
+        path, size = self._file("doc.pdf", synthetic.write_pdf, self.cfg["pdf_pages"])
+        result = summarize(timed(lambda: extract_text_from_pdf(path), self.runs), size / 1e6, "MB")
+        result["pages_per_s"] = round(self.cfg["pdf_pages"] * 1000 / result["mean_ms"], 2)
+        return result
+
+    def extract_docx(self):
+        try:
+            from utils.extract_word import extract_text_from_word
+        except ImportError as e:
+            raise Skip(str(e))
+        path, size = self._file("doc.docx", synthetic.write_docx, self.cfg["docx_words"])
+        return summarize(timed(lambda: extract_text_from_word(path), self.runs), size / 1e6, "MB")
+
+    def extract_image(self):
+        if not shutil.which("tesseract"):
+            raise Skip("tesseract binary not found")
+        try:
+            from utils.extract_image import extract_text_from_image
+        except ImportError as e:
+            raise Skip(str(e))
+        path, _ = self._file("page.png", synthetic.write_image, self.cfg["image_lines"])
+        return summarize(timed(lambda: extract_text_from_image(path), self.runs), 1, "images")
+
+    def extract_code(self):
+        from utils.extract_code import extract_text_from_code
+        path, size = self._file("module.py", synthetic.write_code, self.cfg["code_functions"])
+        return summarize(timed(lambda: extract_text_from_code(path), self.runs), size / 1e6, "MB")
+
+    def chunk(self):
+        from utils.chunker import chunk_document
+        text = self.document()
+        result = summarize(timed(lambda: chunk_document(text), self.runs), len(text.encode()) / 1e6, "MB")
+        result["chunks"] = len(self.chunks())
+        return result
+
+    def embed(self):
+        model = self.model("embedder")
+        chunks = self.chunks()
+        batch = self.cfg["embed_batch"]
+        batches = [chunks[i:i + batch] for i in range(0, len(chunks), batch)]
+        batches = [b for b in batches if len(b) == batch] or batches
+        samples = timed_each(lambda texts: model.encode(texts, convert_to_numpy=True), batches[:self.runs])
+        result = summarize(samples, batch, "chunks")
+        result["load_s"] = self._models.get("embedder_load_s")
+        return result
+
+    def _qdrant(self):
+        from utils import vector_store
+        client = vector_store.create_client("memory")
+        vector_store.ensure_collection(client)
+        return client, vector_store
+
+    def _vectors(self, count, seed):
+        # Random unit vectors keep the Qdrant stages independent of the embedding model
+        vectors = np.random.default_rng(seed).standard_normal((count, VECTOR_SIZE)).astype(np.float32)
+        return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    def _points(self, count, vectors):
+        from qdrant_client.models import PointStruct
+        from utils import vector_store
+        rng = random.Random(self.seed)
+        return [
+            PointStruct(id=i, vector=vectors[i].tolist(), payload={
+                "tenant_id": vector_store.tenant_key(i % 50),
+                "history_id": i % 500,
+                "text": synthetic.sentence(rng),
+                "chunk_index": i,
+            })
+            for i in range(count)
+        ]
+
+    def qdrant_upsert(self):
+        try:
+            client, vector_store = self._qdrant()
+        except ImportError as e:
+            raise Skip(str(e))
+        points = self._points(self.cfg["points"], self._vectors(self.cfg["points"], self.seed))
+        batches = [points[i:i + 256] for i in range(0, len(points), 256)]
+        samples = timed_each(lambda batch: client.upsert(collection_name=vector_store.COLLECTION_NAME, points=batch), batches, warmup=0)
+        return summarize(samples, 256, "points")
+
+    def qdrant_search(self):
+        try:
+            client, vector_store = self._qdrant()
+        except ImportError as e:
+            raise Skip(str(e))
+        points = self._points(self.cfg["points"], self._vectors(self.cfg["points"], self.seed))
+        for i in range(0, len(points), 1024):
+            client.upsert(collection_name=vector_store.COLLECTION_NAME, points=points[i:i + 1024])
+        queries = self._vectors(self.cfg["queries"], self.seed + 1)
+        rng = random.Random(self.seed)
+
+        def search(vector):
+            history_id = rng.randrange(500)
+            vector_store.search(client, vector.tolist(), vector_store.history_filter([history_id], [history_id % 50]),
+                                self.cfg["candidates"])
+        return summarize(timed_each(search, list(queries)), 1, "queries")
+
+    def _candidate_sets(self):
+        chunks = self.chunks()
+        rng = random.Random(self.seed)
+        size = min(self.cfg["candidates"], len(chunks))
+        return [(QUESTIONS[i % len(QUESTIONS)], rng.sample(chunks, size)) for i in range(self.cfg["queries"])]
+
+    def hybrid(self):
+        from utils import retrieval
+        try:
+            import rank_bm25  # noqa: F401
+        except ImportError as e:
+            raise Skip(str(e))
+        return summarize(timed_each(lambda qc: retrieval.hybrid_order(*qc), self._candidate_sets()), 1, "queries")
+
+    def rerank(self):
+        from utils import retrieval
+        model = self.model("reranker")
+        top_k = 5
+        sets = self._candidate_sets()[:self.runs * 10]
+        samples = timed_each(lambda qc: retrieval.rerank(model, qc[0], qc[1], list(range(len(qc[1]))), top_k), sets)
+        result = summarize(samples, 1, "queries")
+        result["load_s"] = self._models.get("reranker_load_s")
+        return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return "unknown"
+
+
+def run(size="medium", runs=10, only=None, seed=0):
+    stages = only or STAGES
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "size": size,
+            "runs": runs,
+            "seed": seed,
+            "embedding_backend": os.environ.get("EMBEDDING_BACKEND", "torch"),
+            "qdrant_quantization": os.environ.get("QDRANT_QUANTIZATION", "none"),
+        },
+        "stages": {},
+    }
+    with tempfile.TemporaryDirectory(prefix="omnidoc-bench-") as workdir:
+        bench = Bench(size, runs, workdir, seed)
+        for stage in stages:
+            print(f"{stage:<15}", end=" ", flush=True)
+            try:
+                result = getattr(bench, stage)()
+                print(f"p50 {result['p50_ms']:>10.2f} ms  p95 {result['p95_ms']:>10.2f} ms  "
+                      f"p99 {result['p99_ms']:>10.2f} ms  {result.get('throughput', '')} {result.get('throughput_unit', '')}")
+            except Skip as e:
+                result = {"skipped": str(e)}
+                print(f"skipped: {e}")
+            except Exception as e:
+                # One broken stage must not cost the results of all the others
+                result = {"failed": f"{type(e).__name__}: {e}"}
+                print(f"FAILED: {result['failed']}")
+            report["stages"][stage] = result
+    return report
+
+
+def compare(baseline, current):
+    print(f"\n{'stage':<15}{'p50 before':>12}{'p50 after':>12}{'p95 before':>12}{'p95 after':>12}{'change':>10}")
+    for stage, after in current["stages"].items():
+        before = baseline.get("stages", {}).get(stage, {})
+        if "p50_ms" not in before or "p50_ms" not in after:
+            continue
+        change = (after["p50_ms"] - before["p50_ms"]) / before["p50_ms"] * 100 if before["p50_ms"] else 0.0
+        print(f"{stage:<15}{before['p50_ms']:>12.2f}{after['p50_ms']:>12.2f}"
+              f"{before['p95_ms']:>12.2f}{after['p95_ms']:>12.2f}{change:>+9.1f}%")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", choices=sorted(SIZES), default="medium")
+    parser.add_argument("--runs", type=int, default=10, help="timed runs per stage (after one warm-up)")
+    parser.add_argument("--only", help=f"comma-separated subset of: {', '.join(STAGES)}")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="JSON path (default: benchmarks/results/<commit>-<size>.json)")
+    parser.add_argument("--compare", help="earlier results JSON to compare against")
+    args = parser.parse_args()
+
+    only = [s.strip() for s in args.only.split(",")] if args.only else None
+    unknown = set(only or []) - set(STAGES)
+    if unknown:
+        parser.error(f"unknown stages: {', '.join(sorted(unknown))}")
+
+    report = run(args.size, args.runs, only, args.seed)
+    out = args.out or os.path.join(RESULTS_DIR, f"{report['meta']['commit']}-{args.size}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.write("\n")
+    print(f"\nSaved {out}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
@@ -0,0 +1,133 @@
+"""Deterministic synthetic documents for the benchmarks.
+
+Everything is generated from a seed, so two runs (or two commits) benchmark
+exactly the same inputs. PDFs are written by hand (no extra dependency); DOCX
+and images need python-docx and Pillow, which the app depends on anyway.
+"""
+import random
+
+WORDS = (
+    "revenue contract analysis quarterly growth model tenant vector document page section "
+    "customer invoice payment termination clause liability schedule report summary index "
+    "latency throughput cache storage network embedding retrieval question answer policy "
+    "the of and to in for with on by from at as is was are be this that which these"
+).split()
+
+
+def sentence(rng, min_words=6, max_words=18):
+    words = [rng.choice(WORDS) for _ in range(rng.randint(min_words, max_words))]
+    return " ".join(words).capitalize() + "."
+
+
+def paragraph(rng, sentences=5):
+    return " ".join(sentence(rng) for _ in range(sentences))
+
+
+def markdown_document(words, seed=0):
+    """Roughly `words` words of markdown: headings, paragraphs, a table and a code block per section."""
+    rng = random.Random(seed)
+    parts = []
+    count = 0
+    section = 0
+    while count < words:
+        section += 1
+        parts.append(f"## Section {section}: {rng.choice(WORDS).title()} {rng.choice(WORDS)}")
+        for _ in range(rng.randint(2, 4)):
+            text = paragraph(rng, rng.randint(3, 7))
+            parts.append(text)
+            count += len(text.split())
+        if section % 3 == 0:
+            rows = ["| Item | Amount | Status |", "| --- | --- | --- |"]
+            rows += [f"| {rng.choice(WORDS)} | {rng.randint(1, 99999)} | {rng.choice(WORDS)} |" for _ in range(rng.randint(3, 12))]
+            parts.append("\n".join(rows))
+            count += 3 * len(rows)
+        if section % 4 == 0:
+            parts.append("```python\n" + code_file(rng.randint(5, 15), seed=seed + section) + "\n```")
+    return "\n\n".join(parts)
+
+
+def code_file(functions, seed=0):
+    rng = random.Random(seed)
+    lines = ["import os", "import json", ""]
+    for i in range(functions):
+        name = f"{rng.choice(WORDS)}_{rng.choice(WORDS)}_{i}"
+        lines += [
+            f"def {name}(items, limit={rng.randint(1, 100)}):",
+            f'    """{sentence(rng)}"""',
+            "    total = 0",
+            "    for item in items[:limit]:",
+            f"        total += len(str(item)) * {rng.randint(2, 9)}",
+            "    return total",
+            "",
+        ]
+    return "\n".join(lines)
+
+
+def _pdf_escape(text):
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def write_pdf(path, pages, lines_per_page=45, seed=0):
+    """A text PDF with `pages` pages of Helvetica text that pdfplumber can extract."""
+    rng = random.Random(seed)
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    page_ids = []
+    for _ in range(pages):
+        commands = ["BT", "/F1 10 Tf", "12 TL", "50 780 Td"]
+        for _ in range(lines_per_page):
+            commands.append(f"({_pdf_escape(sentence(rng, 8, 14))}) '")
+        commands.append("ET")
+        stream = "\n".join(commands).encode("latin-1")
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        content_id = len(objects)
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % content_id
+        )
+        page_ids.append(len(objects))
+    kids = " ".join(f"{i} 0 R" for i in page_ids).encode()
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, pages)
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    with open(path, "wb") as f:
+        f.write(out)
+
+
+def write_docx(path, words, seed=0):
+    from docx import Document
+    doc = Document()
+    for block in markdown_document(words, seed).split("\n\n"):
+        if block.startswith("## "):
+            doc.add_heading(block[3:], level=2)
+        elif not block.startswith(("|", "```")):
+            doc.add_paragraph(block)
+    doc.save(path)
+
+
+def write_image(path, lines, width=1240, seed=0):
+    """A white page with `lines` lines of black text, large enough for OCR."""
+    from PIL import Image, ImageDraw, ImageFont
+    rng = random.Random(seed)
+    line_height = 34
+    image = Image.new("RGB", (width, 60 + lines * line_height), "white")
+    draw = ImageDraw.Draw(image)
+    try:
+        font = ImageFont.load_default(size=24)
+    except TypeError:
+        font = ImageFont.load_default()
+    for i in range(lines):
+        draw.text((40, 30 + i * line_height), sentence(rng, 6, 10), fill="black", font=font)
+    image.save(path)
+
+
+def write_code(path, functions, seed=0):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(code_file(functions, seed))
@@ -0,0 +1,116 @@
+"""Export the embedder and reranker to ONNX for EMBEDDING_BACKEND=onnx.
+
+Writes model.onnx, an int8 dynamically quantized model_quantized.onnx and
+tokenizer.json into ONNX_EMBEDDER_DIR / ONNX_RERANKER_DIR, then checks the ONNX
+outputs against the torch models. Needs torch, sentence-transformers and
+onnxruntime, so run it on a build machine, not in the serving image.
+
+    python export_onnx.py             # export both models and verify
+    python export_onnx.py --verify    # only verify existing exports
+
+The verify step exits non-zero when any embedding's cosine similarity to the torch
+embedding drops below --min-cosine, or the reranker orders the top passages differently.
+"""
+import argparse
+import os
+import sys
+
+from dotenv import load_dotenv
+load_dotenv()
+
+import numpy as np
+
+from utils.onnx_models import OnnxEmbedder, OnnxCrossEncoder
+
+EMBEDDING_MODEL = 'all-MiniLM-L6-v2'
+RERANKER_MODEL = 'cross-encoder/ms-marco-MiniLM-L-6-v2'
+ONNX_EMBEDDER_DIR = os.environ.get("ONNX_EMBEDDER_DIR", "models/all-MiniLM-L6-v2-onnx")
+ONNX_RERANKER_DIR = os.environ.get("ONNX_RERANKER_DIR", "models/ms-marco-MiniLM-L-6-v2-onnx")
+OPSET = 17
+
+SAMPLE_TEXTS = [
+    "warmup",
+    "The quarterly revenue grew by 12% compared to the previous year.",
+    "def chunk_document(text, target_tokens=None):\n    return []",
+    "| Region | Sales |\n| --- | --- |\n| EMEA | 1,204 |",
+    "Photosynthesis converts light energy into chemical energy stored in glucose. " * 20,
+    "Termination requires thirty days written notice by either party.",
+    "Ünïcödé, emoji 🙂 and CJK 文字 should survive tokenization.",
+]
+SAMPLE_QUESTION = "How much did revenue grow last year?"
+
+
+def _export(model, tokenizer, out_dir, output_name):
+    import torch
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    os.makedirs(out_dir, exist_ok=True)
+    model.eval()
+    sample = tokenizer(["warmup text", "a second, longer warmup text"], padding=True, return_tensors="pt")
+    input_names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in sample]
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    dynamic_axes[output_name] = {0: "batch"} if output_name == "logits" else {0: "batch", 1: "sequence"}
+
+    class Wrapper(torch.nn.Module):
+        def __init__(self, inner):
+            super().__init__()
+            self.inner = inner
+
+        def forward(self, *inputs):
+            outputs = self.inner(**dict(zip(input_names, inputs)))
+            return outputs[0]
+
+    path = os.path.join(out_dir, "model.onnx")
+    with torch.no_grad():
+        torch.onnx.export(
+            Wrapper(model), tuple(sample[name] for name in input_names), path,
+            input_names=input_names, output_names=[output_name],
+            dynamic_axes=dynamic_axes, opset_version=OPSET
+        )
+    quantize_dynamic(path, os.path.join(out_dir, "model_quantized.onnx"), weight_type=QuantType.QInt8)
+    # Writes tokenizer.json, which the `tokenizers` package loads without transformers
+    tokenizer.save_pretrained(out_dir)
+    print(f"Exported {out_dir}")
+
+
+def export():
+    from sentence_transformers import SentenceTransformer, CrossEncoder
+    st = SentenceTransformer(EMBEDDING_MODEL, device="cpu")
+    _export(st[0].auto_model, st.tokenizer, ONNX_EMBEDDER_DIR, "last_hidden_state")
+    ce = CrossEncoder(RERANKER_MODEL, device="cpu")
+    _export(ce.model, ce.tokenizer, ONNX_RERANKER_DIR, "logits")
+
+
+def verify(min_cosine, top_n=3):
+    from sentence_transformers import SentenceTransformer, CrossEncoder
+    reference = SentenceTransformer(EMBEDDING_MODEL, device="cpu").encode(SAMPLE_TEXTS, convert_to_numpy=True)
+    reference_scores = CrossEncoder(RERANKER_MODEL, device="cpu").predict([[SAMPLE_QUESTION, t] for t in SAMPLE_TEXTS])
+    ok = True
+    for quantized in (False, True):
+        label = "int8" if quantized else "fp32"
+        embedder = OnnxEmbedder(ONNX_EMBEDDER_DIR, quantized=quantized)
+        if quantized and not embedder.quantized:
+            print(f"{label}: no model_quantized.onnx, skipped")
+            continue
+        vectors = embedder.encode(SAMPLE_TEXTS)
+        # Both sides are L2-normalised, so the dot product is the cosine
+        cosines = np.sum(vectors * reference / np.linalg.norm(reference, axis=1, keepdims=True), axis=1)
+        scores = OnnxCrossEncoder(ONNX_RERANKER_DIR, quantized=quantized).predict(
+            [[SAMPLE_QUESTION, t] for t in SAMPLE_TEXTS])
+        # Only the order matters to retrieval (and older CrossEncoders apply a sigmoid to the logits)
+        same_order = np.array_equal(np.argsort(-scores)[:top_n], np.argsort(-np.asarray(reference_scores))[:top_n])
+        passed = cosines.min() >= min_cosine and same_order
+        ok = ok and passed
+        print(f"{label}: min cosine {cosines.min():.5f}, same top-{top_n} reranking {same_order} "
+              f"-> {'OK' if passed else 'FAIL'}")
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--verify", action="store_true", help="skip the export and only compare existing models")
+    parser.add_argument("--min-cosine", type=float, default=0.99)
+    args = parser.parse_args()
+    if not args.verify:
+        export()
+    sys.exit(0 if verify(args.min_cosine) else 1)
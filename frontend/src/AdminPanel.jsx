@@ -1,6 +1,6 @@
 import { useState, useEffect } from 'react';
 import axios from 'axios';
-import { Users, FileText, ArrowLeft, Star } from 'lucide-react';
+import { Users, FileText, ArrowLeft, Star, Coins } from 'lucide-react';
 
 const rawApiBase = import.meta.env.VITE_API_BASE || 'http://localhost:5000/api';
 const API_BASE = rawApiBase.endsWith('/api') ? rawApiBase : `${rawApiBase}/api`;
@@ -8,6 +8,7 @@ const API_BASE = rawApiBase.endsWith('/api') ? rawApiBase : `${rawApiBase}/api`;
 export default function AdminPanel({ onBack }) {
     const [users, setUsers] = useState([]);
     const [history, setHistory] = useState([]);
+    const [usage, setUsage] = useState([]);
 
     useEffect(() => {
         fetchAdminData();
@@ -19,6 +20,8 @@ export default function AdminPanel({ onBack }) {
             const hRes = await axios.get(`${API_BASE}/admin/history`);
             if (uRes.data.success) setUsers(uRes.data.users);
             if (hRes.data.success) setHistory(hRes.data.history);
+            const usageRes = await axios.get(`${API_BASE}/admin/usage?days=30`);
+            if (usageRes.data.success) setUsage(usageRes.data.users);
         } catch (e) {
             console.error(e);
         }
@@ -75,6 +78,25 @@ export default function AdminPanel({ onBack }) {
                     </div>
                 </div>
             </div>
+
+            <div className="glass-panel" style={{ padding: '24px', marginTop: '24px' }}>
+                <h3 style={{ display: 'flex', alignItems: 'center', gap: '8px', marginBottom: '16px' }}>
+                    <Coins size={20} /> AI Usage (last 30 days)
+                </h3>
+                <div style={{ display: 'flex', flexDirection: 'column', gap: '12px' }}>
+                    {usage.map(u => (
+                        <div key={u.user_id} style={{ display: 'flex', justifyContent: 'space-between', background: 'rgba(255,255,255,0.05)', padding: '12px', borderRadius: '8px' }}>
+                            <span style={{ fontWeight: 600 }}>{u.username || `#${u.user_id}`}</span>
+                            <div style={{ display: 'flex', gap: '16px', fontSize: '0.9rem', color: 'var(--text-muted)' }}>
+                                <span>Calls: {u.calls}</span>
+                                <span>Tokens: {Number(u.tokens).toLocaleString()}</span>
+                                <span>Cached: {Number(u.cached_tokens).toLocaleString()}</span>
+                                <span>${u.cost_usd.toFixed(4)}</span>
+                            </div>
+                        </div>
+                    ))}
+                </div>
+            </div>
         </div>
     );
 }
@@ -0,0 +1,39 @@
+# Picked up automatically by gunicorn from the working directory; CLI flags
+# (e.g. those in the Procfile) still take precedence.
+import os
+
+# With PRELOAD_MODELS=1 the app (and both models) is imported once in the master
+# and forked, so the weights are shared copy-on-write instead of loaded per worker.
+preload_app = os.environ.get("PRELOAD_MODELS", "0") == "1"
+
+
+def post_fork(server, worker):
+    # torch's and ONNX Runtime's thread pools do not survive fork; set them up in each worker
+    if preload_app:
+        import api
+        api.after_fork()
+
+
+def on_starting(server):
+    # Per-worker metric snapshots from a previous run would otherwise be merged into this one
+    from utils import metrics
+    metrics.clear_dir()
+    # The embedded Qdrant store is file-locked to one process; the other workers would run without vectors
+    from utils import vector_store
+    if vector_store.QDRANT_MODE == "embedded" and server.cfg.workers > 1:
+        server.log.error(f"QDRANT_MODE=embedded with {server.cfg.workers} workers: only one can open "
+                         f"{vector_store.QDRANT_PATH}; set QDRANT_MODE=server for multi-worker deploys")
+
+
+def worker_exit(server, worker):
+    # LLM usage rows are buffered for a few seconds; write them before the worker goes away
+    import sys
+    api = sys.modules.get("api")
+    if api is None or not os.environ.get("DATABASE_URL"):
+        return
+    from utils import llm_usage
+    try:
+        with api.db_connection() as conn:
+            llm_usage.flush(conn)
+    except Exception as e:
+        server.log.warning(f"LLM usage flush on worker exit failed ({e})")
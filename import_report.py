@@ -0,0 +1,72 @@
+"""Report how long a cold `import api` takes and which packages it is spent in.
+
+Imports the module in fresh interpreters: a few plain runs for the wall-clock time
+(best of --repeat) and one `python -X importtime` run for the breakdown, whose
+per-module self times are summed by top-level package.
+
+    python import_report.py                  # wall time + top 20 packages
+    python import_report.py --max-ms 1500    # exit 1 when the import is slower
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# Keep import-time side effects (schema check, model preload) out of the measurement
+IMPORT_ENV = {"RUN_SCHEMA_CHECK": "0", "PRELOAD_MODELS": "0"}
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def _run(code, *flags):
+    env = dict(os.environ, **IMPORT_ENV)
+    return subprocess.run(
+        [sys.executable, *flags, "-c", code],
+        cwd=HERE, env=env, capture_output=True, text=True, check=True
+    )
+
+
+def measure_import(module="api", repeat=3):
+    """Best-of-`repeat` wall time in ms to import `module`, plus the top-level modules it left loaded."""
+    code = (
+        "import sys, time, json\n"
+        "t = time.perf_counter()\n"
+        f"import {module}\n"
+        "print(json.dumps([(time.perf_counter() - t) * 1000, sorted(m for m in sys.modules if '.' not in m)]))"
+    )
+    best, loaded = None, []
+    for _ in range(repeat):
+        elapsed, loaded = json.loads(_run(code).stdout.strip().splitlines()[-1])
+        best = elapsed if best is None else min(best, elapsed)
+    return best, loaded
+
+
+def importtime_breakdown(module="api"):
+    """{top-level package: self time in ms} from `-X importtime`, largest first."""
+    totals = {}
+    stderr = _run(f"import {module}", "-X", "importtime").stderr
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, name = line[len("import time:"):].split("|", 2)
+        package = name.strip().split(".")[0]
+        totals[package] = totals.get(package, 0) + int(self_us) / 1000
+    return dict(sorted(totals.items(), key=lambda kv: kv[1], reverse=True))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--module", default="api")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--top", type=int, default=20)
+    parser.add_argument("--max-ms", type=float, help="fail when the best import time exceeds this budget")
+    args = parser.parse_args()
+
+    elapsed, _ = measure_import(args.module, args.repeat)
+    print(f"import {args.module}: {elapsed:.0f} ms (best of {args.repeat})\n")
+    print(f"{'package':<30}{'self ms':>10}")
+    for package, ms in list(importtime_breakdown(args.module).items())[:args.top]:
+        print(f"{package:<30}{ms:>10.1f}")
+    if args.max_ms is not None and elapsed > args.max_ms:
+        print(f"\nOver budget: {elapsed:.0f} ms > {args.max_ms:.0f} ms")
+        sys.exit(1)
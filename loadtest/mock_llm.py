@@ -0,0 +1,253 @@
+"""A local stand-in for OpenRouter's OpenAI-compatible chat completions API.
+
+Point the app at it with LLM_BASE_URL and it never spends money or hits a rate limit:
+
+    python -m loadtest.mock_llm --port 8089 --latency-ms 400 --tokens-per-second 60
+    LLM_BASE_URL=http://127.0.0.1:8089/v1 gunicorn api:app ...
+
+Supports POST /v1/chat/completions (plain and `stream: true`, including
+`stream_options.include_usage`), GET /v1/models and GET /stats. Answers are
+derived from a hash of the request, so the same prompt always gets the same text.
+Latency, token rate and injected failures (429, 500, hung requests) are drawn from
+a seeded generator, so a run can be repeated exactly. Every option can also be set
+through a MOCK_LLM_* environment variable.
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORDS = (
+    "the document describes a quarterly review of revenue growth customer retention and "
+    "operating costs key findings include stronger demand in enterprise accounts a delayed "
+    "product launch and rising infrastructure spend the summary recommends prioritising "
+    "automation renegotiating vendor contracts and tracking churn monthly"
+).split()
+
+
+def _env(name, default):
+    return type(default)(os.environ.get(f"MOCK_LLM_{name}", default))
+
+
+class MockConfig:
+    def __init__(self, latency_ms=300.0, jitter_ms=100.0, tokens_per_second=50.0, completion_tokens=120,
+                 error_429_rate=0.0, error_500_rate=0.0, timeout_rate=0.0, hang_seconds=150.0, seed=0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.tokens_per_second = tokens_per_second
+        self.completion_tokens = completion_tokens
+        self.error_429_rate = error_429_rate
+        self.error_500_rate = error_500_rate
+        self.timeout_rate = timeout_rate
+        self.hang_seconds = hang_seconds
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def draw(self):
+        """(outcome, time to first token in seconds) for the next request."""
+        with self._lock:
+            roll = self._rng.random()
+            delay = max(0.0, self._rng.gauss(self.latency_ms, self.jitter_ms)) / 1000
+        if roll < self.error_429_rate:
+            return "429", delay
+        roll -= self.error_429_rate
+        if roll < self.error_500_rate:
+            return "500", delay
+        roll -= self.error_500_rate
+        if roll < self.timeout_rate:
+            return "timeout", delay
+        return "ok", delay
+
+
+class Stats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {"requests": 0, "streams": 0, "ok": 0, "429": 0, "500": 0, "timeout": 0,
+                       "prompt_tokens": 0, "completion_tokens": 0}
+        self.in_flight = 0
+
+    def add(self, **amounts):
+        with self._lock:
+            for key, amount in amounts.items():
+                if key == "in_flight":
+                    self.in_flight += amount
+                else:
+                    self.counts[key] += amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counts, in_flight=self.in_flight)
+
+
+def count_tokens(messages):
+    # ~4 characters per token, like OpenAI's rule of thumb
+    return sum(len(str(m.get("content") or "")) for m in messages) // 4 + 4 * len(messages)
+
+
+def completion_words(body, max_tokens):
+    """Deterministic answer for a request: same model + messages -> same words."""
+    key = json.dumps([body.get("model"), body.get("messages")], sort_keys=True).encode()
+    rng = random.Random(hashlib.sha256(key).hexdigest())
+    return [rng.choice(WORDS) for _ in range(max_tokens)]
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config = MockConfig()
+    stats = Stats()
+    quiet = True
+
+    def log_message(self, format, *args):
+        if not self.quiet:
+            super().log_message(format, *args)
+
+    def _send_json(self, status, payload, headers=None):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _write_chunk(self, text):
+        data = text.encode()
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self._send_json(200, {"object": "list", "data": [{"id": "mock", "object": "model", "owned_by": "mock"}]})
+        elif self.path.rstrip("/") == "/stats":
+            self._send_json(200, self.stats.snapshot())
+        else:
+            self._send_json(404, {"error": {"message": "Not found"}})
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": "Not found"}})
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self._send_json(400, {"error": {"message": "Invalid JSON body", "type": "invalid_request_error"}})
+            return
+
+        stream = bool(body.get("stream"))
+        self.stats.add(requests=1, streams=int(stream), in_flight=1)
+        try:
+            outcome, delay = self.config.draw()
+            self.stats.add(**{outcome: 1})
+            time.sleep(delay)
+            if outcome == "429":
+                self._send_json(429, {"error": {"message": "Rate limit exceeded (mock)", "type": "rate_limit_error"}},
+                                {"Retry-After": "1"})
+            elif outcome == "500":
+                self._send_json(500, {"error": {"message": "Upstream error (mock)", "type": "server_error"}})
+            elif outcome == "timeout":
+                # Hold the connection open without answering, then drop it
+                time.sleep(self.config.hang_seconds)
+                self.close_connection = True
+            else:
+                self._complete(body, stream)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+        finally:
+            self.stats.add(in_flight=-1)
+
+    def _complete(self, body, stream):
+        max_tokens = int(body.get("max_tokens") or self.config.completion_tokens)
+        words = completion_words(body, min(max_tokens, self.config.completion_tokens))
+        model = body.get("model") or "mock"
+        prompt_tokens = count_tokens(body.get("messages") or [])
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(words),
+                 "total_tokens": prompt_tokens + len(words)}
+        self.stats.add(prompt_tokens=prompt_tokens, completion_tokens=len(words))
+        completion_id = f"chatcmpl-mock-{uuid.uuid4().hex[:12]}"
+        created = int(time.time())
+        token_delay = 1 / self.config.tokens_per_second if self.config.tokens_per_second > 0 else 0
+
+        if not stream:
+            time.sleep(token_delay * len(words))
+            self._send_json(200, {
+                "id": completion_id, "object": "chat.completion", "created": created, "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": " ".join(words)},
+                             "finish_reason": "stop"}],
+                "usage": usage,
+            })
+            return
+
+        def event(choices, **extra):
+            payload = {"id": completion_id, "object": "chat.completion.chunk", "created": created,
+                       "model": model, "choices": choices, **extra}
+            self._write_chunk(f"data: {json.dumps(payload)}\n\n")
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        event([{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}])
+        for i, word in enumerate(words):
+            if i:
+                time.sleep(token_delay)
+            event([{"index": 0, "delta": {"content": word if i == 0 else " " + word}, "finish_reason": None}])
+        event([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+        if (body.get("stream_options") or {}).get("include_usage"):
+            event([], usage=usage)
+        self._write_chunk("data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+
+def serve(host="127.0.0.1", port=8089, config=None, quiet=True):
+    """Start the server in a background thread and return it (call .shutdown() to stop)."""
+    handler = type("ConfiguredHandler", (Handler,), {"config": config or MockConfig(), "stats": Stats(), "quiet": quiet})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="mock-llm", daemon=True).start()
+    return server
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default=_env("HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=_env("PORT", 8089))
+    parser.add_argument("--latency-ms", type=float, default=_env("LATENCY_MS", 300.0), help="mean time to first token")
+    parser.add_argument("--jitter-ms", type=float, default=_env("JITTER_MS", 100.0), help="std deviation of the latency")
+    parser.add_argument("--tokens-per-second", type=float, default=_env("TOKENS_PER_SECOND", 50.0))
+    parser.add_argument("--completion-tokens", type=int, default=_env("COMPLETION_TOKENS", 120))
+    parser.add_argument("--error-429-rate", type=float, default=_env("ERROR_429_RATE", 0.0))
+    parser.add_argument("--error-500-rate", type=float, default=_env("ERROR_500_RATE", 0.0))
+    parser.add_argument("--timeout-rate", type=float, default=_env("TIMEOUT_RATE", 0.0),
+                        help="share of requests that hang for --hang-seconds and then drop")
+    parser.add_argument("--hang-seconds", type=float, default=_env("HANG_SECONDS", 150.0))
+    parser.add_argument("--seed", type=int, default=_env("SEED", 0))
+    parser.add_argument("--verbose", action="store_true", help="log every request")
+    return parser
+
+
+def config_from_args(args):
+    return MockConfig(
+        latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, tokens_per_second=args.tokens_per_second,
+        completion_tokens=args.completion_tokens, error_429_rate=args.error_429_rate,
+        error_500_rate=args.error_500_rate, timeout_rate=args.timeout_rate,
+        hang_seconds=args.hang_seconds, seed=args.seed,
+    )
+
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+    server = serve(args.host, args.port, config_from_args(args), quiet=not args.verbose)
+    print(f"Mock LLM listening on http://{args.host}:{args.port}/v1")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
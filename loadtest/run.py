@@ -0,0 +1,396 @@
+"""HTTP load test for the API with a concurrency sweep.
+
+Starts a throwaway Postgres cluster (or uses --database-url), the mock LLM
+server and `gunicorn api:app` with QDRANT_MODE=memory. It then drives mixed
+login / history / analyze / chat / share traffic at each concurrency level.
+For every worker x thread configuration it records throughput, p50/p95/p99
+latency, error rates and SSE time-to-first-token, and writes them to one JSON
+file so configurations can be compared side by side.
+
+    python -m loadtest.run --configs 1x4,2x4,4x2 --concurrency 1,8,32 --duration 30
+    python -m loadtest.run --database-url postgresql://localhost/omnidoc_load --configs 2x4
+
+The generator is closed-loop: each virtual user sends its next request as soon as
+the previous one finishes (plus --think-ms). Requests are picked from a weighted
+mix drawn from a seeded generator, so runs are repeatable.
+
+With more than one worker, each worker has its own in-memory Qdrant store. Chat
+on a document embedded by another worker falls back to the raw document text,
+as it does in production when Qdrant is unavailable.
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+from benchmarks import synthetic
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+DEFAULT_MIX = "login=10,history=30,analyze=10,chat=30,share=20"
+QUESTIONS = [
+    "What are the key findings?",
+    "Which risks does the document mention?",
+    "Summarize the revenue section.",
+    "What should we do next?",
+]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for(url, timeout, process=None):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"{process.args[0]} exited with code {process.returncode}")
+        try:
+            if requests.get(url, timeout=1).status_code < 500:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+# Services
+
+class Postgres:
+    """A temporary local cluster built with initdb/pg_ctl, removed on stop()."""
+
+    def __init__(self):
+        for tool in ("initdb", "pg_ctl"):
+            if not shutil.which(tool):
+                raise RuntimeError(f"'{tool}' not found on PATH; install PostgreSQL or pass --database-url")
+        self.dir = tempfile.mkdtemp(prefix="omnidoc-pg-")
+        self.port = free_port()
+        data = os.path.join(self.dir, "data")
+        subprocess.run(["initdb", "-D", data, "-A", "trust", "-U", "postgres", "--no-sync"],
+                       check=True, capture_output=True)
+        subprocess.run(["pg_ctl", "-D", data, "-l", os.path.join(self.dir, "log"), "-w", "start",
+                        "-o", f"-p {self.port} -k {self.dir} -c listen_addresses=127.0.0.1 -c fsync=off -c max_connections=200"],
+                       check=True, capture_output=True)
+        self.data = data
+        self.url = f"postgresql://postgres@127.0.0.1:{self.port}/postgres"
+
+    def stop(self):
+        subprocess.run(["pg_ctl", "-D", self.data, "-m", "fast", "stop"], capture_output=True)
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def start_mock_llm(args):
+    port = free_port()
+    process = subprocess.Popen([
+        sys.executable, "-m", "loadtest.mock_llm", "--port", str(port),
+        "--latency-ms", str(args.llm_latency_ms), "--tokens-per-second", str(args.llm_tokens_per_second),
+        "--completion-tokens", str(args.llm_completion_tokens),
+        "--error-429-rate", str(args.llm_error_429_rate), "--error-500-rate", str(args.llm_error_500_rate),
+        "--seed", str(args.seed),
+    ], cwd=ROOT)
+    wait_for(f"http://127.0.0.1:{port}/stats", 15, process)
+    return process, f"http://127.0.0.1:{port}/v1"
+
+
+def app_env(database_url, llm_url, work_dir):
+    """Environment for the app under test; every on-disk cache lives in `work_dir`."""
+    os.makedirs(work_dir, exist_ok=True)
+    return dict(
+        os.environ,
+        DATABASE_URL=database_url,
+        LLM_BASE_URL=llm_url,
+        OPENROUTER_API_KEY="",
+        QDRANT_MODE="memory",
+        # Never read from or write into the checkout's own caches and vector store
+        QDRANT_PATH=os.path.join(work_dir, "qdrant_db"),
+        EMBEDDING_CACHE_PATH=os.path.join(work_dir, "embedding_cache.sqlite3"),
+        WEB_CACHE_PATH=os.path.join(work_dir, "web_cache.sqlite3"),
+        SHARE_CACHE_DIR=os.path.join(work_dir, "shares"),
+        UPLOAD_SPOOL_DIR=work_dir,
+        # Quota would otherwise stop every user after a handful of analyses
+        FREE_TIER_LIMIT="1000000000",
+        RUN_SCHEMA_CHECK="0",
+        PRELOAD_MODELS=os.environ.get("PRELOAD_MODELS", "0"),
+    )
+
+
+def prepare_schema(env):
+    subprocess.run([sys.executable, "-c", "import api"], cwd=ROOT, check=True,
+                   env=dict(env, RUN_SCHEMA_CHECK="1"))
+
+
+def start_app(workers, threads, env):
+    port = free_port()
+    process = subprocess.Popen([
+        "gunicorn", "api:app", "--bind", f"127.0.0.1:{port}",
+        "--workers", str(workers), "--threads", str(threads), "--timeout", "180",
+    ], cwd=ROOT, env=env)
+    base = f"http://127.0.0.1:{port}"
+    wait_for(f"{base}/api/health", 60, process)
+    return process, base
+
+
+def stop(process):
+    process.terminate()
+    try:
+        process.wait(timeout=15)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+# Traffic
+
+class Account:
+    def __init__(self, username, password):
+        self.username = username
+        self.password = password
+        self.user_id = None
+        self.history_ids = []
+        self.shared_ids = []
+
+
+def document_text(rng):
+    return synthetic.markdown_document(rng.randint(300, 1200), seed=rng.randrange(1 << 30))
+
+
+def seed_accounts(base, prefix, count, docs_per_user, seed):
+    rng = random.Random(seed)
+    session = requests.Session()
+    accounts = []
+    for i in range(count):
+        account = Account(f"{prefix}-user-{i}", "load-test-password")
+        r = session.post(f"{base}/api/auth/register", json={"username": account.username, "password": account.password}, timeout=30)
+        r.raise_for_status()
+        account.user_id = r.json()["user"]["id"]
+        for _ in range(docs_per_user):
+            r = session.post(f"{base}/api/analyze", data={"user_id": account.user_id, "text": document_text(rng),
+                                                          "output_type": "Summary"}, timeout=180)
+            r.raise_for_status()
+            history_id = r.json()["data"]["id"]
+            account.history_ids.append(history_id)
+            account.shared_ids.append(session.post(f"{base}/api/share/{history_id}", timeout=30).json()["shared_id"])
+        accounts.append(account)
+    return accounts
+
+
+def op_login(session, base, account, rng):
+    return session.post(f"{base}/api/auth/login", json={"username": account.username, "password": account.password}, timeout=60), None
+
+
+def op_history(session, base, account, rng):
+    return session.get(f"{base}/api/history/{account.user_id}", timeout=60), None
+
+
+def op_analyze(session, base, account, rng):
+    return session.post(f"{base}/api/analyze", data={"user_id": account.user_id, "text": document_text(rng),
+                                                     "output_type": "Summary"}, timeout=300), None
+
+
+def op_share(session, base, account, rng):
+    return session.get(f"{base}/api/shared/{rng.choice(account.shared_ids)}", timeout=60), None
+
+
+def op_chat(session, base, account, rng):
+    started = time.perf_counter()
+    ttft = None
+    response = session.post(f"{base}/api/chat", json={"history_id": rng.choice(account.history_ids),
+                                                      "question": rng.choice(QUESTIONS)}, stream=True, timeout=300)
+    with response:
+        for line in response.iter_lines(decode_unicode=True):
+            if not line or not line.startswith("data:"):
+                continue  # keepalive comments and blank separators
+            if line == "data: [DONE]":
+                break
+            if ttft is None and json.loads(line[5:]).get("content"):
+                ttft = time.perf_counter() - started
+    return response, ttft
+
+
+OPS = {"login": op_login, "history": op_history, "analyze": op_analyze, "chat": op_chat, "share": op_share}
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in OPS:
+            raise ValueError(f"unknown operation '{name}' (expected one of {', '.join(OPS)})")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def run_level(base, accounts, concurrency, duration, mix, think_ms, seed):
+    """Closed-loop traffic from `concurrency` virtual users for `duration` seconds."""
+    samples = {name: [] for name in mix}
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+    names, weights = list(mix), list(mix.values())
+
+    def virtual_user(index):
+        rng = random.Random(seed * 100003 + index)
+        session = requests.Session()
+        while time.monotonic() < deadline:
+            name = rng.choices(names, weights)[0]
+            account = rng.choice(accounts)
+            started = time.perf_counter()
+            status, ttft = None, None
+            try:
+                response, ttft = OPS[name](session, base, account, rng)
+                status = response.status_code
+            except requests.RequestException as e:
+                status = type(e).__name__
+            elapsed = time.perf_counter() - started
+            with lock:
+                samples[name].append((elapsed, status, ttft))
+            if think_ms:
+                time.sleep(think_ms / 1000)
+
+    threads = [threading.Thread(target=virtual_user, args=(i,), daemon=True) for i in range(concurrency)]
+    started = time.monotonic()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return samples, time.monotonic() - started
+
+
+def percentiles(values, prefix=""):
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def pick(q):
+        return round(values[min(len(values) - 1, int(q * len(values)))] * 1000, 2)
+    return {f"{prefix}p50_ms": pick(0.50), f"{prefix}p95_ms": pick(0.95), f"{prefix}p99_ms": pick(0.99)}
+
+
+def summarize_level(concurrency, samples, wall):
+    ops = {}
+    total = errors = 0
+    for name, rows in samples.items():
+        failed = [status for _, status, _ in rows if not (isinstance(status, int) and status < 400)]
+        by_status = {}
+        for status in failed:
+            by_status[str(status)] = by_status.get(str(status), 0) + 1
+        ops[name] = {
+            "requests": len(rows),
+            "rps": round(len(rows) / wall, 2),
+            "error_rate": round(len(failed) / len(rows), 4) if rows else 0.0,
+            "errors": by_status,
+            **percentiles([elapsed for elapsed, _, _ in rows]),
+            **percentiles([ttft for _, _, ttft in rows if ttft is not None], "ttft_"),
+        }
+        total += len(rows)
+        errors += len(failed)
+    return {
+        "concurrency": concurrency,
+        "duration_s": round(wall, 2),
+        "requests": total,
+        "rps": round(total / wall, 2),
+        "error_rate": round(errors / total, 4) if total else 0.0,
+        **percentiles([elapsed for rows in samples.values() for elapsed, _, _ in rows]),
+        "ops": ops,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return "unknown"
+
+
+def main(args):
+    mix = parse_mix(args.mix)
+    configs = [tuple(int(n) for n in c.lower().split("x")) for c in args.configs.split(",")]
+    levels = [int(c) for c in args.concurrency.split(",")]
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+            "cpu_count": os.cpu_count(),
+            "duration_s": args.duration,
+            "think_ms": args.think_ms,
+            "mix": mix,
+            "users": args.users,
+            "docs_per_user": args.docs_per_user,
+            "seed": args.seed,
+            "llm": {"latency_ms": args.llm_latency_ms, "tokens_per_second": args.llm_tokens_per_second,
+                    "completion_tokens": args.llm_completion_tokens,
+                    "error_429_rate": args.llm_error_429_rate, "error_500_rate": args.llm_error_500_rate},
+        },
+        "configs": [],
+    }
+
+    postgres = None if args.database_url else Postgres()
+    mock_llm, llm_url = start_mock_llm(args)
+    work_dir = tempfile.mkdtemp(prefix="omnidoc-load-")
+    try:
+        database_url = args.database_url or postgres.url
+        prepare_schema(app_env(database_url, llm_url, os.path.join(work_dir, "schema")))
+        for workers, threads in configs:
+            label = f"{workers}x{threads}"
+            print(f"== {label}: {workers} worker(s) x {threads} thread(s)")
+            # Fresh caches per configuration, so a later one doesn't start warm
+            env = app_env(database_url, llm_url, os.path.join(work_dir, label))
+            app, base = start_app(workers, threads, env)
+            try:
+                prefix = f"load-{int(time.time())}-{label}"
+                accounts = seed_accounts(base, prefix, args.users, args.docs_per_user, args.seed)
+                result = {"workers": workers, "threads": threads, "levels": []}
+                for concurrency in levels:
+                    samples, wall = run_level(base, accounts, concurrency, args.duration, mix, args.think_ms, args.seed)
+                    level = summarize_level(concurrency, samples, wall)
+                    result["levels"].append(level)
+                    chat_ttft = level["ops"].get("chat", {}).get("ttft_p50_ms", "-")
+                    print(f"   c={concurrency:<4} {level['rps']:>8.1f} req/s  p50 {level.get('p50_ms', 0):>8.1f} ms  "
+                          f"p99 {level.get('p99_ms', 0):>8.1f} ms  errors {level['error_rate']:.1%}  chat TTFT p50 {chat_ttft} ms")
+                report["configs"].append(result)
+            finally:
+                stop(app)
+    finally:
+        stop(mock_llm)
+        if postgres:
+            postgres.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--configs", default="1x4", help="comma-separated WORKERSxTHREADS gunicorn configurations")
+    parser.add_argument("--concurrency", default="1,4,16,32", help="comma-separated virtual user counts")
+    parser.add_argument("--duration", type=float, default=30, help="seconds per concurrency level")
+    parser.add_argument("--think-ms", type=float, default=0)
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"operation weights (default {DEFAULT_MIX})")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--docs-per-user", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--database-url", help="use this database instead of a temporary local cluster")
+    parser.add_argument("--llm-latency-ms", type=float, default=300)
+    parser.add_argument("--llm-tokens-per-second", type=float, default=50)
+    parser.add_argument("--llm-completion-tokens", type=int, default=120)
+    parser.add_argument("--llm-error-429-rate", type=float, default=0.0)
+    parser.add_argument("--llm-error-500-rate", type=float, default=0.0)
+    parser.add_argument("--out", help="JSON path (default: loadtest/results/<commit>-<timestamp>.json)")
+    args = parser.parse_args()
+
+    report = main(args)
+    out = args.out or os.path.join(RESULTS_DIR, f"{report['meta']['commit']}-{int(time.time())}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.write("\n")
+    print(f"Saved {out}")
@@ -0,0 +1,122 @@
+"""Rebuild the omnidoc_chunks collection with the current vector layout settings.
+
+Reads QDRANT_* settings (quantization, on-disk vectors, HNSW m/ef_construct) from the
+environment, copies every point into a freshly created collection, then points the
+`omnidoc_chunks` alias at it and drops the old collection. Searches keep working
+against the old data until the alias switch.
+
+    QDRANT_QUANTIZATION=scalar QDRANT_ON_DISK=1 python migrate_qdrant.py
+
+With --backfill-tenants it instead tags points written before multi-tenancy with
+their owner's tenant_id (needs DATABASE_URL). Until then those points are not
+returned by tenant-scoped searches and chat falls back to the raw document text.
+"""
+import argparse
+import os
+import time
+
+from dotenv import load_dotenv
+load_dotenv()
+
+from qdrant_client.models import (
+    PointStruct, CreateAlias, CreateAliasOperation, DeleteAlias, DeleteAliasOperation
+)
+
+from utils import vector_store
+
+
+def resolve_alias(client, name):
+    """Return the real collection behind `name` and whether `name` is an alias."""
+    for alias in client.get_aliases().aliases:
+        if alias.alias_name == name:
+            return alias.collection_name, True
+    return name, False
+
+
+def copy_points(client, source, target, batch_size):
+    copied = 0
+    offset = None
+    while True:
+        points, offset = client.scroll(
+            collection_name=source,
+            limit=batch_size,
+            offset=offset,
+            with_payload=True,
+            with_vectors=True
+        )
+        if points:
+            client.upsert(
+                collection_name=target,
+                points=[PointStruct(id=p.id, vector=p.vector, payload=p.payload) for p in points],
+                wait=True
+            )
+            copied += len(points)
+            print(f"  copied {copied} points")
+        if offset is None:
+            return copied
+
+
+def migrate(batch_size=512, keep_old=False):
+    client = vector_store.create_client()
+    name = vector_store.COLLECTION_NAME
+    source, is_alias = resolve_alias(client, name)
+    try:
+        client.get_collection(source)
+    except Exception:
+        print(f"No existing '{name}' collection; creating it with the current settings.")
+        vector_store.ensure_collection(client, name)
+        return
+
+    target = f"{name}_{int(time.time())}"
+    print(f"Creating '{target}' (quantization={vector_store.QDRANT_QUANTIZATION}, "
+          f"on_disk={vector_store.QDRANT_ON_DISK}, m={vector_store.QDRANT_HNSW_M}, "
+          f"ef_construct={vector_store.QDRANT_HNSW_EF_CONSTRUCT})")
+    client.create_collection(collection_name=target, **vector_store.collection_config())
+    vector_store.ensure_payload_indexes(client, target)
+
+    copied = copy_points(client, source, target, batch_size)
+    print(f"Copied {copied} points from '{source}' to '{target}'.")
+
+    if is_alias:
+        client.update_collection_aliases(change_aliases_operations=[
+            DeleteAliasOperation(delete_alias=DeleteAlias(alias_name=name)),
+            CreateAliasOperation(create_alias=CreateAlias(collection_name=target, alias_name=name)),
+        ])
+        if not keep_old:
+            client.delete_collection(source)
+    else:
+        # A collection and an alias can't share a name, so the original has to go first
+        client.delete_collection(source)
+        client.update_collection_aliases(change_aliases_operations=[
+            CreateAliasOperation(create_alias=CreateAlias(collection_name=target, alias_name=name)),
+        ])
+    print(f"'{name}' now points to '{target}'.")
+
+
+def backfill_tenants():
+    import psycopg2
+    client = vector_store.create_client()
+    conn = psycopg2.connect(os.environ["DATABASE_URL"])
+
+    def find_owners(history_ids):
+        with conn.cursor() as c:
+            c.execute("SELECT id, user_id FROM user_history WHERE id = ANY(%s) AND user_id IS NOT NULL", (list(history_ids),))
+            return dict(c.fetchall())
+
+    try:
+        updated = vector_store.backfill_tenants(client, find_owners)
+    finally:
+        conn.close()
+    print(f"Tagged chunks of {updated} documents with their tenant_id.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--batch-size", type=int, default=512)
+    parser.add_argument("--keep-old", action="store_true", help="keep the previous collection when it was behind an alias")
+    parser.add_argument("--backfill-tenants", action="store_true", help="set tenant_id on points that lack it")
+    args = parser.parse_args()
+    if args.backfill_tenants:
+        backfill_tenants()
+    else:
+        migrate(batch_size=args.batch_size, keep_old=args.keep_old)
@@ -0,0 +1,933 @@
+import os
+import sys
+
+import pytest
+
+from import_report import measure_import
+
+# About 200 ms locally; the headroom is for slow CI machines. Override with API_IMPORT_BUDGET_MS
+API_IMPORT_BUDGET_MS = float(os.environ.get("API_IMPORT_BUDGET_MS", "1000"))
+LAZY_PACKAGES = {
+    "psycopg2", "qdrant_client", "openai", "httpx", "stripe", "requests", "bs4", "numpy",
+    "torch", "sentence_transformers", "onnxruntime", "pdfplumber", "docx", "PIL", "pytesseract",
+}
+
+
+@pytest.fixture(scope="module")
+def cold_import():
+    pytest.importorskip("flask")
+    pytest.importorskip("flask_cors")
+    return measure_import("api")
+
+
+def test_api_import_defers_heavy_packages(cold_import):
+    _, loaded = cold_import
+    assert not LAZY_PACKAGES & set(loaded)
+
+
+def test_api_cold_import_within_budget(cold_import):
+    elapsed_ms, _ = cold_import
+    assert elapsed_ms <= API_IMPORT_BUDGET_MS, f"import api took {elapsed_ms:.0f} ms"
+
+
+def test_chunks_carry_source_url():
+    from utils.chunker import chunk_document
+    text = "--- Source: http://docs.test/a ---\n# A\nAlpha page.\n\n--- Source: http://docs.test/b ---\n# B\nBeta page."
+    chunks = chunk_document(text)
+    assert [(c["source_url"], c["section"]) for c in chunks] == [("http://docs.test/a", "A"), ("http://docs.test/b", "B")]
+
+
+def test_oversized_units_are_split_within_target():
+    from utils.chunker import chunk_document, count_tokens
+
+    url = "http://example.test/" + "/".join(f"part{i}" for i in range(100))  # one word, ~200 tokens
+    chunks = chunk_document(f"See {url} for details.", target_tokens=32, min_tokens=0)
+    assert all(count_tokens(c["text"]) <= 32 for c in chunks)
+    assert "".join("".join(c["text"].split()) for c in chunks) == f"See{url}fordetails."
+
+    rows = "\n".join(f"| row {i} | value {i} |" for i in range(40))
+    chunks = chunk_document(f"| Name | Value |\n|---|---|\n{rows}", target_tokens=64, min_tokens=0)
+    assert len(chunks) > 1
+    assert all(c["text"].startswith("| Name | Value |\n|---|---|\n| row") for c in chunks)
+
+
+def test_table_heavy_chunks_fit_the_embedding_model():
+    from utils import chunker
+
+    rows = "\n".join(
+        f"| INV-2023-{417 + i:06d} | 2023-{i % 12 + 1:02d}-{i % 28 + 1:02d} | ACME-GmbH/{i * 7919} | {i * 1234.5:,.2f} EUR |"
+        for i in range(120)
+    )
+    text = f"# Invoices (Page 3)\n| Invoice | Date | Customer | Amount |\n|---|---|---|---|\n{rows}"
+    chunks = chunker.chunk_document(text)
+    assert len(chunks) > 1
+    assert all(chunker.count_tokens(c["text"]) <= chunker.CHUNK_TARGET_TOKENS for c in chunks)
+    # Digit groups are counted, not whole numbers, so the estimate doesn't trail WordPiece
+    assert chunker.count_tokens("INV-2023-000417") == 7
+
+    # With the real WordPiece vocabulary (exported by export_onnx.py), nothing is truncated
+    tokenizers = pytest.importorskip("tokenizers")
+    path = os.path.join(os.environ.get("ONNX_EMBEDDER_DIR", "models/all-MiniLM-L6-v2-onnx"), "tokenizer.json")
+    if not os.path.exists(path):
+        pytest.skip("no exported tokenizer.json")
+    tokenizer = tokenizers.Tokenizer.from_file(path)
+    tokenizer.no_truncation()
+    tokenizer.no_padding()
+    assert max(len(tokenizer.encode(c["text"]).ids) for c in chunks) <= chunker.MODEL_MAX_TOKENS
+
+
+@pytest.fixture
+def static_site(tmp_path):
+    import functools
+    import threading
+    from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+    pages = {
+        "docs/index.html": '<a href="guide.html">Guide</a> <a href="api.html#x">API</a> <a href="/blog/">Blog</a><p>Home</p>',
+        "docs/guide.html": '<title>Guide</title><a href="index.html">Home</a><a href="copy.html">Copy</a><p>Install it.</p>',
+        "docs/api.html": '<link rel="canonical" href="api.html"><title>API</title><p>Call it.</p>',
+        "docs/copy.html": '<title>Guide</title><a href="index.html">Home</a><a href="copy.html">Copy</a><p>Install it.</p>',
+        "blog/index.html": "<p>Out of scope</p>",
+    }
+    for name, html in pages.items():
+        (tmp_path / name).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / name).write_text(f"<html><body>{html}</body></html>")
+
+    class QuietHandler(SimpleHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+    handler = functools.partial(QuietHandler, directory=str(tmp_path))
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+
+
+def test_crawl_static_site(static_site):
+    pytest.importorskip("requests")
+    pytest.importorskip("bs4")
+    from utils import web_crawl, web_ingest
+
+    def fetch(url):
+        return web_ingest.fetch(url, use_cache=False)
+
+    result = web_crawl.crawl(f"{static_site}/docs/index.html", max_depth=2, max_pages=10, fetch=fetch, host_delay=0)
+    urls = [url.rsplit("/", 1)[1] for url, _, _ in result.pages]
+    assert urls == ["index.html", "guide.html", "api.html"]
+    assert result.skipped["duplicate"] == 1  # copy.html repeats guide.html
+    assert "--- Source: " in result.as_document()
+
+    # Text budgets: each page is cut to page_chars, and the crawl stops once max_chars are kept
+    result = web_crawl.crawl(f"{static_site}/docs/index.html", max_depth=2, max_pages=10, fetch=fetch, host_delay=0,
+                             page_chars=6, max_chars=10)
+    assert [len(text) for _, _, text in result.pages] == [6, 4] and result.chars == 10
+    assert result.skipped["over_budget"] == 1  # api.html was no longer needed
+
+
+def test_fetch_revalidates_truncates_and_reads_text_types(static_site, tmp_path, monkeypatch):
+    pytest.importorskip("requests")
+    pytest.importorskip("bs4")
+    from utils import web_ingest
+
+    (tmp_path / "data.json").write_text('{"answer": 42}')
+    (tmp_path / "big.txt").write_text("x" * 5000)
+    (tmp_path / "logo.png").write_bytes(b"\x89PNG\r\n\x1a\n")
+    monkeypatch.setattr(web_ingest, "_cache", web_ingest.PageCache(str(tmp_path / "cache.sqlite3")))
+    monkeypatch.setattr(web_ingest, "WEB_CACHE_TTL", 0)  # stale at once, so the next fetch revalidates
+
+    url = f"{static_site}/docs/guide.html"
+    first = web_ingest.fetch(url)
+    assert first.cache is None and first.last_modified
+    again = web_ingest.fetch(url)
+    assert again.cache == "revalidated" and again.text == first.text
+    assert web_ingest._cache.stats["revalidated"] == 1
+
+    page = web_ingest.fetch(f"{static_site}/big.txt", use_cache=False, max_bytes=1000)
+    assert page.truncated and page.text == "x" * 1000
+    assert web_ingest.fetch(f"{static_site}/data.json", use_cache=False).text == '{"answer": 42}'
+    with pytest.raises(web_ingest.FetchError):
+        web_ingest.fetch(f"{static_site}/logo.png", use_cache=False)
+
+
+def test_web_search_returns_partial_results_at_deadline():
+    import time
+    from utils import web_ingest, web_search
+
+    results = [{"title": f"R{i}", "url": f"http://search.test/{i}", "snippet": f"s{i}"} for i in range(3)]
+    web_search.register_provider("test-stub", lambda: web_search.StubProvider({"*": results}))
+
+    def fetch(url):
+        if url.endswith("/2"):
+            time.sleep(2)
+        return web_ingest.Page(url, url, None, f"body of {url}", [])
+
+    report = web_search.search_and_fetch("anything", fetch_pages=3, deadline=0.5, provider="test-stub", fetch=fetch)
+    assert sorted(report.pages) == ["http://search.test/0", "http://search.test/1"]
+    assert report.timed_out == ["http://search.test/2"]
+    assert "--- Source: http://search.test/1 ---" in report.as_document()
+
+    web_search.search_and_fetch("anything", fetch_pages=0, provider="test-stub")
+    assert web_search.stats()["hits"] >= 1
+
+
+def test_upload_is_spooled_hashed_and_capped(tmp_path, monkeypatch):
+    import hashlib
+    import io
+    import tempfile
+    flask = pytest.importorskip("flask")
+    from utils import uploads
+
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))  # where the spool files go
+
+    app = flask.Flask(__name__)
+    app.request_class = uploads.StreamingRequest
+    seen = {}
+
+    @app.route("/upload", methods=["POST"])
+    def upload():
+        spool = flask.request.files["file"].stream
+        seen.update(name=spool.name, sha256=spool.sha256, size=spool.size)
+        with open(spool.name, "rb") as f:
+            return {"bytes": len(f.read())}
+
+    @app.route("/fields", methods=["POST"])
+    def fields():
+        return {"files": list(flask.request.files)}
+
+    body = b"x" * 100_000
+    client = app.test_client()
+    response = client.post("/upload", data={"file": (io.BytesIO(body), "notes.txt")})
+    assert response.json == {"bytes": len(body)}
+    assert seen["sha256"] == hashlib.sha256(body).hexdigest() and seen["name"].endswith(".txt")
+    assert not os.path.exists(seen["name"])  # removed with the request
+
+    too_big = io.BytesIO(b"x" * (uploads.MAX_UPLOAD_BYTES + 1))
+    assert client.post("/upload", data={"file": (too_big, "big.txt")}).status_code == 413
+
+    # A body cut off before its closing boundary: the part never reaches request.files,
+    # but its spool file must still be removed when the request ends
+    truncated = (b'--XyZ\r\nContent-Disposition: form-data; name="file"; filename="cut.txt"\r\n'
+                 b"Content-Type: text/plain\r\n\r\n" + b"y" * 200_000)
+    response = client.post("/fields", data=truncated, content_type="multipart/form-data; boundary=XyZ")
+    assert response.json == {"files": []}
+    assert not list(tmp_path.iterdir())
+
+
+# Tests below need a scratch Postgres database, e.g. TEST_DATABASE_URL=postgresql://postgres@localhost/postgres.
+# Everything runs in a throwaway schema that is dropped afterwards.
+@pytest.fixture(scope="session")
+def database_url():
+    psycopg2 = pytest.importorskip("psycopg2")
+    base_url = os.environ.get("TEST_DATABASE_URL")
+    if not base_url:
+        pytest.skip("TEST_DATABASE_URL is not set")
+    schema = f"test_{os.getpid()}"
+    with psycopg2.connect(base_url) as conn, conn.cursor() as c:
+        c.execute(f"CREATE SCHEMA {schema}")
+    separator = "&" if "?" in base_url else "?"
+    yield f"{base_url}{separator}options=-csearch_path%3D{schema}"
+    conn = psycopg2.connect(base_url)
+    with conn, conn.cursor() as c:
+        c.execute(f"DROP SCHEMA {schema} CASCADE")
+    conn.close()
+
+
+@pytest.fixture(scope="session")
+def api_module(tmp_path_factory):
+    """`api` imported with throwaway caches, an in-memory Qdrant and no background threads."""
+    pytest.importorskip("flask")
+    pytest.importorskip("flask_cors")
+    cache_dir = tmp_path_factory.mktemp("caches")
+    os.environ.update(
+        QDRANT_MODE="memory", ADMIN_ANALYTICS="0",
+        SHARE_CACHE_DIR=str(cache_dir / "shares"), WEB_CACHE_PATH="", EMBEDDING_CACHE_PATH="",
+    )
+    import api
+    api.background_jobs_started = True
+    return api
+
+
+@pytest.fixture(scope="session")
+def api_app(api_module, database_url):
+    pytest.importorskip("qdrant_client")
+    os.environ["DATABASE_URL"] = database_url
+    api_module.check_db()
+    return api_module
+
+
+@pytest.fixture
+def make_user(api_app):
+    def make_user(role="user", is_premium=0, analysis_count=0):
+        with api_app.db_connection() as conn:
+            c = conn.cursor()
+            c.execute(
+                "INSERT INTO users (username, password_hash, role, analysis_count, is_premium) VALUES (%s, 'x', %s, %s, %s) RETURNING id",
+                (f"user-{os.urandom(4).hex()}", role, analysis_count, is_premium)
+            )
+            user_id = c.fetchone()[0]
+            conn.commit()
+        return user_id
+    return make_user
+
+
+@pytest.fixture
+def make_history(api_app):
+    def make_history(user_id, content="Some text", content_type="text", file_name="notes.txt"):
+        with api_app.db_connection() as conn:
+            c = conn.cursor()
+            c.execute(
+                "INSERT INTO user_history (user_id, content_type, content, file_name) VALUES (%s, %s, %s, %s) RETURNING id",
+                (user_id, content_type, content, file_name)
+            )
+            history_id = c.fetchone()[0]
+            conn.commit()
+        return history_id
+    return make_history
+
+
+def test_reserve_slot_stops_at_free_tier_limit(api_app, make_user, monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+    import psycopg2
+    from utils import quota
+
+    monkeypatch.setattr(quota, "FREE_TIER_LIMIT", 3)
+    user_id = make_user()
+
+    def reserve(_):
+        conn = psycopg2.connect(os.environ["DATABASE_URL"])
+        try:
+            return quota.reserve_slot(conn, user_id)[2]
+        finally:
+            conn.close()
+
+    with ThreadPoolExecutor(max_workers=10) as pool:
+        allowed = list(pool.map(reserve, range(10)))
+    assert allowed.count(True) == 3
+    with api_app.db_connection() as conn:
+        assert quota.check_quota(conn, user_id)[1:] == (3, False)
+
+
+def test_failed_analysis_gives_its_slot_back(api_app, make_user):
+    from utils import quota
+
+    user_id = make_user(analysis_count=1)
+    response = api_app.app.test_client().post("/api/analyze", data={"user_id": str(user_id), "text": ""})
+    assert response.status_code == 400  # no content
+    with api_app.db_connection() as conn:
+        assert quota.check_quota(conn, user_id)[1] == 1
+
+
+def test_delete_subtracts_from_rollups_in_the_same_transaction(api_app, make_user, make_history, monkeypatch):
+    from utils import admin_analytics
+
+    monkeypatch.setattr(admin_analytics, "ANALYTICS_SETTLE_SECONDS", 0)
+    user_id = make_user()
+    kept, deleted = make_history(user_id, "keep me"), make_history(user_id, "delete me")
+    with api_app.db_connection() as conn:
+        admin_analytics.refresh_rollups(conn)
+
+    assert api_app.app.test_client().delete(f"/api/history/{deleted}").json["success"]
+    with api_app.db_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT document_count, total_bytes FROM admin_user_stats WHERE user_id = %s", (user_id,))
+        assert c.fetchone() == (1, len("keep me"))
+        c.execute("SELECT id FROM user_history WHERE user_id = %s", (user_id,))
+        assert c.fetchall() == [(kept,)]
+        c.execute("SELECT COUNT(*) FROM pg_locks WHERE locktype = 'advisory'")
+        assert c.fetchone()[0] == 0  # transaction-scoped, released on commit
+        conn.rollback()
+
+
+def test_daily_upload_rollups_use_utc_days(api_app, make_user, monkeypatch):
+    import datetime
+    import psycopg2
+    from utils import admin_analytics
+
+    monkeypatch.setattr(admin_analytics, "ANALYTICS_SETTLE_SECONDS", 0)
+    user_id = make_user()
+    conn = psycopg2.connect(os.environ["DATABASE_URL"])
+    try:
+        c = conn.cursor()
+        c.execute("SET TIME ZONE 'Pacific/Kiritimati'")  # UTC+14: local mornings are the previous UTC day
+        c.execute(
+            """INSERT INTO user_history (user_id, content_type, content, file_name, created_at)
+               VALUES (%s, 'text', 'late', 'a.txt', '2001-03-02 09:00') RETURNING id, created_at""",
+            (user_id,)
+        )
+        history_id, created_at = c.fetchone()
+        conn.commit()
+        admin_analytics.refresh_rollups(conn)
+        c.execute("SELECT day, uploads FROM admin_daily_uploads WHERE day BETWEEN '2001-03-01' AND '2001-03-02'")
+        assert c.fetchall() == [(datetime.date(2001, 3, 1), 1)]
+
+        admin_analytics.lock_rollups(conn)
+        c.execute("DELETE FROM user_history WHERE id = %s", (history_id,))
+        admin_analytics.record_history_deleted(conn, (history_id, user_id, "text", created_at, 4))
+        conn.commit()
+        c.execute("SELECT uploads FROM admin_daily_uploads WHERE day = '2001-03-01'")
+        assert c.fetchone() == (0,)
+    finally:
+        conn.close()
+
+
+def test_share_cache_disk_entries_expire_and_are_pruned(tmp_path, monkeypatch):
+    import time
+    from utils import share_cache
+
+    monkeypatch.setattr(share_cache, "SHARE_CACHE_DIR", str(tmp_path))
+    etag = share_cache.put("abc", b'{"x": 1}')
+    share_cache.invalidate("def")  # unrelated id
+    with share_cache._lock:
+        share_cache._entries.clear()  # as seen by another worker
+    assert share_cache.get("abc") == (etag, b'{"x": 1}')
+    assert not list(tmp_path.glob("*.tmp"))
+
+    # A put that raced an invalidate is only served until its disk TTL runs out
+    monkeypatch.setattr(share_cache, "SHARE_CACHE_DISK_TTL", -1)
+    share_cache.put("stale", b"{}")
+    with share_cache._lock:
+        share_cache._entries.clear()
+    assert share_cache.get("stale") is None
+    assert not os.path.exists(share_cache._disk_path("stale"))
+
+    monkeypatch.setattr(share_cache, "SHARE_CACHE_DISK_TTL", 600)
+    share_cache.invalidate("abc")
+    for i in range(5):
+        share_cache.put(f"id-{i}", b"{}")
+        os.utime(share_cache._disk_path(f"id-{i}"), (time.time() - 100 + i,) * 2)
+    assert share_cache.prune(max_entries=3) == 2  # the oldest two
+    assert sorted(p.name for p in tmp_path.iterdir()) == sorted(
+        os.path.basename(share_cache._disk_path(f"id-{i}")) for i in (2, 3, 4)
+    )
+
+
+def test_shared_document_etag_304_and_invalidation(api_app, make_user, make_history):
+    client = api_app.app.test_client()
+    history_id = make_history(make_user(), file_name="before.txt")
+    shared_id = client.post(f"/api/share/{history_id}").json["shared_id"]
+
+    first = client.get(f"/api/shared/{shared_id}")
+    assert first.status_code == 200 and first.json["data"]["file_name"] == "before.txt"
+    etag = first.headers["ETag"]
+    assert client.get(f"/api/shared/{shared_id}").headers["ETag"] == etag  # served from the cache
+    assert client.get(f"/api/shared/{shared_id}", headers={"If-None-Match": etag}).status_code == 304
+
+    client.patch(f"/api/history/{history_id}/rename", json={"name": "after.txt"})
+    renamed = client.get(f"/api/shared/{shared_id}", headers={"If-None-Match": etag})
+    assert renamed.status_code == 200 and renamed.json["data"]["file_name"] == "after.txt"
+    assert renamed.headers["ETag"] != etag
+
+    client.delete(f"/api/history/{history_id}")
+    assert client.get(f"/api/shared/{shared_id}").status_code == 404
+
+
+def test_reindex_only_embeds_changed_chunks(api_app, make_user, make_history, monkeypatch):
+    import numpy as np
+    from utils import chunker, vector_store
+
+    monkeypatch.setattr(chunker, "CHUNK_TARGET_TOKENS", 8)
+    monkeypatch.setattr(chunker, "CHUNK_MIN_TOKENS", 0)
+    embedded = []
+
+    def embed_chunks(texts):
+        embedded.extend(texts)
+        return [np.full(vector_store.VECTOR_SIZE, (len(embedded) % 7 + 1) / 7, dtype=np.float32) for _ in texts], None
+
+    monkeypatch.setattr(api_app, "embed_chunks", embed_chunks)
+    owner = make_user()
+    history_id = make_history(owner)
+    client = api_app.app.test_client()
+
+    def points():
+        stored = vector_store.list_history_points(api_app.get_q_client(), history_id, ("text",))
+        return {payload["text"]: point_id for point_id, payload in stored.items()}
+
+    paragraphs = ["Alpha one two three four.", "Beta one two three four.", "Gamma one two three four."]
+    response = client.post(f"/api/history/{history_id}/reindex", json={"user_id": owner, "content": "\n\n".join(paragraphs)})
+    assert response.json["report"]["embedded"] == 3
+    before = points()
+
+    embedded.clear()
+    paragraphs[1] = "Delta one two three four."
+    report = client.post(f"/api/history/{history_id}/reindex",
+                         json={"user_id": owner, "content": "\n\n".join(paragraphs)}).json["report"]
+    assert embedded == ["Delta one two three four."]
+    assert (report["embedded"], report["removed"], report["unchanged"]) == (1, 1, 2)
+    after = points()
+    assert sorted(after) == sorted(paragraphs)
+    assert all(after[text] == before[text] for text in paragraphs if text in before)
+
+    # Someone else's document is reported as missing, and left alone
+    stranger = make_user()
+    response = client.post(f"/api/history/{history_id}/reindex", json={"user_id": stranger, "content": "Hijacked."})
+    assert response.status_code == 404
+    assert client.post(f"/api/history/{history_id}/reindex", json={}).status_code == 400
+    assert points() == after
+
+
+def test_metrics_hidden_unless_token_or_public(api_module, monkeypatch):
+    client = api_module.app.test_client()
+    monkeypatch.setattr(api_module, "METRICS_TOKEN", "")
+    monkeypatch.setattr(api_module, "METRICS_PUBLIC", False)
+    assert client.get("/api/metrics").status_code == 404
+
+    monkeypatch.setattr(api_module, "METRICS_PUBLIC", True)
+    assert client.get("/api/metrics").status_code == 200
+
+    monkeypatch.setattr(api_module, "METRICS_TOKEN", "s3cret")
+    assert client.get("/api/metrics").status_code == 401
+    assert client.get("/api/metrics", headers={"Authorization": "Bearer s3cret"}).status_code == 200
+
+
+def test_profiler_stage_accounting_and_slow_capture(monkeypatch):
+    import threading
+    import time
+    from utils import profiler
+
+    monkeypatch.setattr(profiler, "PROFILE_TOKEN", "s3cret")
+    monkeypatch.setitem(profiler.settings, "sample_rate", 0)
+    monkeypatch.setitem(profiler.settings, "slow_ms", 0)
+    leftover = profiler.begin("GET", "/x", "s3cret")  # never finished, e.g. an aborted request
+    assert profiler.begin("GET", "/x", "wrong") is None
+    assert profiler.current() is None
+    profiler.finish(leftover)
+    assert profiler.begin("GET", "/x") is None
+
+    profile = profiler.begin("GET", "/x", "s3cret")
+    with profiler.stage("db"):
+        time.sleep(0.02)
+    worker = threading.Thread(target=profiler.bind(lambda: profiler.add("llm", 0.5)))
+    worker.start()
+    worker.join()
+    profiler.finish(profile)
+    assert profiler.current() is None
+    profiler.add("llm", 1)  # outside a request: ignored
+    summary = profiler.recent("header")[0]
+    assert summary["id"] == profile.id
+    assert summary["stages_ms"]["llm"] == 500.0 and summary["stages_ms"]["db"] >= 20
+
+    # Without a trigger, only requests slower than slow_ms are kept
+    monkeypatch.setitem(profiler.settings, "slow_ms", 40)
+    monkeypatch.setitem(profiler.settings, "slow_interval_ms", 5)
+    fast = profiler.begin("GET", "/fast")
+    profiler.finish(fast)
+    slow = profiler.begin("GET", "/slow")
+    time.sleep(0.1)
+    profiler.finish(slow)
+    kept = [s["id"] for s in profiler.recent("slow")]
+    assert slow.id in kept and fast.id not in kept
+    assert "test_profiler_stage_accounting_and_slow_capture" in profiler.collapsed_stacks(slow.id)
+
+
+def test_cors_allows_and_exposes_profile_headers(api_module):
+    response = api_module.app.test_client().options("/api/health", headers={
+        "Origin": "http://app.test", "Access-Control-Request-Method": "GET", "Access-Control-Request-Headers": "X-Profile",
+    })
+    assert "X-Profile" in response.headers["Access-Control-Allow-Headers"]
+    assert response.headers["Access-Control-Expose-Headers"] == "X-Profile-Id"
+
+
+def test_budget_counts_flushed_and_unflushed_tokens(api_app, make_user, monkeypatch):
+    from types import SimpleNamespace
+    from utils import llm_usage
+
+    monkeypatch.setattr(llm_usage, "DAILY_TOKEN_BUDGET", 100)
+    monkeypatch.setattr(llm_usage, "_pending", [])
+    monkeypatch.setattr(llm_usage, "_spent_cache", {})
+    user_id = make_user()
+    status = {"role": "user", "is_premium": False}
+
+    def usage(prompt, completion):
+        return SimpleNamespace(prompt_tokens=prompt, completion_tokens=completion, prompt_tokens_details=None)
+
+    with api_app.db_connection() as conn:
+        assert llm_usage.check_budget(conn, user_id, status) == (True, 0, 100)
+        llm_usage.record("test/budget-model", 0.2, usage=usage(30, 10), user_id=user_id)
+        assert llm_usage.tokens_today(conn, user_id) == 40  # cached 0 + unflushed 40
+        assert llm_usage.flush(conn) == 1
+        assert llm_usage.tokens_today(conn, user_id) == 40  # moved into the cached figure, not counted twice
+        llm_usage._spent_cache.clear()
+        assert llm_usage.tokens_today(conn, user_id) == 40  # re-read from llm_user_daily
+
+        llm_usage.record("test/budget-model", 0.2, usage=usage(50, 20), user_id=user_id)
+        assert llm_usage.check_budget(conn, user_id, status) == (False, 110, 100)
+        assert llm_usage.check_budget(conn, user_id, {"role": "admin", "is_premium": False}) == (True, None, None)
+        by_model = [r for r in llm_usage.daily_by_model(conn, 1) if r["model"] == "test/budget-model"]
+        assert [(r["calls"], r["tokens"]) for r in by_model] == [(1, 40)]
+
+    response = api_app.app.test_client().post("/api/analyze", data={"user_id": str(user_id), "text": "Hello"})
+    assert response.status_code == 429
+    assert response.json["tokens_used"] == 110 and response.json["token_budget"] == 100
+    assert 0 < int(response.headers["Retry-After"]) <= 24 * 3600
+
+
+class FakeEmbedder:
+    """Deterministic stand-in for the sentence-transformers model: one pseudo-random unit vector per text."""
+
+    def encode(self, texts, convert_to_numpy=True, **kwargs):
+        import hashlib
+        import numpy as np
+        from utils.vector_store import VECTOR_SIZE
+        vectors = []
+        for text in texts:
+            seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "little")
+            vector = np.random.default_rng(seed).standard_normal(VECTOR_SIZE).astype(np.float32)
+            vectors.append(vector / np.linalg.norm(vector))
+        return np.array(vectors)
+
+
+class FakeCrossEncoder:
+    def predict(self, pairs, **kwargs):
+        return [float(len(set(q.lower().split()) & set(c.lower().split()))) for q, c in pairs]
+
+
+def test_retrieval_only_returns_the_callers_chunks(api_module, monkeypatch):
+    pytest.importorskip("qdrant_client")
+    pytest.importorskip("rank_bm25")
+    from qdrant_client.models import PointStruct
+    from utils import vector_store
+
+    monkeypatch.setattr(api_module, "get_embedder", lambda: FakeEmbedder())
+    monkeypatch.setattr(api_module, "get_reranker", lambda: FakeCrossEncoder())
+    client = api_module.get_q_client()
+    texts = {(900001, 71): ["Alice's invoice is unpaid.", "Alice's contract renews in May."],
+             (900002, 72): ["Bob's invoice is unpaid.", "Bob's contract ends in June."]}
+    points = []
+    for (history_id, user_id), chunks in texts.items():
+        ids = vector_store.chunk_point_ids(history_id, chunks)
+        for index, (point_id, text, vector) in enumerate(zip(ids, chunks, FakeEmbedder().encode(chunks))):
+            points.append(PointStruct(id=point_id, vector=vector.tolist(), payload={
+                "tenant_id": vector_store.tenant_key(user_id), "history_id": history_id, "text": text, "chunk_index": index,
+            }))
+    client.upsert(collection_name=vector_store.COLLECTION_NAME, points=points, wait=True)
+
+    # Both documents are asked for, but only user 71's partition is searched
+    context = api_module.retrieve_relevant_chunks("Which invoice is unpaid?", [900001, 900002], "FALLBACK", user_ids=[71])
+    assert "Alice's invoice is unpaid." in context
+    assert "Bob" not in context and "FALLBACK" not in context
+    context = api_module.retrieve_relevant_chunks("Which invoice is unpaid?", [900001], "FALLBACK", user_ids=[72])
+    assert context == "FALLBACK"
+
+
+def test_quantized_collection_is_searched_with_rescoring(monkeypatch):
+    pytest.importorskip("qdrant_client")
+    import numpy as np
+    from qdrant_client.models import PointStruct
+    from utils import vector_store
+
+    monkeypatch.setattr(vector_store, "QDRANT_QUANTIZATION", "binary")
+    client = vector_store.create_client("memory")
+    created = []
+    create_collection = client.create_collection
+    monkeypatch.setattr(client, "create_collection", lambda **kw: created.append(kw) or create_collection(**kw))
+    vector_store.ensure_collection(client)
+    # Local mode accepts but doesn't report quantization, so check what was asked for
+    assert created[0]["quantization_config"].binary is not None
+
+    vectors = np.random.default_rng(7).standard_normal((300, vector_store.VECTOR_SIZE)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    client.upsert(collection_name=vector_store.COLLECTION_NAME, wait=True, points=[
+        PointStruct(id=i, vector=v.tolist(), payload={"tenant_id": "1", "history_id": 1, "text": str(i)})
+        for i, v in enumerate(vectors)
+    ])
+    calls = []
+    query_points = client.query_points
+    monkeypatch.setattr(client, "query_points", lambda **kw: calls.append(kw) or query_points(**kw))
+
+    query = vectors[42] + 0.05 * vectors[7]
+    hits = vector_store.search(client, query.tolist(), vector_store.history_filter([1], [1]), 5)
+    assert calls[0]["search_params"].quantization.rescore is True
+    assert calls[0]["search_params"].quantization.oversampling == vector_store.QDRANT_OVERSAMPLING
+    assert hits[0].id == int(np.argmax(vectors @ (query / np.linalg.norm(query))))
+
+
+def test_preload_warms_single_threaded_and_workers_restore_torch_threads(api_module, monkeypatch):
+    import gc
+    import types
+
+    calls = []
+    torch = types.SimpleNamespace(get_num_threads=lambda: 8, set_num_threads=calls.append)
+    monkeypatch.setitem(sys.modules, "torch", torch)
+    monkeypatch.setattr(gc, "freeze", lambda: None)
+    monkeypatch.setattr(api_module, "EMBEDDING_BACKEND", "torch")
+    monkeypatch.setattr(api_module, "TORCH_NUM_THREADS", 0)
+    monkeypatch.setattr(api_module, "torch_threads", None)
+    monkeypatch.setattr(api_module, "default_torch_threads", None)
+    monkeypatch.setattr(api_module, "get_embedder", lambda: FakeEmbedder())
+    monkeypatch.setattr(api_module, "get_reranker", lambda: FakeCrossEncoder())
+
+    api_module.preload_models(before_fork=True)
+    assert calls == [1]  # the master stays single-threaded until the fork
+    api_module.after_fork()
+    assert calls == [1, 8]
+
+    monkeypatch.setattr(api_module, "TORCH_NUM_THREADS", 2)
+    api_module.after_fork()
+    assert calls[-1] == 2
+
+
+def test_ready_waits_for_preloaded_models(api_module, monkeypatch):
+    client = api_module.app.test_client()
+    monkeypatch.setattr(api_module, "embedder", None)
+    monkeypatch.setattr(api_module, "reranker", None)
+    monkeypatch.setattr(api_module, "PRELOAD_MODELS", "0")
+    assert client.get("/api/ready").status_code == 200
+
+    monkeypatch.setattr(api_module, "PRELOAD_MODELS", "1")
+    response = client.get("/api/ready")
+    assert response.status_code == 503 and response.json["status"] == "loading"
+
+    monkeypatch.setattr(api_module, "embedder", FakeEmbedder())
+    monkeypatch.setattr(api_module, "reranker", FakeCrossEncoder())
+    response = client.get("/api/ready")
+    assert response.status_code == 200 and response.json["models"] == {"embedder": True, "reranker": True}
+
+
+def test_create_client_modes(tmp_path, monkeypatch):
+    pytest.importorskip("qdrant_client")
+    from utils import vector_store
+
+    assert vector_store.create_client("memory").get_collections().collections == []
+
+    monkeypatch.setattr(vector_store, "QDRANT_PATH", str(tmp_path / "qdrant"))
+    monkeypatch.setattr(vector_store, "WEB_CONCURRENCY", 1)
+    client = vector_store.create_client("embedded")
+    vector_store.ensure_collection(client)
+    client.close()
+    assert (tmp_path / "qdrant").is_dir()
+    # Several workers can't share the file lock: refuse rather than leave all but one without vectors
+    monkeypatch.setattr(vector_store, "WEB_CONCURRENCY", 4)
+    with pytest.raises(RuntimeError, match="QDRANT_MODE=server"):
+        vector_store.create_client("embedded")
+
+    monkeypatch.setattr(vector_store, "QDRANT_URL", "http://127.0.0.1:9")
+    monkeypatch.setattr(vector_store, "QDRANT_API_KEY", None)
+    client = vector_store.create_client("server")  # connects lazily
+    assert client._client.rest_uri == "http://127.0.0.1:9"
+    with pytest.raises(ValueError, match="Unknown QDRANT_MODE"):
+        vector_store.create_client("cloud")
+
+
+def test_onnx_models_match_torch():
+    pytest.importorskip("onnxruntime")
+    pytest.importorskip("tokenizers")
+    pytest.importorskip("sentence_transformers")
+    import export_onnx
+    from utils.onnx_models import model_file
+    if not all(os.path.exists(model_file(d)) for d in (export_onnx.ONNX_EMBEDDER_DIR, export_onnx.ONNX_RERANKER_DIR)):
+        pytest.skip("ONNX models not exported (python export_onnx.py)")
+    # Every sample embedding within 0.99 cosine of torch's, same top reranking, fp32 and int8
+    assert export_onnx.verify(min_cosine=0.99)
+
+
+class FakeConnection:
+    """Just enough of a psycopg2 connection for ConnectionPool, without a server."""
+
+    def __init__(self, *args, **kwargs):
+        from psycopg2 import extensions
+        self.closed = 0
+        self.broken = False
+        self.rollbacks = 0
+        self.transaction_status = extensions.TRANSACTION_STATUS_IDLE
+        self.info = self
+
+    def get_transaction_status(self):
+        return self.transaction_status
+
+    def cursor(self):
+        connection = self
+
+        class Cursor:
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc):
+                return False
+
+            def execute(self, sql):
+                if connection.broken:
+                    raise Exception("server closed the connection unexpectedly")
+        return Cursor()
+
+    def rollback(self):
+        from psycopg2 import extensions
+        self.rollbacks += 1
+        self.transaction_status = extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+
+@pytest.fixture
+def fake_pool(monkeypatch):
+    psycopg2 = pytest.importorskip("psycopg2")
+    from utils.db_pool import ConnectionPool
+    monkeypatch.setattr(psycopg2, "connect", FakeConnection)
+    return lambda **kwargs: ConnectionPool(1, 1, "postgresql://fake", **kwargs)
+
+
+def test_db_pool_times_out_and_releases_overflow(fake_pool, api_module):
+    from utils.db_pool import PoolTimeout
+
+    pool = fake_pool(checkout_timeout=0.05)
+    held = pool.getconn()
+    with pytest.raises(PoolTimeout):
+        pool.getconn()
+    assert pool.stats()["timeouts"] == 1
+    with api_module.app.test_request_context():
+        assert api_module.db_pool_timeout(PoolTimeout("busy")).status_code == 503
+    pool.putconn(held)
+
+    pool = fake_pool(checkout_timeout=0.05, max_overflow=1)
+    held = pool.getconn()
+    extra = pool.getconn()
+    assert extra is not held and pool.stats()["overflows"] == 1 and pool.stats()["in_use"] == 2
+    pool.putconn(extra)
+    assert extra.closed and pool.stats()["in_use"] == 1
+    # The overflow slot is free again
+    pool.putconn(pool.getconn())
+    pool.putconn(held)
+    assert pool.stats()["timeouts"] == 0
+
+
+def test_db_pool_discards_stale_and_rolls_back_open_transactions(fake_pool):
+    from psycopg2 import extensions
+
+    pool = fake_pool(validate_after=0)
+    conn = pool.getconn()
+    conn.transaction_status = extensions.TRANSACTION_STATUS_INTRANS
+    pool.putconn(conn)
+    assert conn.rollbacks == 1 and not conn.closed
+    assert pool.getconn() is conn
+    pool.putconn(conn)
+
+    conn.broken = True  # e.g. the server restarted while it sat idle
+    fresh = pool.getconn()
+    assert fresh is not conn and conn.closed
+    assert pool.stats()["stale_discarded"] == 1
+    pool.putconn(fresh)
+
+
+def test_embedding_cache_hits_evicts_and_prunes(tmp_path):
+    import sqlite3
+    import time
+    from utils.embedding_cache import EmbeddingCache, embed_with_cache
+
+    encoded = []
+    def encode(texts):
+        encoded.extend(texts)
+        return FakeEmbedder().encode(texts)
+
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite3"), memory_entries=2, max_rows=3, max_age_days=1)
+    first, hashes = embed_with_cache(cache, "m", ["a", "b", "a"], encode)
+    assert encoded == ["a", "b"]
+    again, _ = embed_with_cache(cache, "m", ["a", "b", "a"], encode)
+    assert encoded == ["a", "b"] and (again == first).all()
+
+    # The in-memory LRU drops the least recently used entry; SQLite still has it
+    embed_with_cache(cache, "m", ["c"], encode)
+    assert len(cache) == 2 and ("m", hashes[0]) not in cache._memory
+    assert set(cache.get_many("m", [hashes[0]])) == {hashes[0]}
+
+    # Past max_rows the oldest rows go; past max_age_days every stale one does
+    db = sqlite3.connect(cache.path)
+    db.execute("UPDATE embeddings SET stored_at = stored_at - 3600 WHERE chunk_hash = ?", (hashes[1],))
+    db.commit()
+    embed_with_cache(cache, "m", ["d"], encode)
+    remaining = {h for (h,) in db.execute("SELECT chunk_hash FROM embeddings")}
+    assert len(remaining) == 3 and hashes[1] not in remaining
+    db.execute("UPDATE embeddings SET stored_at = ?", (int(time.time()) - 2 * 86400,))
+    db.commit()
+    embed_with_cache(cache, "m", ["e"], encode)
+    assert db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0] == 1
+
+
+def test_reindexing_gives_identical_point_ids():
+    from utils import vector_store
+
+    chunks = ["Intro.", "Body.", "Intro."]
+    ids = vector_store.chunk_point_ids(7, chunks)
+    assert ids == vector_store.chunk_point_ids(7, list(chunks))
+    assert len(set(ids)) == 3  # a repeated chunk still gets its own point
+    assert not set(ids) & set(vector_store.chunk_point_ids(8, chunks))
+
+
+def test_history_deletes_reconcile_and_tenant_backfill(monkeypatch):
+    pytest.importorskip("qdrant_client")
+    from qdrant_client.models import PointStruct
+    from utils import vector_store
+
+    client = vector_store.create_client("memory")
+    vector_store.ensure_collection(client)
+    owners = {1: 10, 2: 10, 3: 20, 4: 20}
+    vectors = FakeEmbedder().encode([f"chunk {i}" for i in range(12)])
+    client.upsert(collection_name=vector_store.COLLECTION_NAME, wait=True, points=[
+        PointStruct(id=i, vector=vectors[i].tolist(), payload={"history_id": i % 4 + 1, "text": f"chunk {i}"})
+        for i in range(12)
+    ])
+    def points_by_history():
+        points, _ = client.scroll(vector_store.COLLECTION_NAME, limit=100, with_payload=True)
+        grouped = {}
+        for p in points:
+            grouped.setdefault(p.payload["history_id"], set()).add(p.id)
+        return grouped, {p.id: p.payload.get("tenant_id") for p in points}
+    before, _ = points_by_history()
+
+    # Points written before tenants existed get their owner's tenant, page by page
+    assert vector_store.backfill_tenants(client, lambda ids: {h: owners[h] for h in ids}, batch_size=2) == 4
+    _, tenants = points_by_history()
+    assert tenants == {i: str(owners[i % 4 + 1]) for i in range(12)}
+
+    # Deleting one history row removes exactly its points
+    vector_store.delete_history_vectors(client, [2])
+    after, _ = points_by_history()
+    assert after == {h: ids for h, ids in before.items() if h != 2}
+
+    # Orphans (rows 3 and 4 are gone from Postgres) are purged; live points are untouched
+    report = vector_store.reconcile_orphans(client, lambda ids: {h for h in ids if h == 1}, batch_size=2)
+    assert report["history_ids_checked"] == 3 and report["orphan_history_ids"] == 2
+    assert points_by_history()[0] == {1: before[1]}
+
+
+def test_csv_export_streams_more_rows_than_itersize(api_app, monkeypatch):
+    import csv
+    import io
+    import jwt
+
+    monkeypatch.setattr(api_app, "EXPORT_ITERSIZE", 7)
+    monkeypatch.setattr(api_app, "EXPORT_FLUSH_BYTES", 256)
+    with api_app.db_connection() as conn:
+        c = conn.cursor()
+        prefix = f"export-{os.urandom(4).hex()}"
+        c.executemany(
+            "INSERT INTO users (username, password_hash, role, analysis_count, is_premium) VALUES (%s, 'x', 'user', %s, %s)",
+            [(f"{prefix}-{i}", i, i % 2) for i in range(40)]
+        )
+        conn.commit()
+        c.execute("SELECT COUNT(*) FROM users")
+        total = c.fetchone()[0]
+
+    token = jwt.encode({"role": "admin"}, api_app.JWT_SECRET, algorithm="HS256")
+    response = api_app.app.test_client().get("/api/admin/export", headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 200
+    assert response.headers["Content-Disposition"] == "attachment;filename=omnidoc_users.csv"
+    assert response.mimetype == "text/csv"
+    rows = list(csv.reader(io.StringIO(response.get_data(as_text=True))))
+    assert rows[0] == ['ID', 'Username', 'Role', 'Analysis Count', 'Premium Status']
+    assert len(rows) == total + 1
+    ours = [row for row in rows[1:] if row[1].startswith(prefix)]
+    assert [row[1] for row in ours] == [f"{prefix}-{i}" for i in reversed(range(40))]
+    assert ours[0][3:] == ["39", "Yes"] and ours[-1][3:] == ["0", "No"]
+
+
+def test_non_numeric_user_ids_are_rejected(api_module):
+    client = api_module.app.test_client()
+    for user_id in ("abc", "1 OR 1=1", "-3", "1.5"):
+        response = client.post("/api/analyze", data={"user_id": user_id, "text": "Hello"})
+        assert response.status_code == 400 and response.json["message"] == "Invalid user ID"
+        response = client.post("/api/history/1/reindex", json={"user_id": user_id})
+        assert response.status_code == 400
+        response = client.post("/api/user/checkout-success", json={"user_id": user_id})
+        assert response.status_code == 400 and response.json == {"success": False, "message": "Invalid user ID"}
+    assert client.post("/api/user/checkout-success", json={}).status_code == 400
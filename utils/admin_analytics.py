@@ -0,0 +1,245 @@
+import os
+import threading
+import time
+
+
+ANALYTICS_REFRESH_INTERVAL = float(os.environ.get("ANALYTICS_REFRESH_INTERVAL", "60"))
+# Rows younger than this are left for the next pass so slow-committing inserts with
+# lower SERIAL ids aren't skipped by the watermark.
+ANALYTICS_SETTLE_SECONDS = int(os.environ.get("ANALYTICS_SETTLE_SECONDS", "5"))
+# Arbitrary constant so only one worker refreshes at a time.
+ANALYTICS_LOCK_KEY = 72413001
+
+SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS admin_rollup_state (
+        name VARCHAR(50) PRIMARY KEY,
+        last_id BIGINT NOT NULL DEFAULT 0,
+        refreshed_at TIMESTAMP
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS admin_user_stats (
+        user_id INTEGER PRIMARY KEY,
+        document_count INTEGER NOT NULL DEFAULT 0,
+        total_bytes BIGINT NOT NULL DEFAULT 0,
+        last_upload_at TIMESTAMP
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS admin_daily_uploads (
+        day DATE PRIMARY KEY,
+        uploads INTEGER NOT NULL DEFAULT 0,
+        total_bytes BIGINT NOT NULL DEFAULT 0
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS admin_content_type_stats (
+        content_type VARCHAR(50) PRIMARY KEY,
+        documents INTEGER NOT NULL DEFAULT 0,
+        total_bytes BIGINT NOT NULL DEFAULT 0
+    )
+    ''',
+    "INSERT INTO admin_rollup_state (name, last_id) VALUES ('user_history', 0) ON CONFLICT (name) DO NOTHING",
+]
+
+_schema_ready = False
+_refresher = None
+_refresher_lock = threading.Lock()
+
+
+def ensure_schema(conn):
+    global _schema_ready
+    if _schema_ready:
+        return
+    c = conn.cursor()
+    try:
+        for statement in SCHEMA:
+            c.execute(statement)
+        conn.commit()
+        _schema_ready = True
+    finally:
+        c.close()
+
+
+def refresh_rollups(conn):
+    """Fold user_history rows added since the last run into the rollup tables.
+
+    Only rows past the stored watermark are read, so each refresh costs time
+    proportional to the new uploads rather than to the whole table. Returns the
+    number of history rows processed, or None if another worker holds the lock.
+    """
+    ensure_schema(conn)
+    c = conn.cursor()
+    try:
+        c.execute("SELECT pg_try_advisory_xact_lock(%s)", (ANALYTICS_LOCK_KEY,))
+        if not c.fetchone()[0]:
+            conn.rollback()
+            return None
+
+        c.execute("SELECT last_id FROM admin_rollup_state WHERE name = 'user_history'")
+        last_id = c.fetchone()[0]
+        c.execute(
+            """SELECT MAX(id), MIN(id) FILTER (WHERE created_at >= NOW() - make_interval(secs => %s))
+               FROM user_history WHERE id > %s""",
+            (ANALYTICS_SETTLE_SECONDS, last_id)
+        )
+        max_id, first_unsettled = c.fetchone()
+        upto = max_id or last_id
+        if first_unsettled is not None:
+            upto = min(upto, first_unsettled - 1)
+
+        processed = 0
+        if upto > last_id:
+            window = {"lo": last_id, "hi": upto}
+            c.execute(
+                """INSERT INTO admin_user_stats (user_id, document_count, total_bytes, last_upload_at)
+                   SELECT user_id, COUNT(*), SUM(COALESCE(octet_length(content), 0)), MAX(created_at)
+                   FROM user_history WHERE id > %(lo)s AND id <= %(hi)s AND user_id IS NOT NULL
+                   GROUP BY user_id
+                   ON CONFLICT (user_id) DO UPDATE SET
+                       document_count = admin_user_stats.document_count + EXCLUDED.document_count,
+                       total_bytes = admin_user_stats.total_bytes + EXCLUDED.total_bytes,
+                       last_upload_at = GREATEST(admin_user_stats.last_upload_at, EXCLUDED.last_upload_at)""",
+                window
+            )
+            # Days are UTC whatever the server's TimeZone. created_at is a plain TIMESTAMP
+            # written in the session's zone, so it goes through timestamptz to convert.
+            c.execute(
+                """INSERT INTO admin_daily_uploads (day, uploads, total_bytes)
+                   SELECT (created_at::timestamptz AT TIME ZONE 'UTC')::date, COUNT(*), SUM(COALESCE(octet_length(content), 0))
+                   FROM user_history WHERE id > %(lo)s AND id <= %(hi)s
+                   GROUP BY 1
+                   ON CONFLICT (day) DO UPDATE SET
+                       uploads = admin_daily_uploads.uploads + EXCLUDED.uploads,
+                       total_bytes = admin_daily_uploads.total_bytes + EXCLUDED.total_bytes""",
+                window
+            )
+            c.execute(
+                """INSERT INTO admin_content_type_stats (content_type, documents, total_bytes)
+                   SELECT COALESCE(content_type, 'unknown'), COUNT(*), SUM(COALESCE(octet_length(content), 0))
+                   FROM user_history WHERE id > %(lo)s AND id <= %(hi)s
+                   GROUP BY COALESCE(content_type, 'unknown')
+                   ON CONFLICT (content_type) DO UPDATE SET
+                       documents = admin_content_type_stats.documents + EXCLUDED.documents,
+                       total_bytes = admin_content_type_stats.total_bytes + EXCLUDED.total_bytes""",
+                window
+            )
+            c.execute("SELECT COUNT(*) FROM user_history WHERE id > %(lo)s AND id <= %(hi)s", window)
+            processed = c.fetchone()[0]
+
+        c.execute(
+            "UPDATE admin_rollup_state SET last_id = %s, refreshed_at = NOW() WHERE name = 'user_history'",
+            (upto,)
+        )
+        conn.commit()
+        return processed
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        c.close()
+
+
+def lock_rollups(conn):
+    """Wait for the rollup lock inside the caller's transaction (released on commit/rollback).
+
+    Taken before deleting history rows, so a concurrent refresh can't move the
+    watermark between the DELETE and record_history_deleted().
+    """
+    ensure_schema(conn)
+    c = conn.cursor()
+    try:
+        c.execute("SELECT pg_advisory_xact_lock(%s)", (ANALYTICS_LOCK_KEY,))
+    finally:
+        c.close()
+
+
+def record_history_deleted(conn, row):
+    """Subtract a deleted history row from the rollups, in the caller's transaction.
+
+    The caller takes lock_rollups() before the DELETE and commits both together.
+    `row` is the (id, user_id, content_type, created_at, bytes) returned by the
+    DELETE. Rows past the watermark were never counted, so they are skipped.
+    """
+    history_id, user_id, content_type, created_at, size = row
+    c = conn.cursor()
+    try:
+        c.execute("SELECT last_id FROM admin_rollup_state WHERE name = 'user_history'")
+        state = c.fetchone()
+        if not state or history_id > state[0]:
+            return
+        size = size or 0
+        c.execute(
+            "UPDATE admin_user_stats SET document_count = GREATEST(document_count - 1, 0), total_bytes = GREATEST(total_bytes - %s, 0) WHERE user_id = %s",
+            (size, user_id)
+        )
+        if created_at:
+            c.execute(
+                """UPDATE admin_daily_uploads SET uploads = GREATEST(uploads - 1, 0), total_bytes = GREATEST(total_bytes - %s, 0)
+                   WHERE day = (%s::timestamptz AT TIME ZONE 'UTC')::date""",
+                (size, created_at)
+            )
+        c.execute(
+            "UPDATE admin_content_type_stats SET documents = GREATEST(documents - 1, 0), total_bytes = GREATEST(total_bytes - %s, 0) WHERE content_type = %s",
+            (size, content_type or 'unknown')
+        )
+    finally:
+        c.close()
+
+
+def get_summary(conn, days=30):
+    """Everything the admin dashboard needs, read from the compact rollup tables only."""
+    ensure_schema(conn)
+    from psycopg2.extras import RealDictCursor
+    c = conn.cursor(cursor_factory=RealDictCursor)
+    try:
+        c.execute("SELECT refreshed_at FROM admin_rollup_state WHERE name = 'user_history'")
+        state = c.fetchone()
+        c.execute("SELECT content_type, documents, total_bytes FROM admin_content_type_stats ORDER BY documents DESC")
+        content_types = [dict(r) for r in c.fetchall()]
+        c.execute(
+            "SELECT day, uploads, total_bytes FROM admin_daily_uploads WHERE day >= (NOW() AT TIME ZONE 'UTC')::date - %s ORDER BY day",
+            (days,)
+        )
+        daily = [dict(r) for r in c.fetchall()]
+        c.execute(
+            """SELECT s.user_id, u.username, s.document_count, s.total_bytes, s.last_upload_at
+               FROM admin_user_stats s LEFT JOIN users u ON u.id = s.user_id
+               ORDER BY s.document_count DESC LIMIT 10"""
+        )
+        top_users = [dict(r) for r in c.fetchall()]
+    finally:
+        c.close()
+    return {
+        "refreshed_at": state["refreshed_at"] if state else None,
+        "total_documents": sum(r["documents"] for r in content_types),
+        "content_types": content_types,
+        "daily_uploads": daily,
+        "top_users": top_users,
+    }
+
+
+def start_refresher(connection_factory, interval=None):
+    """Start the background refresh thread once per process.
+
+    `connection_factory` is a context manager yielding a DB connection (api.db_connection).
+    """
+    global _refresher
+    interval = interval or ANALYTICS_REFRESH_INTERVAL
+    with _refresher_lock:
+        if _refresher is not None and _refresher.is_alive():
+            return _refresher
+
+        def run():
+            while True:
+                try:
+                    with connection_factory() as conn:
+                        refresh_rollups(conn)
+                except Exception as e:
+                    print(f"Warning: Admin analytics refresh failed ({e})")
+                time.sleep(interval)
+
+        _refresher = threading.Thread(target=run, name="admin-analytics", daemon=True)
+        _refresher.start()
+        return _refresher
@@ -0,0 +1,247 @@
+import os
+import re
+
+# all-MiniLM-L6-v2 truncates input at 256 word pieces ([CLS] and [SEP] included), so
+# anything longer is never embedded. count_tokens() only estimates WordPiece: rare words
+# and codes split into more pieces than it counts, so the target keeps ~20% headroom.
+MODEL_MAX_TOKENS = 256
+CHUNK_TARGET_TOKENS = int(os.environ.get("CHUNK_TARGET_TOKENS", "200"))
+# Sections smaller than this are merged with the next one instead of becoming their own chunk
+CHUNK_MIN_TOKENS = int(os.environ.get("CHUNK_MIN_TOKENS", "64"))
+
+# Digit runs count one piece per three digits: WordPiece only knows short numbers,
+# and invoice numbers, dates and amounts are what make tables token-heavy
+_TOKEN_RE = re.compile(r"[^\W\d]+|\d{1,3}|[^\w\s]")
+_SENTENCE_RE = re.compile(r"(?<=[.!?])\s+(?=[\"'(\[]?[A-Z0-9])")
+_HEADING_RE = re.compile(r"^(#{1,6})\s+(.+?)\s*#*$")
+_PAGE_MARKER_RE = re.compile(r"^-{3}\s*Page\s+(\d+)\s*-{3}$")
+_SOURCE_MARKER_RE = re.compile(r"^-{3}\s*Source:\s*(\S+)\s*-{3}$")
+_TABLE_CAPTION_PAGE_RE = re.compile(r"\(Page\s+(\d+)\)")
+_TABLE_SEPARATOR_RE = re.compile(r"^\|?(\s*:?-+:?\s*\|)+\s*(:?-+:?)?\s*$")
+
+
+def count_tokens(text):
+    """Cheap, linear word-piece estimate: words, short digit groups and punctuation marks."""
+    return len(_TOKEN_RE.findall(text))
+
+
+def _blocks(text):
+    """Split text into (kind, text, section, page) blocks in a single pass over its lines.
+
+    kind is one of heading, paragraph, code, table, source. Form feeds (as emitted by
+    extract_pdf) and "--- Page N ---" lines (OCR output) advance the page number;
+    "--- Source: <url> ---" lines (crawled sites) yield a source block and reset the section.
+    """
+    section = None
+    page = 1
+    lines = []
+    kind = None
+    in_fence = False
+
+    def flush():
+        nonlocal lines, kind
+        if lines:
+            body = "\n".join(lines).strip("\n")
+            if body.strip():
+                yield (kind, body, section, page)
+        lines = []
+        kind = None
+
+    for raw_line in text.split("\n"):
+        # A form feed marks a page break; it may sit in the middle of a line
+        parts = raw_line.split("\f")
+        for part_index, line in enumerate(parts):
+            if part_index > 0:
+                if not in_fence:
+                    yield from flush()
+                page += 1
+            stripped = line.strip()
+
+            if in_fence:
+                lines.append(line)
+                if stripped.startswith("```"):
+                    in_fence = False
+                    yield from flush()
+                continue
+            if stripped.startswith("```"):
+                yield from flush()
+                kind = "code"
+                in_fence = True
+                lines.append(line)
+                continue
+
+            page_marker = _PAGE_MARKER_RE.match(stripped)
+            if page_marker:
+                yield from flush()
+                page = int(page_marker.group(1))
+                continue
+
+            source_marker = _SOURCE_MARKER_RE.match(stripped)
+            if source_marker:
+                yield from flush()
+                section = None
+                yield ("source", source_marker.group(1), None, page)
+                continue
+
+            heading = _HEADING_RE.match(stripped)
+            if heading:
+                yield from flush()
+                section = heading.group(2)
+                caption_page = _TABLE_CAPTION_PAGE_RE.search(section)
+                if caption_page:
+                    page = int(caption_page.group(1))
+                yield ("heading", stripped, section, page)
+                continue
+
+            if not stripped:
+                yield from flush()
+                continue
+
+            line_kind = "table" if stripped.startswith("|") else "paragraph"
+            if kind is not None and kind != line_kind:
+                yield from flush()
+            kind = line_kind
+            lines.append(line)
+    yield from flush()
+
+
+def _split_words(text, target):
+    """Pack whole words into pieces of at most `target` tokens.
+
+    A single word with more tokens than that (a long URL, say) is cut at token boundaries.
+    """
+    piece, piece_tokens = [], 0
+    for word in text.split():
+        tokens = count_tokens(word)
+        if tokens > target:
+            if piece:
+                yield " ".join(piece)
+                piece, piece_tokens = [], 0
+            starts = [match.start() for match in _TOKEN_RE.finditer(word)]
+            for i in range(0, len(starts), target):
+                yield word[starts[i]:starts[i + target] if i + target < len(starts) else len(word)]
+            continue
+        if piece and piece_tokens + tokens > target:
+            yield " ".join(piece)
+            piece, piece_tokens = [], 0
+        piece.append(word)
+        piece_tokens += tokens
+    if piece:
+        yield " ".join(piece)
+
+
+def _split_oversized(kind, text, target):
+    """Break a block bigger than `target` along its natural boundaries."""
+    if kind == "table" or kind == "code":
+        rows = text.split("\n")
+        # Repeat a table's header (and its |---| line) so every piece is still readable on its own
+        header_rows = 0
+        if kind == "table":
+            header_rows = 2 if len(rows) > 1 and _TABLE_SEPARATOR_RE.match(rows[1].strip()) else 1
+        header = "\n".join(rows[:header_rows]) or None
+        units = rows[header_rows:]
+        joiner = "\n"
+    else:
+        header = None
+        units = _SENTENCE_RE.split(text)
+        joiner = " "
+
+    piece, piece_tokens = [], 0
+    header_tokens = count_tokens(header) if header else 0
+    for unit in units:
+        unit_tokens = count_tokens(unit)
+        if unit_tokens > target:
+            if piece:
+                yield joiner.join(([header] if header else []) + piece)
+                piece, piece_tokens = [], 0
+            yield from _split_words(unit, target)
+            continue
+        if piece and header_tokens + piece_tokens + unit_tokens > target:
+            yield joiner.join(([header] if header else []) + piece)
+            piece, piece_tokens = [], 0
+        piece.append(unit)
+        piece_tokens += unit_tokens
+    if piece:
+        yield joiner.join(([header] if header else []) + piece)
+
+
+def chunk_document(text, target_tokens=None, min_tokens=None):
+    """Split a document into embedding-sized chunks that respect its structure.
+
+    Chunks never cut through a word, sentence, table row or code line unless a
+    single unit is itself larger than the target. Headings start a new chunk
+    (once the current one holds at least `min_tokens`). Runs in linear time.
+
+    Returns a list of dicts: text, section, page, page_end, source_url, chunk_index
+    (page is None for documents without page breaks, source_url is None outside
+    "--- Source: <url> ---" parts; a chunk never spans two sources).
+    """
+    target = target_tokens or CHUNK_TARGET_TOKENS
+    minimum = CHUNK_MIN_TOKENS if min_tokens is None else min_tokens
+    chunks = []
+    current, current_tokens = [], 0
+    meta = {}
+    source_url = None
+
+    def emit():
+        nonlocal current, current_tokens
+        if current:
+            chunks.append({
+                "text": "\n\n".join(current),
+                "section": meta.get("section"),
+                "page": meta.get("page"),
+                "page_end": meta.get("page_end"),
+                "source_url": meta.get("source_url"),
+                "chunk_index": len(chunks),
+            })
+        current, current_tokens = [], 0
+
+    def add(pieces, section, page):
+        nonlocal current_tokens
+        tokens = sum(t for _, t in pieces)
+        if current and current_tokens + tokens > target:
+            emit()
+        if not current:
+            meta.update(section=section, page=page, source_url=source_url)
+        meta["page_end"] = page
+        for piece, piece_tokens in pieces:
+            current.append(piece)
+            current_tokens += piece_tokens
+
+    # A heading is held back and emitted together with the block that follows it,
+    # so it never ends up stranded at the bottom of the previous chunk.
+    pending_heading = None
+    for kind, body, section, page in _blocks(text):
+        if kind == "source":
+            if pending_heading:
+                add([pending_heading], None, page)
+                pending_heading = None
+            emit()
+            source_url = body
+            continue
+        if kind == "heading":
+            if current_tokens >= minimum:
+                emit()
+            if pending_heading:
+                add([pending_heading], section, page)
+            pending_heading = (body, count_tokens(body))
+            continue
+        tokens = count_tokens(body)
+        if tokens <= target:
+            pieces = [(body, tokens)]
+        else:
+            pieces = [(piece, count_tokens(piece)) for piece in _split_oversized(kind, body, target)]
+        for piece in pieces:
+            if pending_heading:
+                add([pending_heading, piece], section, page)
+                pending_heading = None
+            else:
+                add([piece], section, page)
+    if pending_heading:
+        add([pending_heading], None, meta.get("page_end"))
+    emit()
+    if chunks and chunks[-1]["page_end"] == 1:
+        # No page breaks at all: page numbers carry no information
+        for chunk in chunks:
+            chunk["page"] = chunk["page_end"] = None
+    return chunks
@@ -0,0 +1,165 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection becomes available within the checkout timeout."""
+
+
+class ConnectionPool:
+    """Blocking wrapper around psycopg2's ThreadedConnectionPool.
+
+    ThreadedConnectionPool raises immediately when exhausted. This wrapper makes
+    callers wait (up to checkout_timeout seconds) for a free slot instead, allows a
+    bounded number of overflow connections, validates connections that sat idle,
+    and keeps counters for checkouts, waits, overflows, timeouts and leaks.
+    """
+
+    def __init__(self, minconn, maxconn, dsn, checkout_timeout=5.0, max_overflow=0,
+                 validate_after=30.0, leak_threshold=60.0, **connect_kwargs):
+        self.dsn = dsn
+        self.maxconn = maxconn
+        self.max_overflow = max_overflow
+        self.checkout_timeout = checkout_timeout
+        self.validate_after = validate_after
+        self.leak_threshold = leak_threshold
+        self._connect_kwargs = connect_kwargs
+        import psycopg2.pool
+        self._pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, dsn, **connect_kwargs)
+        self._slots = threading.BoundedSemaphore(maxconn + max_overflow)
+        self._lock = threading.Lock()
+        # id(conn) -> (conn, checked_out_at, is_overflow)
+        self._checked_out = {}
+        # id(conn) -> last time it was returned to the pool
+        self._last_used = {}
+        self._leaks_reported = set()
+        self._counters = {
+            "checkouts": 0,
+            "waits": 0,
+            "wait_time_total": 0.0,
+            "wait_time_max": 0.0,
+            "timeouts": 0,
+            "overflows": 0,
+            "stale_discarded": 0,
+            "leaks": 0,
+        }
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+
+    def _connect(self):
+        import psycopg2
+        return psycopg2.connect(self.dsn, **self._connect_kwargs)
+
+    def _is_usable(self, conn):
+        if conn.closed:
+            return False
+        idle_since = self._last_used.get(id(conn))
+        if idle_since is None or time.monotonic() - idle_since < self.validate_after:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _take(self):
+        import psycopg2.pool
+        try:
+            conn = self._pool.getconn()
+        except psycopg2.pool.PoolError:
+            # All pooled connections are out but an overflow slot was granted.
+            self._count("overflows")
+            return self._connect(), True
+        if not self._is_usable(conn):
+            self._count("stale_discarded")
+            self._last_used.pop(id(conn), None)
+            self._pool.putconn(conn, close=True)
+            conn = self._pool.getconn()
+        return conn, False
+
+    def getconn(self):
+        start = time.monotonic()
+        if not self._slots.acquire(blocking=False):
+            acquired = self._slots.acquire(timeout=self.checkout_timeout)
+            waited = time.monotonic() - start
+            with self._lock:
+                self._counters["waits"] += 1
+                self._counters["wait_time_total"] += waited
+                self._counters["wait_time_max"] = max(self._counters["wait_time_max"], waited)
+                if not acquired:
+                    self._counters["timeouts"] += 1
+            if not acquired:
+                raise PoolTimeout(f"No database connection available after {self.checkout_timeout:.1f}s")
+        try:
+            conn, is_overflow = self._take()
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._counters["checkouts"] += 1
+            self._checked_out[id(conn)] = (conn, time.monotonic(), is_overflow)
+        return conn
+
+    def putconn(self, conn):
+        with self._lock:
+            entry = self._checked_out.pop(id(conn), None)
+            self._leaks_reported.discard(id(conn))
+        if entry is None:
+            return
+        try:
+            if entry[2] or conn.closed:
+                if entry[2]:
+                    conn.close()
+                else:
+                    self._pool.putconn(conn, close=True)
+                self._last_used.pop(id(conn), None)
+                return
+            from psycopg2 import extensions
+            if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                # Never hand the next caller a half-finished transaction.
+                conn.rollback()
+            self._last_used[id(conn)] = time.monotonic()
+            self._pool.putconn(conn)
+        except Exception:
+            self._last_used.pop(id(conn), None)
+            try:
+                self._pool.putconn(conn, close=True)
+            except Exception:
+                pass
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            in_use = len(self._checked_out)
+            for key, (_, since, _) in self._checked_out.items():
+                if now - since > self.leak_threshold and key not in self._leaks_reported:
+                    self._leaks_reported.add(key)
+                    self._counters["leaks"] += 1
+            long_held = len(self._leaks_reported)
+            snapshot = dict(self._counters)
+        snapshot.update({
+            "max_connections": self.maxconn,
+            "max_overflow": self.max_overflow,
+            "in_use": in_use,
+            "idle": len(self._pool._pool),
+            "long_held": long_held,
+        })
+        return snapshot
+
+    def closeall(self):
+        self._pool.closeall()
@@ -0,0 +1,162 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# numpy is imported inside the functions that need it: it adds ~60 ms to importing
+# api, and only document ingestion ever touches this cache.
+
+# Set to an empty string to disable the on-disk layer
+EMBEDDING_CACHE_PATH = os.environ.get("EMBEDDING_CACHE_PATH", "embedding_cache.sqlite3")
+EMBEDDING_CACHE_MEMORY = int(os.environ.get("EMBEDDING_CACHE_MEMORY", "4096"))
+# Bounds for the SQLite layer (0 disables either); the oldest rows go first.
+# 384 float32 dims is ~1.5 KB a row, so the default caps the file near 150 MB.
+EMBEDDING_CACHE_MAX_ROWS = int(os.environ.get("EMBEDDING_CACHE_MAX_ROWS", "100000"))
+EMBEDDING_CACHE_MAX_AGE_DAYS = float(os.environ.get("EMBEDDING_CACHE_MAX_AGE_DAYS", "90"))
+_SQL_BATCH = 500
+
+
+def content_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """Embeddings keyed by (model name, chunk hash): a small in-memory LRU over SQLite.
+
+    SQLite runs in WAL mode so several gunicorn workers on one host can share the file.
+    Every insert prunes rows older than max_age_days and, past max_rows, the oldest ones.
+    """
+
+    def __init__(self, path=EMBEDDING_CACHE_PATH, memory_entries=EMBEDDING_CACHE_MEMORY,
+                 max_rows=EMBEDDING_CACHE_MAX_ROWS, max_age_days=EMBEDDING_CACHE_MAX_AGE_DAYS):
+        self.path = path
+        self.memory_entries = memory_entries
+        self.max_rows = max_rows
+        self.max_age_days = max_age_days
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self.stats = {"hits": 0, "misses": 0}
+
+    def __len__(self):
+        """Entries held in memory (the SQLite layer is not counted)."""
+        return len(self._memory)
+
+    def _conn(self):
+        if self._db is None and self.path:
+            try:
+                db = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+                db.execute("PRAGMA journal_mode=WAL")
+                db.execute(
+                    """CREATE TABLE IF NOT EXISTS embeddings (
+                           model TEXT NOT NULL,
+                           chunk_hash TEXT NOT NULL,
+                           vector BLOB NOT NULL,
+                           stored_at INTEGER NOT NULL DEFAULT 0,
+                           PRIMARY KEY (model, chunk_hash)
+                       ) WITHOUT ROWID"""
+                )
+                columns = {row[1] for row in db.execute("PRAGMA table_info(embeddings)")}
+                if "stored_at" not in columns:
+                    # Files from before pruning existed: their rows count as oldest
+                    db.execute("ALTER TABLE embeddings ADD COLUMN stored_at INTEGER NOT NULL DEFAULT 0")
+                db.execute("CREATE INDEX IF NOT EXISTS embeddings_stored_at ON embeddings (stored_at)")
+                db.commit()
+                self._db = db
+            except sqlite3.Error as e:
+                # Keep working from memory only (e.g. read-only filesystem)
+                print(f"Warning: Embedding cache disabled ({e})")
+                self.path = ""
+        return self._db
+
+    def _remember(self, key, vector):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def get_many(self, model, hashes):
+        """Return {hash: vector} for the hashes that are cached."""
+        import numpy as np
+        found = {}
+        with self._lock:
+            pending = []
+            for h in hashes:
+                vector = self._memory.get((model, h))
+                if vector is None:
+                    pending.append(h)
+                else:
+                    self._memory.move_to_end((model, h))
+                    found[h] = vector
+            db = self._conn() if pending else None
+            if db is not None:
+                for i in range(0, len(pending), _SQL_BATCH):
+                    batch = pending[i:i + _SQL_BATCH]
+                    placeholders = ",".join("?" for _ in batch)
+                    rows = db.execute(
+                        f"SELECT chunk_hash, vector FROM embeddings WHERE model = ? AND chunk_hash IN ({placeholders})",
+                        [model, *batch]
+                    ).fetchall()
+                    for h, blob in rows:
+                        vector = np.frombuffer(blob, dtype=np.float32)
+                        self._remember((model, h), vector)
+                        found[h] = vector
+            self.stats["hits"] += len(found)
+            self.stats["misses"] += len(hashes) - len(found)
+        return found
+
+    def put_many(self, model, vectors):
+        """Store {hash: vector}."""
+        import numpy as np
+        with self._lock:
+            rows = []
+            for h, vector in vectors.items():
+                vector = np.asarray(vector, dtype=np.float32)
+                self._remember((model, h), vector)
+                rows.append((model, h, vector.tobytes()))
+            db = self._conn()
+            if db is not None and rows:
+                now = int(time.time())
+                db.executemany(
+                    "INSERT OR REPLACE INTO embeddings (model, chunk_hash, vector, stored_at) VALUES (?, ?, ?, ?)",
+                    [(*row, now) for row in rows]
+                )
+                self._prune(db, now)
+                db.commit()
+
+    def _prune(self, db, now):
+        if self.max_age_days:
+            db.execute("DELETE FROM embeddings WHERE stored_at < ?", (now - int(self.max_age_days * 86400),))
+        if self.max_rows:
+            excess = db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0] - self.max_rows
+            if excess > 0:
+                db.execute(
+                    """DELETE FROM embeddings WHERE (model, chunk_hash) IN (
+                           SELECT model, chunk_hash FROM embeddings ORDER BY stored_at LIMIT ?)""",
+                    (excess,)
+                )
+
+
+def embed_with_cache(cache, model, texts, encode):
+    """Embed `texts`, calling `encode(list_of_texts)` only for chunks not seen before.
+
+    Identical chunks inside one call are encoded once as well. Returns an
+    (n, dim) float32 array in input order plus the list of chunk hashes.
+    """
+    import numpy as np
+    hashes = [content_hash(t) for t in texts]
+    found = cache.get_many(model, list(dict.fromkeys(hashes)))
+    missing = {}
+    for h, text in zip(hashes, texts):
+        if h not in found and h not in missing:
+            missing[h] = text
+    if missing:
+        encoded = encode(list(missing.values()))
+        fresh = dict(zip(missing.keys(), (np.asarray(v, dtype=np.float32) for v in encoded)))
+        cache.put_many(model, fresh)
+        found.update(fresh)
+    if not texts:
+        return np.zeros((0, 0), dtype=np.float32), hashes
+    return np.stack([found[h] for h in hashes]), hashes
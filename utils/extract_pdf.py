@@ -8,7 +8,10 @@ def extract_text_from_pdf(file_path):
     # Method 1: Try standard extraction with pdfplumber
     try:
         with pdfplumber.open(file_path) as pdf:
-            for page in pdf.pages:
+            for page_idx, page in enumerate(pdf.pages):
+                # Form feed between pages lets the chunker keep track of page numbers
+                if page_idx > 0:
+                    text += "\f"
                 # 1. First extract text
                 extracted = page.extract_text()
                 if extracted:
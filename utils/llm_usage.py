@@ -0,0 +1,351 @@
+"""Per-user LLM token and cost accounting, and daily token budgets.
+
+Every completion is buffered in memory by record() and written in batches by a
+background thread: one row per call into llm_usage (who, which feature, model,
+tokens, prompt-cache hits, latency, cost), plus an upsert into the per-user
+per-day rollup llm_user_daily that budgets and the admin panel read.
+
+Budgets are soft: a user's spend is the rollup row (re-read at most every
+USAGE_BUDGET_TTL seconds) plus what this process has not flushed yet, so other
+workers' latest calls can be missed for a few seconds.
+
+Days are UTC days everywhere (created_at is stored in UTC, and budgets reset at
+UTC midnight), so Python and SQL always agree on what "today" is.
+"""
+import datetime
+import json
+import os
+import threading
+import time
+
+USAGE_FLUSH_INTERVAL = float(os.environ.get("USAGE_FLUSH_INTERVAL", "5"))
+USAGE_BATCH_SIZE = int(os.environ.get("USAGE_BATCH_SIZE", "200"))
+USAGE_BUDGET_TTL = float(os.environ.get("USAGE_BUDGET_TTL", "30"))
+# Rows kept in memory while the database is unreachable; the oldest are dropped beyond this
+USAGE_MAX_PENDING = 20000
+# Daily token budgets (prompt + completion); 0 disables. Admins are never limited.
+DAILY_TOKEN_BUDGET = int(os.environ.get("DAILY_TOKEN_BUDGET", "0"))
+PREMIUM_DAILY_TOKEN_BUDGET = int(os.environ.get("PREMIUM_DAILY_TOKEN_BUDGET", "0"))
+# USD per million (prompt, completion) tokens; extend or override with MODEL_PRICES='{"model": [in, out]}'
+MODEL_PRICES = {"openai/gpt-4o-mini": (0.15, 0.60)}
+MODEL_PRICES.update({k: tuple(v) for k, v in json.loads(os.environ.get("MODEL_PRICES", "{}")).items()})
+
+SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS llm_usage (
+        id BIGSERIAL PRIMARY KEY,
+        created_at TIMESTAMP NOT NULL DEFAULT (NOW() AT TIME ZONE 'UTC'),
+        user_id INTEGER,
+        feature VARCHAR(50),
+        model VARCHAR(100) NOT NULL,
+        prompt_tokens INTEGER NOT NULL DEFAULT 0,
+        completion_tokens INTEGER NOT NULL DEFAULT 0,
+        cached_tokens INTEGER NOT NULL DEFAULT 0,
+        latency_ms INTEGER NOT NULL DEFAULT 0,
+        ok BOOLEAN NOT NULL DEFAULT TRUE,
+        cost_usd NUMERIC(12, 6) NOT NULL DEFAULT 0
+    )
+    ''',
+    "CREATE INDEX IF NOT EXISTS idx_llm_usage_user_created ON llm_usage (user_id, created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_llm_usage_created ON llm_usage (created_at)",
+    '''
+    CREATE TABLE IF NOT EXISTS llm_user_daily (
+        user_id INTEGER NOT NULL,
+        day DATE NOT NULL,
+        calls INTEGER NOT NULL DEFAULT 0,
+        prompt_tokens BIGINT NOT NULL DEFAULT 0,
+        completion_tokens BIGINT NOT NULL DEFAULT 0,
+        cached_tokens BIGINT NOT NULL DEFAULT 0,
+        cost_usd NUMERIC(14, 6) NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, day)
+    )
+    ''',
+]
+
+_pending = []
+_pending_lock = threading.Lock()
+_flush_wanted = threading.Event()
+# user_id -> (day, tokens in llm_user_daily, read at monotonic time)
+_spent_cache = {}
+_schema_ready = False
+_flusher = None
+_flusher_lock = threading.Lock()
+
+
+def ensure_schema(conn):
+    global _schema_ready
+    if _schema_ready:
+        return
+    c = conn.cursor()
+    try:
+        for statement in SCHEMA:
+            c.execute(statement)
+        conn.commit()
+        _schema_ready = True
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        c.close()
+
+
+def _utcnow():
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def _today():
+    return _utcnow().date()
+
+
+def cost_usd(model, prompt_tokens, completion_tokens):
+    price_in, price_out = MODEL_PRICES.get(model, (0.0, 0.0))
+    return (prompt_tokens * price_in + completion_tokens * price_out) / 1_000_000
+
+
+def cached_tokens(usage):
+    """Prompt tokens served from the provider's prompt cache (0 when not reported)."""
+    details = getattr(usage, "prompt_tokens_details", None)
+    return (getattr(details, "cached_tokens", None) or 0) if details is not None else 0
+
+
+def record(model, seconds, usage=None, ok=True, user_id=None, feature=None):
+    """Buffer one completion; the flusher writes it to llm_usage shortly after."""
+    prompt = (usage.prompt_tokens or 0) if usage is not None else 0
+    completion = (usage.completion_tokens or 0) if usage is not None else 0
+    try:
+        user_id = int(user_id) if user_id is not None else None
+    except (TypeError, ValueError):
+        user_id = None
+    now = _utcnow()
+    row = {
+        "created_at": now,
+        "day": now.date(),
+        "user_id": user_id,
+        "feature": feature,
+        "model": model,
+        "prompt_tokens": prompt,
+        "completion_tokens": completion,
+        "cached_tokens": cached_tokens(usage) if usage is not None else 0,
+        "latency_ms": int(seconds * 1000),
+        "ok": ok,
+        "cost_usd": cost_usd(model, prompt, completion),
+    }
+    with _pending_lock:
+        _pending.append(row)
+        if len(_pending) >= USAGE_BATCH_SIZE:
+            _flush_wanted.set()
+
+
+def flush(conn):
+    """Write the buffered rows in one transaction; returns how many were written."""
+    global _pending
+    with _pending_lock:
+        if not _pending:
+            return 0
+    # Before the batch is taken: if this fails the rows are still pending
+    ensure_schema(conn)
+    with _pending_lock:
+        batch, _pending = _pending, []
+    if not batch:
+        return 0
+    c = conn.cursor()
+    try:
+        c.executemany(
+            """INSERT INTO llm_usage (created_at, user_id, feature, model, prompt_tokens, completion_tokens,
+                                      cached_tokens, latency_ms, ok, cost_usd)
+               VALUES (%(created_at)s, %(user_id)s, %(feature)s, %(model)s, %(prompt_tokens)s, %(completion_tokens)s,
+                       %(cached_tokens)s, %(latency_ms)s, %(ok)s, %(cost_usd)s)""",
+            batch
+        )
+        daily = _by_user_day(batch)
+        c.executemany(
+            """INSERT INTO llm_user_daily (user_id, day, calls, prompt_tokens, completion_tokens, cached_tokens, cost_usd)
+               VALUES (%s, %s, %s, %s, %s, %s, %s)
+               ON CONFLICT (user_id, day) DO UPDATE SET
+                   calls = llm_user_daily.calls + EXCLUDED.calls,
+                   prompt_tokens = llm_user_daily.prompt_tokens + EXCLUDED.prompt_tokens,
+                   completion_tokens = llm_user_daily.completion_tokens + EXCLUDED.completion_tokens,
+                   cached_tokens = llm_user_daily.cached_tokens + EXCLUDED.cached_tokens,
+                   cost_usd = llm_user_daily.cost_usd + EXCLUDED.cost_usd""",
+            [(user_id, day, *totals) for (user_id, day), totals in daily.items()]
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        with _pending_lock:
+            _pending = (batch + _pending)[-USAGE_MAX_PENDING:]
+        raise
+    finally:
+        c.close()
+    committed = time.monotonic()
+    # The flushed tokens now live in the rollup; move them into cached figures read before the commit
+    with _pending_lock:
+        for (user_id, day), totals in daily.items():
+            cached = _spent_cache.get(user_id)
+            if cached and cached[0] == day and cached[2] < committed:
+                _spent_cache[user_id] = (day, cached[1] + totals[1] + totals[2], cached[2])
+    return len(batch)
+
+
+def _by_user_day(rows):
+    totals = {}
+    for row in rows:
+        if row["user_id"] is None:
+            continue
+        entry = totals.setdefault((row["user_id"], row["day"]), [0, 0, 0, 0, 0.0])
+        entry[0] += 1
+        entry[1] += row["prompt_tokens"]
+        entry[2] += row["completion_tokens"]
+        entry[3] += row["cached_tokens"]
+        entry[4] += row["cost_usd"]
+    return totals
+
+
+def tokens_today(conn, user_id):
+    """Prompt + completion tokens the user has spent today (see the module note on staleness)."""
+    user_id = int(user_id)
+    day = _today()
+    with _pending_lock:
+        cached = _spent_cache.get(user_id)
+        unflushed = sum(r["prompt_tokens"] + r["completion_tokens"] for r in _pending
+                        if r["user_id"] == user_id and r["day"] == day)
+    if cached and cached[0] == day and time.monotonic() - cached[2] < USAGE_BUDGET_TTL:
+        return cached[1] + unflushed
+
+    ensure_schema(conn)
+    c = conn.cursor()
+    try:
+        c.execute("SELECT prompt_tokens + completion_tokens FROM llm_user_daily WHERE user_id = %s AND day = %s",
+                  (user_id, day))
+        row = c.fetchone()
+    finally:
+        c.close()
+    stored = int(row[0]) if row else 0
+    with _pending_lock:
+        _spent_cache[user_id] = (day, stored, time.monotonic())
+    return stored + unflushed
+
+
+def budgets_enabled():
+    return bool(DAILY_TOKEN_BUDGET or PREMIUM_DAILY_TOKEN_BUDGET)
+
+
+def budget_for(status):
+    """Daily token budget for a user status from quota (None = unlimited)."""
+    if status is None or status["role"] == "admin":
+        return None
+    budget = PREMIUM_DAILY_TOKEN_BUDGET if status["is_premium"] else DAILY_TOKEN_BUDGET
+    return budget or None
+
+
+def check_budget(conn, user_id, status):
+    """Returns (allowed, tokens spent today, budget); spend isn't read when there is no budget."""
+    budget = budget_for(status)
+    if budget is None:
+        return True, None, None
+    spent = tokens_today(conn, user_id)
+    return spent < budget, spent, budget
+
+
+def seconds_until_reset():
+    """Seconds until the budgets reset at UTC midnight."""
+    now = _utcnow()
+    tomorrow = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time())
+    return max(1, int((tomorrow - now).total_seconds()))
+
+
+def user_summary(conn, user_id, days=30):
+    """Daily totals plus per-feature/model breakdown for one user."""
+    ensure_schema(conn)
+    from psycopg2.extras import RealDictCursor
+    c = conn.cursor(cursor_factory=RealDictCursor)
+    try:
+        c.execute(
+            """SELECT day, calls, prompt_tokens, completion_tokens, cached_tokens, cost_usd
+               FROM llm_user_daily WHERE user_id = %s AND day >= (NOW() AT TIME ZONE 'UTC')::date - %s ORDER BY day""",
+            (user_id, days)
+        )
+        daily = [dict(r) for r in c.fetchall()]
+        c.execute(
+            """SELECT feature, model, COUNT(*) AS calls, SUM(prompt_tokens) AS prompt_tokens,
+                      SUM(completion_tokens) AS completion_tokens, SUM(cached_tokens) AS cached_tokens,
+                      SUM(cost_usd) AS cost_usd, AVG(latency_ms)::INTEGER AS avg_latency_ms,
+                      SUM(CASE WHEN ok THEN 0 ELSE 1 END) AS errors
+               FROM llm_usage WHERE user_id = %s AND created_at >= (NOW() AT TIME ZONE 'UTC')::date - %s
+               GROUP BY feature, model ORDER BY SUM(cost_usd) DESC""",
+            (user_id, days)
+        )
+        by_feature = [dict(r) for r in c.fetchall()]
+    finally:
+        c.close()
+    for row in daily + by_feature:
+        row["cost_usd"] = float(row["cost_usd"] or 0)
+    return {"daily": daily, "by_feature": by_feature}
+
+
+def top_users(conn, days=30, limit=20):
+    """Heaviest users by tokens over the last `days` days, from the daily rollup."""
+    ensure_schema(conn)
+    from psycopg2.extras import RealDictCursor
+    c = conn.cursor(cursor_factory=RealDictCursor)
+    try:
+        c.execute(
+            """SELECT d.user_id, u.username, SUM(d.calls) AS calls,
+                      SUM(d.prompt_tokens + d.completion_tokens) AS tokens,
+                      SUM(d.cached_tokens) AS cached_tokens, SUM(d.cost_usd) AS cost_usd
+               FROM llm_user_daily d LEFT JOIN users u ON u.id = d.user_id
+               WHERE d.day >= (NOW() AT TIME ZONE 'UTC')::date - %s
+               GROUP BY d.user_id, u.username ORDER BY tokens DESC LIMIT %s""",
+            (days, limit)
+        )
+        rows = [dict(r) for r in c.fetchall()]
+    finally:
+        c.close()
+    for row in rows:
+        row["cost_usd"] = float(row["cost_usd"] or 0)
+    return rows
+
+
+def daily_by_model(conn, days=30):
+    """Calls, errors, latency, tokens and cost per day and model, for the admin dashboard."""
+    ensure_schema(conn)
+    from psycopg2.extras import RealDictCursor
+    c = conn.cursor(cursor_factory=RealDictCursor)
+    try:
+        c.execute(
+            """SELECT created_at::date AS day, model, COUNT(*) AS calls,
+                      SUM(CASE WHEN ok THEN 0 ELSE 1 END) AS errors, SUM(latency_ms) AS total_latency_ms,
+                      SUM(prompt_tokens + completion_tokens) AS tokens, SUM(cost_usd) AS cost_usd
+               FROM llm_usage WHERE created_at >= (NOW() AT TIME ZONE 'UTC')::date - %s
+               GROUP BY created_at::date, model ORDER BY day, model""",
+            (days,)
+        )
+        rows = [dict(r) for r in c.fetchall()]
+    finally:
+        c.close()
+    for row in rows:
+        row["cost_usd"] = float(row["cost_usd"] or 0)
+    return rows
+
+
+def start_flusher(connection_factory, interval=None):
+    """Start the background writer once per process (connection_factory as in admin_analytics)."""
+    global _flusher
+    interval = interval or USAGE_FLUSH_INTERVAL
+    with _flusher_lock:
+        if _flusher is not None and _flusher.is_alive():
+            return _flusher
+
+        def run():
+            while True:
+                _flush_wanted.wait(interval)
+                _flush_wanted.clear()
+                try:
+                    with connection_factory() as conn:
+                        flush(conn)
+                except Exception as e:
+                    print(f"Warning: LLM usage flush failed ({e})")
+
+        _flusher = threading.Thread(target=run, name="llm-usage", daemon=True)
+        _flusher.start()
+        return _flusher
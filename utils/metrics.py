@@ -0,0 +1,304 @@
+"""In-process metrics rendered in the Prometheus text exposition format.
+
+Counters, gauges and histograms are plain dicts behind a lock, so recording one
+costs about as much as a dict update. Values that already live elsewhere (cache
+and connection pool counters) are copied in by collector callbacks at scrape time.
+
+With several gunicorn workers, set METRICS_DIR to a directory shared by them:
+each worker then writes its snapshot to <METRICS_DIR>/metrics_<pid>.json
+(on every scrape and every METRICS_FLUSH_INTERVAL seconds), and a scrape served
+by any worker merges all files. Counters and histograms are summed over every
+file, gauges only over workers that are still alive.
+"""
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_DIR = os.environ.get("METRICS_DIR", "")
+METRICS_FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", "10"))
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_registry = []
+_collectors = []
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set_total(self, value, **labels):
+        """Mirror a cumulative count kept somewhere else (used by collectors)."""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track(self, **labels):
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    def track_iter(self, iterable, **labels):
+        """Count a streamed response body as in flight from its first chunk until it is closed."""
+        with self.track(**labels):
+            yield from iterable
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            # [count per bucket..., count above the last bucket, sum]
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[len(self.buckets)] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self._lock:
+            return [[list(key), list(value)] for key, value in self._values.items()]
+
+
+def register_collector(fn):
+    """Call `fn()` before every snapshot, to copy externally kept values into metrics."""
+    _collectors.append(fn)
+    return fn
+
+
+def snapshot():
+    for fn in _collectors:
+        try:
+            fn()
+        except Exception as e:
+            print(f"Warning: metrics collector {getattr(fn, '__name__', fn)} failed ({e})")
+    return {
+        m.name: {
+            "kind": m.kind,
+            "help": m.documentation,
+            "labels": list(m.labelnames),
+            "buckets": list(getattr(m, "buckets", ())),
+            "samples": m.samples(),
+        }
+        for m in _registry
+    }
+
+
+# Multiprocess mode
+
+def _dump_path(pid=None):
+    return os.path.join(METRICS_DIR, f"metrics_{pid or os.getpid()}.json")
+
+
+def dump():
+    """Write this process's snapshot to METRICS_DIR (atomically, via rename)."""
+    path = _dump_path()
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(snapshot(), f)
+    os.replace(tmp, path)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+
+def _merge(snapshots):
+    merged = {}
+    for pid, snap in snapshots:
+        alive = None
+        for name, metric in snap.items():
+            if metric["kind"] == "gauge":
+                if alive is None:
+                    alive = _alive(pid)
+                if not alive:
+                    continue
+            target = merged.setdefault(name, dict(metric, samples={}))
+            for labels, value in metric["samples"]:
+                key = tuple(labels)
+                if key not in target["samples"]:
+                    target["samples"][key] = value
+                elif metric["kind"] == "histogram":
+                    target["samples"][key] = [a + b for a, b in zip(target["samples"][key], value)]
+                else:
+                    target["samples"][key] += value
+    for metric in merged.values():
+        metric["samples"] = [[list(k), v] for k, v in metric["samples"].items()]
+    return merged
+
+
+def collect():
+    """Snapshot of every metric: this process only, or merged across workers in multiprocess mode."""
+    if not METRICS_DIR:
+        return snapshot()
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    dump()
+    snapshots = []
+    for path in glob.glob(os.path.join(METRICS_DIR, "metrics_*.json")):
+        try:
+            pid = int(os.path.basename(path)[len("metrics_"):-len(".json")])
+            with open(path) as f:
+                snapshots.append((pid, json.load(f)))
+        except (ValueError, OSError):
+            continue  # half-written or just removed
+    return _merge(snapshots)
+
+
+def start_flusher():
+    """Keep this worker's file fresh even when scrapes land on other workers."""
+    if not METRICS_DIR:
+        return None
+
+    def loop():
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        while True:
+            try:
+                dump()
+            except Exception as e:
+                print(f"Warning: metrics flush failed ({e})")
+            time.sleep(METRICS_FLUSH_INTERVAL)
+
+    thread = threading.Thread(target=loop, name="metrics-flusher", daemon=True)
+    thread.start()
+    return thread
+
+
+def clear_dir():
+    """Remove snapshots left by a previous server run (called from the gunicorn master)."""
+    if METRICS_DIR:
+        for path in glob.glob(os.path.join(METRICS_DIR, "metrics_*.json*")):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+# Text format
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in list(zip(names, values)) + list(extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def render(metrics=None):
+    metrics = collect() if metrics is None else metrics
+    lines = []
+    for name in sorted(metrics):
+        metric = metrics[name]
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['kind']}")
+        for labels, value in sorted(metric["samples"]):
+            if metric["kind"] != "histogram":
+                lines.append(f"{name}{_labels(metric['labels'], labels)} {_number(value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip(metric["buckets"] + [float("inf")], value[:-1]):
+                cumulative += count
+                le = (("le", _number(float(bound))),)
+                lines.append(f"{name}_bucket{_labels(metric['labels'], labels, le)} {cumulative}")
+            lines.append(f"{name}_sum{_labels(metric['labels'], labels)} {_number(value[-1])}")
+            lines.append(f"{name}_count{_labels(metric['labels'], labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+# Application metrics
+
+HTTP_REQUESTS = Counter("omnidoc_http_requests_total", "HTTP requests by route, method and status.", ("route", "method", "status"))
+HTTP_LATENCY = Histogram("omnidoc_http_request_duration_seconds", "Time until the response (headers, for streams) is ready.", ("route", "method"))
+HTTP_IN_FLIGHT = Gauge("omnidoc_http_requests_in_flight", "Requests currently being handled.")
+SSE_STREAMS = Gauge("omnidoc_sse_streams_in_flight", "Chat answers currently being streamed.")
+LLM_LATENCY = Histogram("omnidoc_llm_request_duration_seconds", "LLM call duration by model and outcome.", ("model", "outcome"))
+LLM_TOKENS = Counter("omnidoc_llm_tokens_total", "Tokens reported by the LLM API.", ("model", "kind"))
+EXTRACTION_LATENCY = Histogram("omnidoc_extraction_duration_seconds", "Text extraction time by file type.", ("type",))
+EMBEDDING_JOBS = Gauge("omnidoc_embedding_jobs_in_flight", "Background document embedding jobs queued or running.")
+CACHE_HITS = Counter("omnidoc_cache_hits_total", "Cache hits by cache.", ("cache",))
+CACHE_MISSES = Counter("omnidoc_cache_misses_total", "Cache misses by cache.", ("cache",))
+CACHE_ENTRIES = Gauge("omnidoc_cache_entries", "Entries held in memory by cache.", ("cache",))
+DB_POOL_CONNECTIONS = Gauge("omnidoc_db_pool_connections", "Pooled database connections by state.", ("state",))
+DB_POOL_EVENTS = Counter("omnidoc_db_pool_events_total", "Connection pool events (checkouts, waits, timeouts, ...).", ("event",))
+DB_POOL_WAIT = Counter("omnidoc_db_pool_wait_seconds_total", "Total time spent waiting for a pooled connection.")
@@ -0,0 +1,107 @@
+"""ONNX Runtime stand-ins for the SentenceTransformer embedder and CrossEncoder reranker.
+
+They load a model directory written by export_onnx.py (model.onnx, optionally
+model_quantized.onnx, and tokenizer.json) and expose the same encode()/predict()
+calls api.py already uses, without importing torch.
+"""
+import os
+
+import numpy as np
+
+ONNX_QUANTIZED = os.environ.get("ONNX_QUANTIZED", "1") == "1"
+
+
+def model_file(model_dir, quantized=ONNX_QUANTIZED):
+    quantized_path = os.path.join(model_dir, "model_quantized.onnx")
+    if quantized and os.path.exists(quantized_path):
+        return quantized_path
+    return os.path.join(model_dir, "model.onnx")
+
+
+def _session(path, num_threads):
+    import onnxruntime as ort
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if num_threads:
+        options.intra_op_num_threads = num_threads
+        options.inter_op_num_threads = 1
+    return ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+
+def _tokenizer(model_dir, max_length):
+    from tokenizers import Tokenizer
+    tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+    tokenizer.enable_truncation(max_length=max_length)
+    pad_id = tokenizer.token_to_id("[PAD]") or 0
+    tokenizer.enable_padding(pad_id=pad_id, pad_token="[PAD]")
+    return tokenizer
+
+
+class _OnnxModel:
+    def __init__(self, model_dir, max_length, batch_size=32, num_threads=0, quantized=ONNX_QUANTIZED):
+        self.path = model_file(model_dir, quantized)
+        self.quantized = self.path.endswith("model_quantized.onnx")
+        self.batch_size = batch_size
+        self.session = _session(self.path, num_threads)
+        self.tokenizer = _tokenizer(model_dir, max_length)
+        self._input_names = {i.name for i in self.session.get_inputs()}
+
+    def _run(self, encodings):
+        feeds = {
+            "input_ids": np.array([e.ids for e in encodings], dtype=np.int64),
+            "attention_mask": np.array([e.attention_mask for e in encodings], dtype=np.int64),
+        }
+        if "token_type_ids" in self._input_names:
+            feeds["token_type_ids"] = np.array([e.type_ids for e in encodings], dtype=np.int64)
+        return self.session.run(None, feeds)[0], feeds["attention_mask"]
+
+    def _batched(self, inputs, lengths, run_batch, batch_size):
+        """Run batches of similar length (less padding), then restore input order."""
+        batch_size = batch_size or self.batch_size
+        order = np.argsort(lengths, kind="stable")
+        results = [None] * len(inputs)
+        for start in range(0, len(order), batch_size):
+            idx = order[start:start + batch_size]
+            for i, row in zip(idx, run_batch([inputs[i] for i in idx])):
+                results[i] = row
+        return results
+
+
+class OnnxEmbedder(_OnnxModel):
+    """Mean-pooled, L2-normalised sentence embeddings, matching all-MiniLM-L6-v2's pipeline."""
+
+    def __init__(self, model_dir, max_length=256, **kwargs):
+        super().__init__(model_dir, max_length, **kwargs)
+
+    def _embed(self, texts):
+        hidden, mask = self._run(self.tokenizer.encode_batch(texts))
+        mask = mask[..., None].astype(np.float32)
+        pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        return pooled / np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+
+    def encode(self, sentences, batch_size=None, convert_to_numpy=True, **kwargs):
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        rows = self._batched(texts, [len(t) for t in texts], self._embed, batch_size)
+        embeddings = np.vstack(rows).astype(np.float32)
+        return embeddings[0] if single else embeddings
+
+
+class OnnxCrossEncoder(_OnnxModel):
+    """Relevance logits for (query, passage) pairs, like CrossEncoder.predict()."""
+
+    def __init__(self, model_dir, max_length=512, **kwargs):
+        super().__init__(model_dir, max_length, **kwargs)
+
+    def _score(self, pairs):
+        logits, _ = self._run(self.tokenizer.encode_batch([(q, p) for q, p in pairs]))
+        return logits[:, 0]
+
+    def predict(self, sentences, batch_size=None, **kwargs):
+        pairs = [tuple(p) for p in sentences]
+        if not pairs:
+            return np.zeros((0,), dtype=np.float32)
+        rows = self._batched(pairs, [len(q) + len(p) for q, p in pairs], self._score, batch_size)
+        return np.array(rows, dtype=np.float32)
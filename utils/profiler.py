@@ -0,0 +1,267 @@
+"""Opt-in request profiling: per-stage timings plus a sampling stack profiler.
+
+Nothing is recorded unless one of these is switched on (per worker process):
+
+- PROFILE_SAMPLE_RATE: fraction of requests that are stack-sampled every
+  PROFILE_INTERVAL_MS and kept.
+- PROFILE_TOKEN: a request sending `X-Profile: <token>` is sampled and kept.
+- PROFILE_SLOW_MS: every request is timed per stage and sampled at the coarser
+  PROFILE_SLOW_INTERVAL_MS; the ones slower than the threshold are kept.
+
+Stages (extraction, llm, db, rag) are added up by `stage()`/`add()` from anywhere
+in the request, including worker threads started through `bind()`. Stacks are
+taken with sys._current_frames() from a single sampler thread, so the request
+threads themselves run uninstrumented, and are kept in the collapsed format
+("frame;frame;frame count") that flamegraph.pl and speedscope read directly.
+The last PROFILE_KEEP captures stay in memory for the admin endpoints.
+"""
+import collections
+import contextvars
+import hmac
+import itertools
+import os
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN", "")
+PROFILE_SLOW_MS = float(os.environ.get("PROFILE_SLOW_MS", "0"))
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", "5"))
+PROFILE_SLOW_INTERVAL_MS = float(os.environ.get("PROFILE_SLOW_INTERVAL_MS", "50"))
+PROFILE_KEEP = int(os.environ.get("PROFILE_KEEP", "50"))
+PROFILE_MAX_STACKS = 5000
+STAGES = ("extraction", "llm", "db", "rag")
+
+# Runtime settings, changed through configure() (the admin toggle)
+settings = {
+    "sample_rate": PROFILE_SAMPLE_RATE,
+    "slow_ms": PROFILE_SLOW_MS,
+    "interval_ms": PROFILE_INTERVAL_MS,
+    "slow_interval_ms": PROFILE_SLOW_INTERVAL_MS,
+}
+
+_current = contextvars.ContextVar("omnidoc_profile", default=None)
+_ids = itertools.count(1)
+_active = set()
+_active_lock = threading.Lock()
+_wakeup = threading.Event()
+_sampler = None
+_captures = collections.deque(maxlen=PROFILE_KEEP)
+_captures_lock = threading.Lock()
+
+
+class Profile:
+    def __init__(self, method, path, reason, interval):
+        self.id = f"{os.getpid()}-{next(_ids)}"
+        self.method = method
+        self.path = path
+        self.route = None
+        self.status = None
+        self.reason = reason  # "header", "sampled" or None (slow capture only)
+        self.interval = interval
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.response_ms = None
+        self.stages = dict.fromkeys(STAGES, 0.0)
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.threads = {threading.get_ident()}
+        self.next_sample = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def record_stack(self, stack):
+        with self._lock:
+            if stack in self.stacks or len(self.stacks) < PROFILE_MAX_STACKS:
+                self.stacks[stack] += 1
+            else:
+                self.stacks["[truncated]"] += 1
+            self.samples += 1
+
+    def summary(self, duration_ms):
+        stages_ms = {name: round(seconds * 1000, 1) for name, seconds in self.stages.items()}
+        # Stages running in parallel (the two analyze calls) can add up to more than the wall time
+        stages_ms["other"] = round(max(0.0, duration_ms - sum(stages_ms.values())), 1)
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "route": self.route,
+            "status": self.status,
+            "reason": self.reason or "slow",
+            "started_at": self.started_at,
+            "duration_ms": round(duration_ms, 1),
+            "response_ms": self.response_ms,
+            "stages_ms": stages_ms,
+            "samples": self.samples,
+        }
+
+
+def configure(**changes):
+    """Update the runtime settings; unknown keys raise ValueError."""
+    unknown = set(changes) - set(settings)
+    if unknown:
+        raise ValueError(f"Unknown profiling settings: {', '.join(sorted(unknown))}")
+    for key, value in changes.items():
+        value = float(value)
+        if value < 0 or (key == "sample_rate" and value > 1):
+            raise ValueError(f"Invalid value for {key}: {value}")
+        settings[key] = value
+    return dict(settings)
+
+
+def begin(method, path, profile_header=None):
+    """Start profiling the current request if any trigger applies; returns the Profile or None."""
+    if PROFILE_TOKEN and profile_header and hmac.compare_digest(profile_header.encode(), PROFILE_TOKEN.encode()):
+        reason, interval = "header", settings["interval_ms"]
+    elif settings["sample_rate"] and random.random() < settings["sample_rate"]:
+        reason, interval = "sampled", settings["interval_ms"]
+    elif settings["slow_ms"]:
+        reason, interval = None, settings["slow_interval_ms"]
+    else:
+        # A thread serves many requests: don't leave an earlier one's profile current
+        _current.set(None)
+        return None
+    profile = Profile(method, path, reason, interval / 1000)
+    _current.set(profile)
+    if profile.interval > 0:
+        with _active_lock:
+            _active.add(profile)
+        _ensure_sampler()
+    return profile
+
+
+def finish(profile):
+    """Stop profiling; keep the capture if it was requested or the request was slow."""
+    duration_ms = (time.perf_counter() - profile.started) * 1000
+    with _active_lock:
+        _active.discard(profile)
+    if _current.get() is profile:
+        _current.set(None)
+    if profile.reason or (settings["slow_ms"] and duration_ms >= settings["slow_ms"]):
+        with _captures_lock:
+            _captures.append((profile.summary(duration_ms), profile))
+    return duration_ms
+
+
+def current():
+    return _current.get()
+
+
+def add(name, seconds):
+    profile = _current.get()
+    if profile is not None:
+        profile.add(name, seconds)
+
+
+@contextmanager
+def stage(name):
+    profile = _current.get()
+    if profile is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add(name, time.perf_counter() - started)
+
+
+def bind(fn):
+    """Wrap `fn` to run in another thread as part of the current request's profile."""
+    profile = _current.get()
+    if profile is None:
+        return fn
+
+    def run(*args, **kwargs):
+        ident = threading.get_ident()
+        token = _current.set(profile)
+        with profile._lock:
+            profile.threads.add(ident)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with profile._lock:
+                profile.threads.discard(ident)
+            _current.reset(token)
+
+    return run
+
+
+# Sampler
+
+def _frame_label(frame):
+    code = frame.f_code
+    parts = code.co_filename.replace("\\", "/").rsplit("/", 2)
+    return f"{code.co_name} ({'/'.join(parts[-2:])})"
+
+
+def _collapse(frame):
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+
+def _sample_loop():
+    while True:
+        with _active_lock:
+            profiles = list(_active)
+        if not profiles:
+            _wakeup.wait()
+            _wakeup.clear()
+            continue
+        now = time.perf_counter()
+        due = [p for p in profiles if p.next_sample <= now]
+        if due:
+            frames = sys._current_frames()
+            for profile in due:
+                profile.next_sample = now + profile.interval
+                with profile._lock:
+                    threads = list(profile.threads)
+                for ident in threads:
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        profile.record_stack(_collapse(frame))
+            del frames
+        time.sleep(max(0.001, min(p.next_sample for p in profiles) - time.perf_counter()))
+
+
+def _ensure_sampler():
+    global _sampler
+    if _sampler is None or not _sampler.is_alive():
+        with _active_lock:
+            if _sampler is None or not _sampler.is_alive():
+                _sampler = threading.Thread(target=_sample_loop, name="profiler-sampler", daemon=True)
+                _sampler.start()
+    _wakeup.set()
+
+
+# Captures
+
+def recent(reason=None):
+    """Summaries of the kept captures, newest first."""
+    with _captures_lock:
+        items = [summary for summary, _ in _captures]
+    if reason:
+        items = [s for s in items if s["reason"] == reason]
+    return items[::-1]
+
+
+def collapsed_stacks(profile_id):
+    """The capture's stacks as collapsed text, or None if it is no longer kept."""
+    with _captures_lock:
+        for summary, profile in _captures:
+            if summary["id"] == profile_id:
+                break
+        else:
+            return None
+    with profile._lock:
+        return "".join(f"{stack} {count}\n" for stack, count in profile.stacks.most_common())
@@ -0,0 +1,131 @@
+import os
+import threading
+import time
+
+
+FREE_TIER_LIMIT = int(os.environ.get("FREE_TIER_LIMIT", "4"))
+USER_STATUS_TTL = float(os.environ.get("USER_STATUS_TTL", "60"))
+
+# user_id -> (expires_at, {"role": ..., "is_premium": ...})
+_status_cache = {}
+_status_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0}
+
+
+def _is_unlimited(status):
+    return status["role"] == "admin" or bool(status["is_premium"])
+
+
+def get_cached_status(user_id):
+    """Return the cached role/premium status for a user, or None if missing or expired."""
+    key = int(user_id)
+    with _status_lock:
+        entry = _status_cache.get(key)
+        if entry is None:
+            _stats["misses"] += 1
+            return None
+        if entry[0] < time.monotonic():
+            del _status_cache[key]
+            _stats["misses"] += 1
+            return None
+        _stats["hits"] += 1
+        return entry[1]
+
+
+def cache_status(user_id, role, is_premium):
+    status = {"role": role, "is_premium": bool(is_premium)}
+    with _status_lock:
+        _status_cache[int(user_id)] = (time.monotonic() + USER_STATUS_TTL, status)
+    return status
+
+
+def invalidate_status(user_id=None):
+    """Drop one user's cached status (or everyone's) after a role/premium change."""
+    with _status_lock:
+        if user_id is None:
+            _status_cache.clear()
+        else:
+            _status_cache.pop(int(user_id), None)
+
+
+def stats():
+    with _status_lock:
+        return dict(_stats, entries=len(_status_cache))
+
+
+def check_quota(conn, user_id):
+    """Read-only quota check used by Studio generations, which do not consume a slot.
+
+    Returns (status, analysis_count, allowed); status is None if the user does not exist.
+    Premium/admin users are answered from the status cache without touching the DB.
+    """
+    status = get_cached_status(user_id)
+    if status is not None and _is_unlimited(status):
+        return status, None, True
+
+    from psycopg2.extras import RealDictCursor
+    c = conn.cursor(cursor_factory=RealDictCursor)
+    try:
+        c.execute("SELECT role, analysis_count, is_premium FROM users WHERE id = %s", (user_id,))
+        row = c.fetchone()
+    finally:
+        c.close()
+    if not row:
+        return None, None, False
+    status = cache_status(user_id, row["role"], row["is_premium"])
+    allowed = _is_unlimited(status) or row["analysis_count"] < FREE_TIER_LIMIT
+    return status, row["analysis_count"], allowed
+
+
+def reserve_slot(conn, user_id):
+    """Atomically consume one analysis slot.
+
+    A single conditional UPDATE both checks the free-tier limit and increments the
+    counter, so concurrent uploads can never push a free user past the limit.
+    Returns (status, analysis_count, allowed); status is None if the user does not exist.
+    """
+    from psycopg2.extras import RealDictCursor
+    c = conn.cursor(cursor_factory=RealDictCursor)
+    try:
+        c.execute(
+            """UPDATE users SET analysis_count = analysis_count + 1
+               WHERE id = %s AND (role = 'admin' OR is_premium = 1 OR analysis_count < %s)
+               RETURNING role, analysis_count, is_premium""",
+            (user_id, FREE_TIER_LIMIT)
+        )
+        row = c.fetchone()
+        conn.commit()
+        if row:
+            status = cache_status(user_id, row["role"], row["is_premium"])
+            return status, row["analysis_count"], True
+
+        # Nothing updated: either the user is unknown or the limit is reached.
+        status = get_cached_status(user_id)
+        if status is None:
+            c.execute("SELECT role, is_premium FROM users WHERE id = %s", (user_id,))
+            user = c.fetchone()
+            if not user:
+                return None, None, False
+            status = cache_status(user_id, user["role"], user["is_premium"])
+        return status, None, False
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        c.close()
+
+
+def release_slot(conn, user_id):
+    """Give back a slot reserved by reserve_slot() when the analysis pipeline fails."""
+    c = conn.cursor()
+    try:
+        c.execute(
+            "UPDATE users SET analysis_count = GREATEST(analysis_count - 1, 0) WHERE id = %s",
+            (user_id,)
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        c.close()
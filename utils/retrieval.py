@@ -0,0 +1,28 @@
+RRF_K = 60
+
+
+def hybrid_order(question, chunks, rrf_k=RRF_K):
+    """Fuse the dense order of `chunks` (as returned by the vector search) with a BM25
+    ranking of the same candidates using reciprocal rank fusion.
+
+    Returns candidate indices, best first.
+    """
+    import numpy as np
+    from rank_bm25 import BM25Okapi
+    bm25 = BM25Okapi([chunk.lower().split() for chunk in chunks])
+    bm25_scores = bm25.get_scores(question.lower().split())
+    sparse_indices = np.argsort(bm25_scores)[::-1].tolist()
+
+    rrf_scores = {}
+    for rank in range(len(chunks)):
+        rrf_scores[rank] = rrf_scores.get(rank, 0) + 1 / (rrf_k + rank + 1)
+    for rank, idx in enumerate(sparse_indices):
+        rrf_scores[idx] = rrf_scores.get(idx, 0) + 1 / (rrf_k + rank + 1)
+    return sorted(rrf_scores.keys(), key=lambda x: rrf_scores[x], reverse=True)
+
+
+def rerank(model, question, chunks, candidates, top_k):
+    """Score candidate chunks with a cross-encoder and return the best `top_k` indices."""
+    cross_scores = model.predict([[question, chunks[i]] for i in candidates])
+    reranked_pairs = sorted(zip(candidates, cross_scores), key=lambda x: x[1], reverse=True)
+    return [pair[0] for pair in reranked_pairs[:top_k]]
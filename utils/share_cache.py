@@ -0,0 +1,156 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+SHARE_CACHE_TTL = float(os.environ.get("SHARE_CACHE_TTL", "60"))
+SHARE_CACHE_MAX_ENTRIES = int(os.environ.get("SHARE_CACHE_MAX_ENTRIES", "1000"))
+# Optional directory shared by all workers on a host; invalidating deletes the file,
+# which also expires every worker's in-memory copy on its next lookup.
+SHARE_CACHE_DIR = os.environ.get("SHARE_CACHE_DIR", "")
+# Disk entries expire too, so a put() that raced an invalidate() can't serve stale data for long
+SHARE_CACHE_DISK_TTL = float(os.environ.get("SHARE_CACHE_DISK_TTL", "600"))
+SHARE_CACHE_DIR_MAX_ENTRIES = int(os.environ.get("SHARE_CACHE_DIR_MAX_ENTRIES", "10000"))
+# The directory is pruned once every this many writes by a worker
+_PRUNE_EVERY = 100
+
+# shared_id -> (expires_at, etag, body)
+_entries = OrderedDict()
+_lock = threading.Lock()
+_stats = {"hits": 0, "disk_hits": 0, "misses": 0, "invalidations": 0}
+_writes = 0
+
+
+def make_etag(body):
+    return '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+
+def _disk_path(shared_id):
+    key = hashlib.sha256(shared_id.encode()).hexdigest()
+    return os.path.join(SHARE_CACHE_DIR, f"{key}.json")
+
+
+def _remember(shared_id, etag, body, ttl=None):
+    ttl = SHARE_CACHE_TTL if ttl is None else min(ttl, SHARE_CACHE_TTL)
+    with _lock:
+        _entries[shared_id] = (time.monotonic() + ttl, etag, body)
+        _entries.move_to_end(shared_id)
+        while len(_entries) > SHARE_CACHE_MAX_ENTRIES:
+            _entries.popitem(last=False)
+
+
+def get(shared_id):
+    """Return (etag, body) for a cached shared payload, or None."""
+    with _lock:
+        entry = _entries.get(shared_id)
+        if entry and entry[0] < time.monotonic():
+            del _entries[shared_id]
+            entry = None
+        if entry:
+            _entries.move_to_end(shared_id)
+    if entry and (not SHARE_CACHE_DIR or os.path.exists(_disk_path(shared_id))):
+        _stats["hits"] += 1
+        return entry[1], entry[2]
+
+    if SHARE_CACHE_DIR:
+        path = _disk_path(shared_id)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                cached = json.load(f)
+            remaining = cached["expires_at"] - time.time()
+            if remaining > 0:
+                body = cached["body"].encode("utf-8")
+                _remember(shared_id, cached["etag"], body, ttl=remaining)
+                _stats["disk_hits"] += 1
+                return cached["etag"], body
+            _remove(path)
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+    _stats["misses"] += 1
+    return None
+
+
+def put(shared_id, body):
+    global _writes
+    etag = make_etag(body)
+    _remember(shared_id, etag, body)
+    if SHARE_CACHE_DIR:
+        try:
+            os.makedirs(SHARE_CACHE_DIR, exist_ok=True)
+            path = _disk_path(shared_id)
+            # Unique per thread as well as per worker, so concurrent puts never share a temp file
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"etag": etag, "body": body.decode("utf-8"),
+                           "expires_at": time.time() + SHARE_CACHE_DISK_TTL}, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Warning: Failed to write share cache ({e})")
+        with _lock:
+            _writes += 1
+            prune_now = _writes % _PRUNE_EVERY == 0
+        if prune_now:
+            prune()
+    return etag
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def prune(max_entries=None):
+    """Delete expired files (by age) and the oldest ones beyond SHARE_CACHE_DIR_MAX_ENTRIES.
+
+    Returns the number of files removed.
+    """
+    max_entries = SHARE_CACHE_DIR_MAX_ENTRIES if max_entries is None else max_entries
+    if not SHARE_CACHE_DIR:
+        return 0
+    try:
+        names = os.listdir(SHARE_CACHE_DIR)
+    except OSError:
+        return 0
+    now = time.time()
+    files = []
+    removed = 0
+    for name in names:
+        path = os.path.join(SHARE_CACHE_DIR, name)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            continue
+        # Temp files are leftovers of crashed writes once they're a minute old
+        stale = name.endswith(".tmp") and mtime < now - 60
+        if stale or (name.endswith(".json") and mtime < now - SHARE_CACHE_DISK_TTL):
+            _remove(path)
+            removed += 1
+        elif name.endswith(".json"):
+            files.append((mtime, path))
+    if len(files) > max_entries:
+        files.sort()
+        for _, path in files[:len(files) - max_entries]:
+            _remove(path)
+            removed += 1
+    return removed
+
+
+def invalidate(shared_id):
+    """Forget a shared payload after its history row or chat changed."""
+    if not shared_id:
+        return
+    _stats["invalidations"] += 1
+    with _lock:
+        _entries.pop(shared_id, None)
+    if SHARE_CACHE_DIR:
+        _remove(_disk_path(shared_id))
+
+
+def stats():
+    with _lock:
+        size = len(_entries)
+    return dict(_stats, entries=size)
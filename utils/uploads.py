@@ -0,0 +1,164 @@
+"""Multipart uploads streamed straight to a spool file.
+
+Werkzeug normally buffers an uploaded file in its own temporary file, and the
+analyze endpoint used to copy it again with file.save(). StreamingRequest
+replaces the file stream with a SpoolFile instead. The parser's chunks are
+written directly into a named temporary file (which the extractors open by
+path) and hashed in the same pass. The request is rejected with 413 as soon as
+one byte more than MAX_UPLOAD_BYTES arrives. Memory per upload is therefore
+bounded by the parser's chunk size.
+
+The SHA-256 of each upload keys a small LRU of extracted text, so uploading the
+same file again skips extraction (and OCR) entirely.
+"""
+import hashlib
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+
+from flask import Request
+from werkzeug.exceptions import RequestEntityTooLarge
+
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_MB", "20")) * 1024 * 1024
+# Form fields and multipart framing on top of the file itself
+MAX_REQUEST_OVERHEAD = 1024 * 1024
+UPLOAD_SPOOL_DIR = os.environ.get("UPLOAD_SPOOL_DIR") or None
+EXTRACTION_CACHE_ENTRIES = int(os.environ.get("EXTRACTION_CACHE_ENTRIES", "32"))
+# Extracted texts longer than this are not cached
+EXTRACTION_CACHE_MAX_CHARS = 2_000_000
+_SUFFIX_RE = re.compile(r"^[A-Za-z0-9]{1,10}$")
+
+
+class UploadTooLarge(RequestEntityTooLarge):
+    description = f"File too large. Maximum allowed size is {MAX_UPLOAD_BYTES // (1024 * 1024)} MB."
+
+
+class SpoolFile:
+    """Write-once file that hashes what it stores and refuses to grow past `limit` bytes.
+
+    The file is deleted when closed. StreamingRequest closes every spool it created when
+    the request ends, including parts the parser abandoned (a body cut off before its
+    closing boundary never makes it into request.files).
+    """
+
+    def __init__(self, suffix="", limit=MAX_UPLOAD_BYTES, directory=UPLOAD_SPOOL_DIR):
+        self._file = tempfile.NamedTemporaryFile(delete=False, suffix=suffix, dir=directory)
+        self.name = self._file.name
+        self.limit = limit
+        self.size = 0
+        self._hash = hashlib.sha256()
+
+    @property
+    def sha256(self):
+        return self._hash.hexdigest()
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.limit:
+            self.close()
+            raise UploadTooLarge()
+        self._hash.update(data)
+        return self._file.write(data)
+
+    def flush(self):
+        self._file.flush()
+
+    def seek(self, offset, whence=0):
+        # Werkzeug rewinds the stream once the part is complete; make the data visible by path too
+        self._file.flush()
+        return self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    @property
+    def closed(self):
+        return self._file.closed
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+        try:
+            os.unlink(self.name)
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class StreamingRequest(Request):
+    """Use as app.request_class, together with MAX_CONTENT_LENGTH = MAX_UPLOAD_BYTES + MAX_REQUEST_OVERHEAD."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._spools = []
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        extension = (filename or "").rsplit(".", 1)[-1] if "." in (filename or "") else ""
+        suffix = f".{extension.lower()}" if _SUFFIX_RE.match(extension) else ""
+        spool = SpoolFile(suffix=suffix)
+        self._spools.append(spool)
+        return spool
+
+    def close(self):
+        # Flask calls this when the request context ends
+        try:
+            super().close()
+        finally:
+            spools, self._spools = self._spools, []
+            for spool in spools:
+                spool.close()
+
+
+class ExtractionCache:
+    """Extracted text keyed by (upload hash, file type), least recently used evicted first."""
+
+    def __init__(self, entries=EXTRACTION_CACHE_ENTRIES):
+        self.entries = entries
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0}
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, sha256, content_type):
+        key = (sha256, content_type)
+        with self._lock:
+            text = self._items.get(key)
+            if text is None:
+                self.stats["misses"] += 1
+                return None
+            self._items.move_to_end(key)
+            self.stats["hits"] += 1
+            return text
+
+    def put(self, sha256, content_type, text):
+        if not self.entries or not text or len(text) > EXTRACTION_CACHE_MAX_CHARS:
+            return
+        with self._lock:
+            self._items[(sha256, content_type)] = text
+            self._items.move_to_end((sha256, content_type))
+            while len(self._items) > self.entries:
+                self._items.popitem(last=False)
+
+
+extraction_cache = ExtractionCache()
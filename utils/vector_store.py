@@ -0,0 +1,307 @@
+import os
+import uuid
+
+# qdrant_client is imported inside the functions that need it: it is slow to import,
+# and most API requests (and app startup) never touch Qdrant.
+
+COLLECTION_NAME = "omnidoc_chunks"
+VECTOR_SIZE = 384
+RECONCILE_BATCH_SIZE = 1000
+
+# "embedded" (local files, single process), "server" (HTTP/gRPC, shared by all workers) or "memory" (tests)
+QDRANT_MODE = os.environ.get("QDRANT_MODE", "embedded").lower()
+QDRANT_PATH = os.environ.get("QDRANT_PATH", "qdrant_db")
+QDRANT_URL = os.environ.get("QDRANT_URL", "")
+QDRANT_HOST = os.environ.get("QDRANT_HOST", "localhost")
+QDRANT_PORT = int(os.environ.get("QDRANT_PORT", "6333"))
+QDRANT_GRPC_PORT = int(os.environ.get("QDRANT_GRPC_PORT", "6334"))
+QDRANT_PREFER_GRPC = os.environ.get("QDRANT_PREFER_GRPC", "0") == "1"
+QDRANT_API_KEY = os.environ.get("QDRANT_API_KEY") or None
+QDRANT_TIMEOUT = int(os.environ.get("QDRANT_TIMEOUT", "10"))
+QDRANT_POOL_SIZE = int(os.environ.get("QDRANT_POOL_SIZE", "20"))
+QDRANT_KEEPALIVE = int(os.environ.get("QDRANT_KEEPALIVE", "10"))
+# Gunicorn worker count (the Procfile passes it as --workers); embedded mode needs exactly one
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", "1"))
+
+# Collection layout. Changing these only affects newly created collections;
+# run migrate_qdrant.py to rebuild an existing one.
+QDRANT_QUANTIZATION = os.environ.get("QDRANT_QUANTIZATION", "none").lower()  # none | scalar | binary
+QDRANT_QUANTILE = float(os.environ.get("QDRANT_QUANTILE", "0.99"))
+QDRANT_QUANT_ALWAYS_RAM = os.environ.get("QDRANT_QUANT_ALWAYS_RAM", "1") == "1"
+QDRANT_ON_DISK = os.environ.get("QDRANT_ON_DISK", "0") == "1"
+QDRANT_HNSW_M = int(os.environ.get("QDRANT_HNSW_M", "16"))
+QDRANT_HNSW_EF_CONSTRUCT = int(os.environ.get("QDRANT_HNSW_EF_CONSTRUCT", "100"))
+QDRANT_HNSW_ON_DISK = os.environ.get("QDRANT_HNSW_ON_DISK", "0") == "1"
+# Build one HNSW graph per tenant (payload_m) instead of a global one (m=0). Every
+# query is scoped to a tenant, so a search only walks that user's own graph.
+QDRANT_TENANT_GRAPHS = os.environ.get("QDRANT_TENANT_GRAPHS", "1") == "1"
+# Query-time knobs for quantized collections
+QDRANT_RESCORE = os.environ.get("QDRANT_RESCORE", "1") == "1"
+QDRANT_OVERSAMPLING = float(os.environ.get("QDRANT_OVERSAMPLING", "2.0"))
+QDRANT_HNSW_EF = int(os.environ.get("QDRANT_HNSW_EF", "0")) or None
+
+
+def create_client(mode=None):
+    """Build a QdrantClient for the configured backend."""
+    from qdrant_client import QdrantClient
+    mode = (mode or QDRANT_MODE).lower()
+    if mode == "memory":
+        return QdrantClient(location=":memory:")
+    if mode == "embedded":
+        # Takes a file lock on QDRANT_PATH: only one process may open it. With several
+        # workers the first one would win and the rest silently run without vectors.
+        if WEB_CONCURRENCY > 1:
+            raise RuntimeError(
+                f"QDRANT_MODE=embedded cannot be shared by {WEB_CONCURRENCY} workers; "
+                "use QDRANT_MODE=server or WEB_CONCURRENCY=1"
+            )
+        return QdrantClient(path=QDRANT_PATH)
+    if mode == "server":
+        import httpx
+        kwargs = dict(
+            prefer_grpc=QDRANT_PREFER_GRPC,
+            grpc_port=QDRANT_GRPC_PORT,
+            api_key=QDRANT_API_KEY,
+            timeout=QDRANT_TIMEOUT,
+            # Keep-alive pool for the REST transport, shared by all request threads
+            limits=httpx.Limits(max_connections=QDRANT_POOL_SIZE, max_keepalive_connections=QDRANT_KEEPALIVE),
+        )
+        if QDRANT_URL:
+            return QdrantClient(url=QDRANT_URL, **kwargs)
+        return QdrantClient(host=QDRANT_HOST, port=QDRANT_PORT, **kwargs)
+    raise ValueError(f"Unknown QDRANT_MODE '{mode}' (expected embedded, server or memory)")
+
+
+def quantization_config(kind=None):
+    from qdrant_client import models
+    kind = (kind or QDRANT_QUANTIZATION).lower()
+    if kind == "scalar":
+        # int8 codes: 4x smaller than float32, kept in RAM while originals can live on disk
+        return models.ScalarQuantization(scalar=models.ScalarQuantizationConfig(
+            type=models.ScalarType.INT8, quantile=QDRANT_QUANTILE, always_ram=QDRANT_QUANT_ALWAYS_RAM
+        ))
+    if kind == "binary":
+        # 1 bit per dimension: 32x smaller; needs rescoring with oversampling to keep recall
+        return models.BinaryQuantization(binary=models.BinaryQuantizationConfig(always_ram=QDRANT_QUANT_ALWAYS_RAM))
+    if kind in ("", "none"):
+        return None
+    raise ValueError(f"Unknown QDRANT_QUANTIZATION '{kind}' (expected none, scalar or binary)")
+
+
+def collection_config():
+    """create_collection() arguments for the configured vector layout."""
+    from qdrant_client import models
+    return dict(
+        vectors_config=models.VectorParams(size=VECTOR_SIZE, distance=models.Distance.COSINE, on_disk=QDRANT_ON_DISK),
+        hnsw_config=models.HnswConfigDiff(
+            m=0 if QDRANT_TENANT_GRAPHS else QDRANT_HNSW_M,
+            payload_m=QDRANT_HNSW_M if QDRANT_TENANT_GRAPHS else None,
+            ef_construct=QDRANT_HNSW_EF_CONSTRUCT,
+            on_disk=QDRANT_HNSW_ON_DISK
+        ),
+        quantization_config=quantization_config(),
+    )
+
+
+def search_params():
+    """Per-query params: rescore quantized candidates against the original vectors."""
+    from qdrant_client import models
+    if quantization_config() is None:
+        return models.SearchParams(hnsw_ef=QDRANT_HNSW_EF) if QDRANT_HNSW_EF else None
+    return models.SearchParams(
+        hnsw_ef=QDRANT_HNSW_EF,
+        quantization=models.QuantizationSearchParams(rescore=QDRANT_RESCORE, oversampling=QDRANT_OVERSAMPLING)
+    )
+
+
+def search(client, vector, query_filter, limit, collection_name=COLLECTION_NAME):
+    """Nearest chunks to `vector` (a list of floats) within `query_filter`, best first, with payloads.
+
+    Goes through query_points(): qdrant-client 1.13+ no longer has search().
+    """
+    return client.query_points(
+        collection_name=collection_name,
+        query=vector,
+        query_filter=query_filter,
+        search_params=search_params(),
+        limit=limit,
+        with_payload=True,
+    ).points
+
+
+def ensure_collection(client, collection_name=COLLECTION_NAME):
+    """Create the chunk collection if it is missing, and make sure its payload indexes exist."""
+    try:
+        client.get_collection(collection_name)
+    except Exception:
+        client.create_collection(collection_name=collection_name, **collection_config())
+    ensure_payload_indexes(client, collection_name)
+
+
+def ensure_payload_indexes(client, collection_name=COLLECTION_NAME):
+    """Index the fields every query and delete filters on."""
+    from qdrant_client import models
+    client.create_payload_index(
+        collection_name=collection_name,
+        field_name="tenant_id",
+        # is_tenant co-locates each user's points on disk and lets Qdrant plan per-tenant searches
+        field_schema=models.KeywordIndexParams(type=models.KeywordIndexType.KEYWORD, is_tenant=True)
+    )
+    client.create_payload_index(
+        collection_name=collection_name,
+        field_name="history_id",
+        field_schema=models.PayloadSchemaType.INTEGER
+    )
+
+
+# Fixed namespace so the same (history, chunk) always maps to the same point id
+CHUNK_ID_NAMESPACE = uuid.UUID("5b0c6f64-3f1e-4b8a-9a51-2f9a0c7d1e42")
+
+
+def chunk_point_ids(history_id, chunk_hashes):
+    """Deterministic point ids: re-ingesting the same chunks overwrites instead of duplicating.
+
+    Repeated chunks within one document are told apart by their occurrence number.
+    """
+    seen = {}
+    ids = []
+    for h in chunk_hashes:
+        occurrence = seen.get(h, 0)
+        seen[h] = occurrence + 1
+        ids.append(str(uuid.uuid5(CHUNK_ID_NAMESPACE, f"{history_id}:{h}:{occurrence}")))
+    return ids
+
+
+def tenant_key(user_id):
+    return str(int(user_id))
+
+
+def history_filter(history_ids, user_ids=None):
+    """Filter on history rows, confined to the owners' tenant partition when known."""
+    from qdrant_client import models
+    must = [models.FieldCondition(key="history_id", match=models.MatchAny(any=list(history_ids)))]
+    if user_ids:
+        tenants = sorted({tenant_key(u) for u in user_ids})
+        if len(tenants) == 1:
+            must.insert(0, models.FieldCondition(key="tenant_id", match=models.MatchValue(value=tenants[0])))
+        else:
+            must.insert(0, models.FieldCondition(key="tenant_id", match=models.MatchAny(any=tenants)))
+    return models.Filter(must=must)
+
+
+def delete_history_vectors(client, history_ids, collection_name=COLLECTION_NAME):
+    """Remove every chunk that belongs to the given history rows."""
+    from qdrant_client import models
+    history_ids = [int(h) for h in history_ids]
+    if not history_ids:
+        return
+    client.delete(
+        collection_name=collection_name,
+        points_selector=models.FilterSelector(filter=history_filter(history_ids)),
+        wait=True
+    )
+
+
+def list_history_points(client, history_id, fields, collection_name=COLLECTION_NAME, batch_size=RECONCILE_BATCH_SIZE):
+    """Return {point_id: payload} for a document's chunks, payload fields only."""
+    found = {}
+    offset = None
+    while True:
+        points, offset = client.scroll(
+            collection_name=collection_name,
+            scroll_filter=history_filter([history_id]),
+            limit=batch_size,
+            offset=offset,
+            with_payload=list(fields),
+            with_vectors=False
+        )
+        for p in points:
+            found[str(p.id)] = p.payload or {}
+        if offset is None:
+            return found
+
+
+def update_payloads(client, payloads, collection_name=COLLECTION_NAME):
+    """Apply {point_id: partial_payload} in one batched request."""
+    from qdrant_client import models
+    if not payloads:
+        return
+    client.batch_update_points(
+        collection_name=collection_name,
+        update_operations=[
+            models.SetPayloadOperation(set_payload=models.SetPayload(payload=payload, points=[point_id]))
+            for point_id, payload in payloads.items()
+        ]
+    )
+
+
+def delete_points(client, point_ids, collection_name=COLLECTION_NAME):
+    from qdrant_client import models
+    if point_ids:
+        client.delete(collection_name=collection_name, points_selector=models.PointIdsList(points=list(point_ids)), wait=True)
+
+
+def reconcile_orphans(client, find_existing_ids, collection_name=COLLECTION_NAME, batch_size=RECONCILE_BATCH_SIZE):
+    """Purge vectors whose history row no longer exists in Postgres.
+
+    Scrolls the collection `batch_size` points at a time (payload only, no vectors),
+    asks `find_existing_ids(ids) -> set` which history ids are still alive, and
+    deletes the rest by filter. Returns counts for reporting.
+    """
+    report = {"points_scanned": 0, "history_ids_checked": 0, "orphan_history_ids": 0}
+    checked = set()
+    offset = None
+    while True:
+        points, offset = client.scroll(
+            collection_name=collection_name,
+            limit=batch_size,
+            offset=offset,
+            with_payload=["history_id"],
+            with_vectors=False
+        )
+        report["points_scanned"] += len(points)
+        batch_ids = {p.payload.get("history_id") for p in points if p.payload} - checked - {None}
+        if batch_ids:
+            checked.update(batch_ids)
+            orphans = batch_ids - set(find_existing_ids(sorted(batch_ids)))
+            if orphans:
+                delete_history_vectors(client, orphans, collection_name)
+                report["orphan_history_ids"] += len(orphans)
+        if offset is None:
+            break
+    report["history_ids_checked"] = len(checked)
+    return report
+
+
+def backfill_tenants(client, find_owners, collection_name=COLLECTION_NAME, batch_size=RECONCILE_BATCH_SIZE):
+    """Tag points written before multi-tenancy with their owner's tenant_id.
+
+    `find_owners(history_ids) -> {history_id: user_id}` looks owners up in Postgres.
+    Points whose history row is gone are left for reconcile_orphans().
+    """
+    from qdrant_client import models
+    missing = models.Filter(must=[models.IsEmptyCondition(is_empty=models.PayloadField(key="tenant_id"))])
+    seen = set()
+    updated = 0
+    offset = None
+    while True:
+        points, offset = client.scroll(
+            collection_name=collection_name,
+            scroll_filter=missing,
+            limit=batch_size,
+            offset=offset,
+            with_payload=["history_id"],
+            with_vectors=False
+        )
+        batch_ids = {p.payload.get("history_id") for p in points if p.payload} - seen - {None}
+        seen.update(batch_ids)
+        if batch_ids:
+            for history_id, user_id in find_owners(sorted(batch_ids)).items():
+                client.set_payload(
+                    collection_name=collection_name,
+                    payload={"tenant_id": tenant_key(user_id)},
+                    points=history_filter([history_id])
+                )
+                updated += 1
+        if offset is None:
+            return updated
@@ -0,0 +1,211 @@
+"""Crawling a documentation site into one multi-part document.
+
+Breadth-first from a seed URL, level by level, up to `max_depth` link hops,
+`max_pages` kept pages and `max_chars` characters of kept text (each page
+contributing at most `page_chars`). Only links on the seed's host and under the
+seed's directory are followed. Pages are fetched concurrently through
+web_ingest.fetch (pooled session, page cache). Per host, at most
+CRAWL_PER_HOST requests run at once, starts are spaced by CRAWL_HOST_DELAY
+seconds, and robots.txt is honoured. A page is dropped when its URL, canonical
+URL or text was already seen. The result is joined with
+"--- Source: <url> ---" markers, which the chunker turns into a source_url on
+every chunk.
+"""
+import hashlib
+import os
+import posixpath
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from contextlib import contextmanager
+from urllib.parse import urlsplit, urlunsplit
+from urllib.robotparser import RobotFileParser
+
+from utils import web_ingest
+
+CRAWL_MAX_DEPTH = int(os.environ.get("CRAWL_MAX_DEPTH", "3"))
+CRAWL_MAX_PAGES = int(os.environ.get("CRAWL_MAX_PAGES", "50"))
+CRAWL_WORKERS = int(os.environ.get("CRAWL_WORKERS", "8"))
+CRAWL_PER_HOST = int(os.environ.get("CRAWL_PER_HOST", "4"))
+CRAWL_HOST_DELAY = float(os.environ.get("CRAWL_HOST_DELAY", "0.1"))
+CRAWL_DEADLINE = float(os.environ.get("CRAWL_DEADLINE", "60"))
+# Text budgets: characters kept per page, and for the whole crawl
+CRAWL_PAGE_CHARS = int(os.environ.get("CRAWL_PAGE_CHARS", "20000"))
+CRAWL_MAX_CHARS = int(os.environ.get("CRAWL_MAX_CHARS", "300000"))
+_SKIP_EXTENSIONS = (
+    ".pdf", ".zip", ".gz", ".tar", ".png", ".jpg", ".jpeg", ".gif", ".svg", ".webp", ".ico",
+    ".css", ".js", ".mp3", ".mp4", ".woff", ".woff2", ".ttf", ".exe", ".dmg",
+)
+
+
+def normalize_url(url):
+    """Lowercase scheme and host, drop default ports, fragments and empty paths."""
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    port = parts.port
+    netloc = host if port is None or (scheme, port) in (("http", 80), ("https", 443)) else f"{host}:{port}"
+    return urlunsplit((scheme, netloc, parts.path or "/", parts.query, ""))
+
+
+class _HostGate:
+    """Per-host concurrency limit plus a minimum spacing between request starts."""
+
+    def __init__(self, per_host, delay):
+        self.per_host = per_host
+        self.delay = delay
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def slot(self, host):
+        with self._lock:
+            entry = self._hosts.setdefault(host, [threading.Semaphore(self.per_host), 0.0])
+        entry[0].acquire()
+        try:
+            with self._lock:
+                now = time.monotonic()
+                start = max(entry[1], now)
+                entry[1] = start + self.delay
+            if start > now:
+                time.sleep(start - now)
+            yield
+        finally:
+            entry[0].release()
+
+
+class CrawlResult:
+    def __init__(self, seed):
+        self.seed = seed
+        self.pages = []  # (url, title, text) in crawl order
+        self.errors = []  # (url, message)
+        self.skipped = {"duplicate": 0, "robots": 0, "out_of_time": 0, "over_budget": 0}
+        self.chars = 0
+        self.elapsed = 0.0
+
+    def as_document(self):
+        parts = []
+        for url, title, text in self.pages:
+            header = f"--- Source: {url} ---"
+            parts.append(f"{header}\n# {title}\n{text}" if title else f"{header}\n{text}")
+        return "\n\n".join(parts)
+
+
+class Crawler:
+    def __init__(self, fetch=None, workers=CRAWL_WORKERS, per_host=CRAWL_PER_HOST, host_delay=CRAWL_HOST_DELAY,
+                 respect_robots=True):
+        self.fetch = fetch or web_ingest.fetch
+        self.workers = workers
+        self.gate = _HostGate(per_host, host_delay)
+        self.respect_robots = respect_robots
+        self._robots = {}
+        self._robots_lock = threading.Lock()
+
+    def _allowed(self, url):
+        if not self.respect_robots:
+            return True
+        parts = urlsplit(url)
+        root = f"{parts.scheme}://{parts.netloc}"
+        with self._robots_lock:
+            parser = self._robots.get(root)
+        if parser is None:
+            parser = RobotFileParser()
+            try:
+                with self.gate.slot(parts.netloc):
+                    page = self.fetch(f"{root}/robots.txt")
+                parser.parse(page.text.splitlines())
+            except web_ingest.FetchError:
+                parser.parse([])  # no robots.txt: everything is allowed
+            with self._robots_lock:
+                self._robots[root] = parser
+        return parser.can_fetch(web_ingest.WEB_USER_AGENT, url)
+
+    def _get(self, url):
+        if not self._allowed(url):
+            return None
+        with self.gate.slot(urlsplit(url).netloc):
+            return self.fetch(url)
+
+    @staticmethod
+    def _in_scope(url, seed_parts, prefix):
+        parts = urlsplit(url)
+        return (
+            parts.scheme == seed_parts.scheme
+            and parts.netloc == seed_parts.netloc
+            and parts.path.startswith(prefix)
+            and not parts.path.lower().endswith(_SKIP_EXTENSIONS)
+        )
+
+    def crawl(self, seed, max_depth=CRAWL_MAX_DEPTH, max_pages=CRAWL_MAX_PAGES, deadline=CRAWL_DEADLINE,
+              page_chars=CRAWL_PAGE_CHARS, max_chars=CRAWL_MAX_CHARS):
+        """Crawl from `seed`; returns a CrawlResult (partial if the deadline or the text budget is hit)."""
+        started = time.monotonic()
+        seed = normalize_url(seed)
+        seed_parts = urlsplit(seed)
+        prefix = seed_parts.path if seed_parts.path.endswith("/") else posixpath.dirname(seed_parts.path).rstrip("/") + "/"
+        result = CrawlResult(seed)
+        seen_urls = {seed}
+        seen_canonical = set()
+        seen_text = set()
+        frontier = [seed]
+
+        # Not a with-block: on timeout we return without waiting for fetches still in flight
+        pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="crawl")
+        try:
+            for depth in range(max_depth + 1):
+                remaining = max_pages - len(result.pages)
+                if not frontier or remaining <= 0 or result.chars >= max_chars:
+                    break
+                batch = frontier[:remaining]
+                futures = [(url, pool.submit(self._get, url)) for url in batch]
+                next_frontier = []
+                for index, (url, future) in enumerate(futures):
+                    left = deadline - (time.monotonic() - started)
+                    try:
+                        page = future.result(timeout=max(left, 0))
+                    except FutureTimeout:
+                        result.skipped["out_of_time"] += len(futures) - index
+                        result.elapsed = time.monotonic() - started
+                        return result
+                    except Exception as e:
+                        result.errors.append((url, str(e)))
+                        continue
+                    if page is None:
+                        result.skipped["robots"] += 1
+                        continue
+
+                    final_url = normalize_url(page.final_url)
+                    canonical = normalize_url(page.canonical) if page.canonical else final_url
+                    text_hash = hashlib.sha256(page.text.encode("utf-8")).hexdigest()
+                    if canonical in seen_canonical or final_url in seen_canonical or text_hash in seen_text:
+                        result.skipped["duplicate"] += 1
+                        continue
+                    seen_canonical.update((canonical, final_url))
+                    seen_text.add(text_hash)
+                    if len(result.pages) < max_pages:
+                        text = page.text[:min(page_chars, max_chars - result.chars)]
+                        result.pages.append((canonical, page.title, text))
+                        result.chars += len(text)
+                        if result.chars >= max_chars:
+                            # Budget spent: whatever is still in flight or queued is not needed
+                            result.skipped["over_budget"] += len(futures) - index - 1
+                            break
+
+                    if depth < max_depth:
+                        for link in page.links:
+                            link = normalize_url(link)
+                            if link not in seen_urls and self._in_scope(link, seed_parts, prefix):
+                                seen_urls.add(link)
+                                next_frontier.append(link)
+                frontier = next_frontier
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+        result.elapsed = time.monotonic() - started
+        return result
+
+
+def crawl(seed, max_depth=CRAWL_MAX_DEPTH, max_pages=CRAWL_MAX_PAGES, deadline=CRAWL_DEADLINE,
+          page_chars=CRAWL_PAGE_CHARS, max_chars=CRAWL_MAX_CHARS, **crawler_options):
+    return Crawler(**crawler_options).crawl(seed, max_depth=max_depth, max_pages=max_pages, deadline=deadline,
+                                            page_chars=page_chars, max_chars=max_chars)
@@ -0,0 +1,307 @@
+"""Fetching web pages for analysis: pooled connections, capped bodies, HTTP caching.
+
+All fetches share one requests.Session per process, so repeat requests to a
+host reuse its keep-alive connections. Bodies are streamed and cut off at
+WEB_MAX_BYTES, so a huge page can't exhaust a worker's memory. HTML is parsed
+with lxml when it is installed (html.parser otherwise); other text types
+(text/*, JSON, XML) are kept as plain text, and binary types are refused.
+
+Parsed pages are cached in SQLite (WEB_CACHE_PATH, WAL mode so workers on one
+host share it) together with their ETag/Last-Modified validators. Within the
+freshness lifetime (Cache-Control max-age, else WEB_CACHE_TTL) a page is served
+without any request, and after that it is revalidated with a conditional GET.
+A 304 answer reuses the stored text.
+"""
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from urllib.parse import urljoin, urldefrag
+
+WEB_USER_AGENT = os.environ.get(
+    "WEB_USER_AGENT",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
+)
+WEB_CONNECT_TIMEOUT = float(os.environ.get("WEB_CONNECT_TIMEOUT", "5"))
+WEB_READ_TIMEOUT = float(os.environ.get("WEB_READ_TIMEOUT", "15"))
+WEB_MAX_BYTES = int(os.environ.get("WEB_MAX_BYTES", str(5 * 1024 * 1024)))
+WEB_POOL_SIZE = int(os.environ.get("WEB_POOL_SIZE", "32"))
+# Set to an empty string to disable the cache
+WEB_CACHE_PATH = os.environ.get("WEB_CACHE_PATH", "web_cache.sqlite3")
+WEB_CACHE_TTL = float(os.environ.get("WEB_CACHE_TTL", "300"))
+WEB_CACHE_MAX_AGE = float(os.environ.get("WEB_CACHE_MAX_AGE", "86400"))
+WEB_CACHE_MAX_ENTRIES = int(os.environ.get("WEB_CACHE_MAX_ENTRIES", "5000"))
+_CHUNK_SIZE = 64 * 1024
+_DROP_TAGS = ["script", "style", "nav", "footer", "header", "noscript", "template"]
+_HTML_TYPES = ("text/html", "application/xhtml+xml", "")
+_TEXT_APPLICATION_TYPES = ("application/json", "application/xml")
+
+_session = None
+_session_lock = threading.Lock()
+_parser = None
+
+
+class FetchError(Exception):
+    pass
+
+
+class Page:
+    def __init__(self, url, final_url, title, text, links, canonical=None, status=200,
+                 cache=None, truncated=False, etag=None, last_modified=None, expires_at=0.0):
+        self.url = url
+        self.final_url = final_url
+        self.title = title
+        self.text = text
+        self.links = links
+        self.canonical = canonical
+        self.status = status
+        self.cache = cache  # None (fetched), "fresh" or "revalidated"
+        self.truncated = truncated
+        self.etag = etag
+        self.last_modified = last_modified
+        self.expires_at = expires_at
+
+    def to_row(self):
+        return json.dumps({"final_url": self.final_url, "title": self.title, "text": self.text,
+                           "links": self.links, "canonical": self.canonical, "truncated": self.truncated})
+
+
+def get_session():
+    """The process-wide pooled session (created on first use, so after a gunicorn fork)."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                from urllib3.util.retry import Retry
+                session = requests.Session()
+                retry = Retry(total=2, connect=2, read=0, backoff_factor=0.3,
+                              status_forcelist=(502, 503, 504), allowed_methods=frozenset({"GET", "HEAD"}))
+                adapter = HTTPAdapter(pool_connections=WEB_POOL_SIZE, pool_maxsize=WEB_POOL_SIZE, max_retries=retry)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                session.headers.update({"User-Agent": WEB_USER_AGENT, "Accept": "text/html,text/*;q=0.9,application/json;q=0.9,application/xml;q=0.9,*/*;q=0.5"})
+                _session = session
+    return _session
+
+
+def html_parser():
+    """"lxml" if it is installed (several times faster), else the stdlib parser."""
+    global _parser
+    if _parser is None:
+        try:
+            import lxml  # noqa: F401
+            _parser = "lxml"
+        except ImportError:
+            _parser = "html.parser"
+    return _parser
+
+
+class PageCache:
+    """Parsed pages keyed by URL, with their HTTP validators."""
+
+    def __init__(self, path=WEB_CACHE_PATH, max_entries=WEB_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._db = None
+        self._writes = 0
+        self.stats = {"hits": 0, "revalidated": 0, "misses": 0}
+
+    def _conn(self):
+        if self._db is None and self.path:
+            try:
+                db = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+                db.execute("PRAGMA journal_mode=WAL")
+                db.execute(
+                    """CREATE TABLE IF NOT EXISTS pages (
+                           url_hash TEXT PRIMARY KEY,
+                           url TEXT NOT NULL,
+                           etag TEXT,
+                           last_modified TEXT,
+                           expires_at REAL NOT NULL,
+                           stored_at REAL NOT NULL,
+                           page TEXT NOT NULL
+                       ) WITHOUT ROWID"""
+                )
+                db.execute("CREATE INDEX IF NOT EXISTS idx_pages_stored_at ON pages (stored_at)")
+                db.commit()
+                self._db = db
+            except sqlite3.Error as e:
+                print(f"Warning: Web page cache disabled ({e})")
+                self.path = ""
+        return self._db
+
+    @staticmethod
+    def _key(url):
+        return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+    def get(self, url):
+        with self._lock:
+            db = self._conn()
+            if db is None:
+                return None
+            row = db.execute("SELECT etag, last_modified, expires_at, page FROM pages WHERE url_hash = ?",
+                             (self._key(url),)).fetchone()
+        if row is None:
+            return None
+        etag, last_modified, expires_at, stored = row
+        data = json.loads(stored)
+        return Page(url, data["final_url"], data["title"], data["text"], data["links"], data.get("canonical"),
+                    truncated=data.get("truncated", False), etag=etag, last_modified=last_modified,
+                    expires_at=expires_at)
+
+    def put(self, page):
+        with self._lock:
+            db = self._conn()
+            if db is None:
+                return
+            db.execute(
+                "INSERT OR REPLACE INTO pages (url_hash, url, etag, last_modified, expires_at, stored_at, page) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (self._key(page.url), page.url, page.etag, page.last_modified, page.expires_at, time.time(), page.to_row())
+            )
+            self._writes += 1
+            if self._writes % 100 == 0:
+                # Trim the oldest entries now and then instead of on every write
+                db.execute(
+                    "DELETE FROM pages WHERE url_hash IN (SELECT url_hash FROM pages ORDER BY stored_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,)
+                )
+            db.commit()
+
+    def touch(self, page):
+        """Extend a revalidated entry's lifetime."""
+        with self._lock:
+            db = self._conn()
+            if db is not None:
+                db.execute("UPDATE pages SET expires_at = ?, stored_at = ? WHERE url_hash = ?",
+                           (page.expires_at, time.time(), self._key(page.url)))
+                db.commit()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = PageCache()
+    return _cache
+
+
+def _expires_at(headers):
+    cache_control = headers.get("Cache-Control", "").lower()
+    if "no-store" in cache_control or "no-cache" in cache_control:
+        return time.time()
+    match = re.search(r"max-age=(\d+)", cache_control)
+    lifetime = min(float(match.group(1)), WEB_CACHE_MAX_AGE) if match else WEB_CACHE_TTL
+    return time.time() + lifetime
+
+
+def _read_capped(response, limit):
+    """Read at most `limit` bytes of the body; returns (bytes, truncated)."""
+    body = bytearray()
+    for chunk in response.iter_content(_CHUNK_SIZE):
+        body += chunk
+        if len(body) > limit:
+            del body[limit:]
+            return bytes(body), True
+    return bytes(body), False
+
+
+def parse_html(body, base_url, encoding=None):
+    """(title, text, links, canonical) of an HTML document given as bytes."""
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(body, html_parser(), from_encoding=encoding)
+    title = soup.title.get_text(strip=True) if soup.title else None
+    canonical = None
+    link = soup.find("link", rel="canonical", href=True)
+    if link:
+        canonical = urldefrag(urljoin(base_url, link["href"]))[0]
+    links = []
+    seen = set()
+    for a in soup.find_all("a", href=True):
+        href = urldefrag(urljoin(base_url, a["href"].strip()))[0]
+        if href.startswith(("http://", "https://")) and href not in seen:
+            seen.add(href)
+            links.append(href)
+    for tag in soup(_DROP_TAGS):
+        tag.extract()
+    text = soup.get_text(separator="\n", strip=True)
+    return title, text, links, canonical
+
+
+def is_text_type(content_type):
+    """HTML, any text/* type, or JSON/XML (including +json/+xml types); everything else is binary."""
+    return (
+        content_type in _HTML_TYPES
+        or content_type.startswith("text/")
+        or content_type in _TEXT_APPLICATION_TYPES
+        or content_type.endswith(("+xml", "+json"))
+    )
+
+
+def fetch(url, use_cache=True, max_bytes=None, timeout=None):
+    """Fetch and parse `url`, going through the page cache. Raises FetchError."""
+    import requests
+    cache = get_cache() if use_cache else None
+    cached = cache.get(url) if cache else None
+    if cached is not None and cached.expires_at > time.time():
+        cache.stats["hits"] += 1
+        cached.cache = "fresh"
+        return cached
+
+    headers = {}
+    if cached is not None:
+        if cached.etag:
+            headers["If-None-Match"] = cached.etag
+        if cached.last_modified:
+            headers["If-Modified-Since"] = cached.last_modified
+    try:
+        response = get_session().get(url, headers=headers, stream=True,
+                                     timeout=timeout or (WEB_CONNECT_TIMEOUT, WEB_READ_TIMEOUT))
+    except requests.RequestException as e:
+        raise FetchError(f"Could not fetch {url}: {e}") from e
+
+    with response:
+        if response.status_code == 304 and cached is not None:
+            cache.stats["revalidated"] += 1
+            cached.expires_at = _expires_at(response.headers)
+            cached.cache = "revalidated"
+            cache.touch(cached)
+            return cached
+        if response.status_code >= 400:
+            raise FetchError(f"{url} returned HTTP {response.status_code}")
+
+        content_type = response.headers.get("Content-Type", "text/html").split(";")[0].strip().lower()
+        if not is_text_type(content_type):
+            raise FetchError(f"Unsupported content type {content_type} at {url}")
+        limit = max_bytes or WEB_MAX_BYTES
+        try:
+            body, truncated = _read_capped(response, limit)
+        except requests.RequestException as e:
+            raise FetchError(f"Could not read {url}: {e}") from e
+
+    final_url = response.url
+    # Only trust an explicit charset; guessing (apparent_encoding) is slow, bs4 sniffs <meta> itself
+    encoding = response.encoding if "charset" in response.headers.get("Content-Type", "").lower() else None
+    if content_type in _HTML_TYPES:
+        title, text, links, canonical = parse_html(body, final_url, encoding)
+    else:
+        # Plain text, CSV, JSON, XML...: kept verbatim
+        title, text, links, canonical = None, body.decode(encoding or "utf-8", errors="replace"), [], None
+    page = Page(url, final_url, title, text, links, canonical, status=response.status_code, truncated=truncated,
+                etag=response.headers.get("ETag"), last_modified=response.headers.get("Last-Modified"),
+                expires_at=_expires_at(response.headers))
+    if cache is not None:
+        cache.stats["misses"] += 1
+        if "no-store" not in response.headers.get("Cache-Control", "").lower():
+            cache.put(page)
+    return page
@@ -0,0 +1,154 @@
+"""The /search web agent: query a search provider, then read the top result pages.
+
+Providers are looked up by name (WEB_SEARCH_PROVIDER): "duckduckgo" (default)
+or "stub", which answers from a JSON file (WEB_SEARCH_STUB_FILE) so tests and
+load tests never go to the internet. More can be added with register_provider().
+Results are cached in memory for WEB_SEARCH_CACHE_TTL seconds per query.
+
+The top WEB_SEARCH_FETCH_PAGES result pages are fetched concurrently through
+web_ingest (pooled session, page cache). Whatever has arrived when the overall
+WEB_SEARCH_DEADLINE expires is used, and the rest is reported as timed out.
+"""
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from utils import web_ingest
+
+WEB_SEARCH_PROVIDER = os.environ.get("WEB_SEARCH_PROVIDER", "duckduckgo")
+WEB_SEARCH_STUB_FILE = os.environ.get("WEB_SEARCH_STUB_FILE", "")
+WEB_SEARCH_MAX_RESULTS = int(os.environ.get("WEB_SEARCH_MAX_RESULTS", "5"))
+WEB_SEARCH_FETCH_PAGES = int(os.environ.get("WEB_SEARCH_FETCH_PAGES", "3"))
+WEB_SEARCH_DEADLINE = float(os.environ.get("WEB_SEARCH_DEADLINE", "12"))
+WEB_SEARCH_PAGE_CHARS = int(os.environ.get("WEB_SEARCH_PAGE_CHARS", "6000"))
+WEB_SEARCH_CACHE_TTL = float(os.environ.get("WEB_SEARCH_CACHE_TTL", "600"))
+WEB_SEARCH_CACHE_SIZE = 256
+
+
+class SearchError(Exception):
+    pass
+
+
+class DuckDuckGoProvider:
+    def search(self, query, max_results):
+        from duckduckgo_search import DDGS
+        with DDGS() as ddgs:
+            return [
+                {"title": r.get("title"), "url": r.get("href"), "snippet": r.get("body")}
+                for r in ddgs.text(query, max_results=max_results)
+            ]
+
+
+class StubProvider:
+    """Canned results: {"query": [{"title", "url", "snippet"}, ...], "*": [...]} from a dict or JSON file."""
+
+    def __init__(self, results=None, path=WEB_SEARCH_STUB_FILE):
+        if results is None:
+            results = {}
+            if path:
+                with open(path, encoding="utf-8") as f:
+                    results = json.load(f)
+        self.results = results
+
+    def search(self, query, max_results):
+        return list(self.results.get(query, self.results.get("*", [])))[:max_results]
+
+
+_providers = {"duckduckgo": DuckDuckGoProvider, "stub": StubProvider}
+_provider_instances = {}
+
+
+def register_provider(name, factory):
+    """Make `factory()` (returning an object with search(query, max_results)) available by name."""
+    _providers[name] = factory
+    _provider_instances.pop(name, None)
+
+
+def get_provider(name=None):
+    name = name or WEB_SEARCH_PROVIDER
+    if name not in _provider_instances:
+        if name not in _providers:
+            raise SearchError(f"Unknown search provider '{name}'")
+        _provider_instances[name] = _providers[name]()
+    return _provider_instances[name]
+
+
+# (provider, query, max_results) -> (expires_at, results)
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0}
+
+
+def cached_search(query, max_results=WEB_SEARCH_MAX_RESULTS, provider=None):
+    name = provider or WEB_SEARCH_PROVIDER
+    key = (name, " ".join(query.lower().split()), max_results)
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            _cache.move_to_end(key)
+            _stats["hits"] += 1
+            return entry[1]
+        _stats["misses"] += 1
+    results = [r for r in get_provider(name).search(query, max_results) if r.get("url")]
+    with _cache_lock:
+        _cache[key] = (time.monotonic() + WEB_SEARCH_CACHE_TTL, results)
+        _cache.move_to_end(key)
+        while len(_cache) > WEB_SEARCH_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return results
+
+
+def stats():
+    with _cache_lock:
+        return dict(_stats, entries=len(_cache))
+
+
+class SearchReport:
+    def __init__(self, query, results):
+        self.query = query
+        self.results = results
+        self.pages = {}  # url -> (title, text)
+        self.errors = {}  # url -> message
+        self.timed_out = []
+
+    def as_document(self, page_chars=WEB_SEARCH_PAGE_CHARS):
+        parts = [f"Web Search Context for query '{self.query}':"]
+        for i, r in enumerate(self.results):
+            parts.append(f"[{i+1}] {r.get('title')}\nSnippet: {r.get('snippet')}\nURL: {r['url']}")
+        for r in self.results:
+            if r["url"] in self.pages:
+                title, text = self.pages[r["url"]]
+                parts.append(f"--- Source: {r['url']} ---\n# {title or r.get('title') or r['url']}\n{text[:page_chars]}")
+        return "\n\n".join(parts)
+
+
+def search_and_fetch(query, max_results=WEB_SEARCH_MAX_RESULTS, fetch_pages=WEB_SEARCH_FETCH_PAGES,
+                     deadline=WEB_SEARCH_DEADLINE, provider=None, fetch=None):
+    """Search, then fetch the top `fetch_pages` results in parallel within `deadline` seconds overall."""
+    fetch = fetch or web_ingest.fetch
+    started = time.monotonic()
+    # Not a with-block: at the deadline we return without waiting for slow pages
+    pool = ThreadPoolExecutor(max_workers=max(fetch_pages, 1), thread_name_prefix="web-search")
+    try:
+        search = pool.submit(cached_search, query, max_results, provider)
+        done, _ = wait([search], timeout=deadline)
+        if not done:
+            raise SearchError(f"Search did not answer within {deadline:.0f}s")
+        report = SearchReport(query, search.result())
+
+        futures = {pool.submit(fetch, r["url"]): r["url"] for r in report.results[:fetch_pages]}
+        done, pending = wait(futures, timeout=max(0.0, deadline - (time.monotonic() - started)))
+        for future in done:
+            url = futures[future]
+            try:
+                page = future.result()
+                report.pages[url] = (page.title, page.text)
+            except Exception as e:
+                report.errors[url] = str(e)
+        report.timed_out = [futures[f] for f in pending]
+        return report
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)